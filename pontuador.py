@@ -1,7 +1,13 @@
 import os
+import csv
+import gzip
+import io
+import html
 import json
 import re
+import secrets
 import sys
+import tempfile
 from random import random
 from urllib.parse import urlparse
 import asyncpg
@@ -10,14 +16,22 @@ import random
 import nest_asyncio
 import asyncio
 import math
-from datetime import datetime, timedelta
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, User
 from telegram import Update, Bot
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
-from telegram.ext import ApplicationHandlerStop, CallbackQueryHandler
+from telegram.ext import ApplicationHandlerStop, CallbackQueryHandler, ChatMemberHandler, TypeHandler
 from dotenv import load_dotenv
+
+try:
+    import orjson  # opcional: decodifica JSON bem mais rápido que o json da stdlib
+except ImportError:
+    orjson = None
 from telegram.ext import ApplicationBuilder, ContextTypes
 from telegram import BotCommand, BotCommandScopeDefault, BotCommandScopeAllPrivateChats
 from telegram.ext import (
@@ -34,6 +48,17 @@ def hoje_hora_sp():
     return datetime.now(tz=ZoneInfo("America/Sao_Paulo"))
 
 
+def intervalo_dia_sp(dia: date) -> tuple[datetime, datetime]:
+    """
+    Retorna [início, fim) do dia em America/Sao_Paulo. Filtrar por faixa em vez de
+    DATE(coluna) = dia deixa o Postgres usar os índices sobre a coluna.
+    """
+    fuso = ZoneInfo("America/Sao_Paulo")
+    inicio = datetime.combine(dia, datetime.min.time(), tzinfo=fuso)
+    fim = datetime.combine(dia + timedelta(days=1), datetime.min.time(), tzinfo=fuso)
+    return inicio, fim
+
+
 def format_dt_sp(dt: datetime | None, fmt: str = "%d/%m/%Y %H:%M:%S") -> str:
     """
     Converte um datetime (UTC ou outro fuso) para America/Sao_Paulo
@@ -45,6 +70,45 @@ def format_dt_sp(dt: datetime | None, fmt: str = "%d/%m/%Y %H:%M:%S") -> str:
     return sp.strftime(fmt)
 
 
+class CacheTTL:
+    """
+    Cache LRU limitado a `max_itens`, com expiração por entrada (em segundos).
+    Só é usado de dentro do event loop, por isso não tem lock.
+    """
+
+    def __init__(self, max_itens: int, ttl: float):
+        self.max_itens = max_itens
+        self.ttl = ttl
+        self._dados: OrderedDict = OrderedDict()
+
+    def obter(self, chave, padrao=None):
+        item = self._dados.get(chave)
+        if item is None:
+            return padrao
+        valor, expira_em = item
+        if expira_em < time.monotonic():
+            del self._dados[chave]
+            return padrao
+        self._dados.move_to_end(chave)
+        return valor
+
+    def definir(self, chave, valor, ttl: float | None = None):
+        expira_em = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._dados[chave] = (valor, expira_em)
+        self._dados.move_to_end(chave)
+        while len(self._dados) > self.max_itens:
+            self._dados.popitem(last=False)
+
+    def remover(self, chave):
+        self._dados.pop(chave, None)
+
+    def limpar(self):
+        self._dados.clear()
+
+    def __len__(self):
+        return len(self._dados)
+
+
 pool: asyncpg.Pool | None = None
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -94,150 +158,944 @@ NIVEIS_BRINDES = {
 
 TEMPO_LIMITE_BUSCA = 10  # Tempo máximo (em segundos) para consulta
 
-ranking_mensagens_top = {}
+ranking_mensagens_top: dict[int, int] = {}  # chat_id -> message_id (cópia da tabela ranking_mensagens)
+
+
+# --- Registro central de consultas ---
+class ConexaoPontuador(asyncpg.Connection):
+    """
+    Conexão do pool; guarda em `preparadas` os statements do registro,
+    preparados uma única vez quando a conexão é aberta.
+    """
+    preparadas: dict
+
+
+def _json_padrao(valor):
+    # mesmo formato que o orjson usa para datas nativamente
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    return str(valor)
+
+
+def _json_dumps(valor) -> str:
+    """Mesma saída com ou sem orjson: chaves não-str viram texto e datas, ISO 8601."""
+    if orjson is not None:
+        return orjson.dumps(valor, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(valor, default=_json_padrao)
+
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+async def registrar_codecs_json(conn: asyncpg.Connection):
+    """json/jsonb chegam como dict/list e são enviados a partir deles, decodificados no driver."""
+    for tipo in ("json", "jsonb"):
+        await conn.set_type_codec(
+            tipo, encoder=_json_dumps, decoder=_json_loads, schema="pg_catalog"
+        )
+
+
+class RegistroConsultas:
+    """
+    Consultas SQL nomeadas. Cada uma é preparada uma vez por conexão (hook
+    `init` do pool) e chamada pelo nome; guarda nº de chamadas e tempo total.
+    """
+
+    def __init__(self):
+        self.sql: dict[str, str] = {}
+        self.chamadas: dict[str, int] = defaultdict(int)
+        self.tempo_total: dict[str, float] = defaultdict(float)
+
+    def registrar(self, nome: str, sql: str) -> str:
+        if nome in self.sql:
+            raise ValueError(f"Consulta '{nome}' registrada duas vezes")
+        self.sql[nome] = sql
+        return sql
+
+    async def preparar(self, conn: ConexaoPontuador):
+        # Os codecs vêm antes do prepare: o statement guarda o codec de cada coluna
+        await registrar_codecs_json(conn)
+        conn.preparadas = {}
+        for nome, sql in self.sql.items():
+            conn.preparadas[nome] = await conn.prepare(sql)
+
+    async def _executar(self, metodo: str, nome: str, *args):
+        async with pool.acquire() as conn:
+            stmt = conn.preparadas[nome]
+            inicio = time.perf_counter()
+            try:
+                return await getattr(stmt, metodo)(*args)
+            finally:
+                self.chamadas[nome] += 1
+                self.tempo_total[nome] += time.perf_counter() - inicio
+
+    async def fetch(self, nome: str, *args) -> list[asyncpg.Record]:
+        return await self._executar("fetch", nome, *args)
+
+    async def fetchrow(self, nome: str, *args) -> asyncpg.Record | None:
+        return await self._executar("fetchrow", nome, *args)
+
+    async def fetchval(self, nome: str, *args):
+        return await self._executar("fetchval", nome, *args)
+
+    async def execute(self, nome: str, *args):
+        # PreparedStatement não tem execute(); o resultado é simplesmente descartado
+        await self._executar("fetch", nome, *args)
+
+    def estatisticas(self) -> list[tuple[str, int, float]]:
+        """(nome, chamadas, tempo total em segundos), do mais caro para o mais barato."""
+        return sorted(
+            ((nome, self.chamadas[nome], self.tempo_total[nome]) for nome in self.sql),
+            key=lambda item: item[2],
+            reverse=True
+        )
+
+
+consultas = RegistroConsultas()
+
+consultas.registrar("usuario_por_id", "SELECT * FROM usuarios WHERE user_id = $1")
+consultas.registrar("nome_usuario", "SELECT username, first_name, last_name FROM usuarios WHERE user_id = $1")
+consultas.registrar("zerar_pontos", "UPDATE usuarios SET pontos = 0 WHERE user_id = $1")
+consultas.registrar("pontos_todos", "SELECT user_id, pontos FROM usuarios")
+consultas.registrar("checkins_do_dia", "SELECT user_id FROM usuarios WHERE ultima_interacao = $1")
+consultas.registrar("config_checkin", "SELECT chave, valor FROM config_checkin")
+consultas.registrar("existe_wallet", "SELECT 1 FROM wallet WHERE user_id = $1")
+consultas.registrar("saldo_wallet", "SELECT saldo FROM wallet WHERE user_id = $1")
+consultas.registrar("wallet_usuario", "SELECT saldo, atualizado FROM wallet WHERE user_id = $1")
+consultas.registrar("fila_por_codigo", "SELECT id, user_id FROM fila_pagamento WHERE code = $1")
+consultas.registrar("fila_remover", "DELETE FROM fila_pagamento WHERE id = $1")
+
+
+# --- Tarefas periódicas em segundo plano ---
+tarefas_periodicas: list[asyncio.Task] = []
+
+
+def agendar_periodica(nome: str, intervalo: float, funcao):
+    """Roda `await funcao()` a cada `intervalo` segundos até o shutdown."""
+    async def _laco():
+        while True:
+            await asyncio.sleep(intervalo)
+            try:
+                await funcao()
+            except Exception:
+                logger.exception(f"[{nome}] Erro na tarefa periódica")
+
+    tarefas_periodicas.append(asyncio.create_task(_laco(), name=nome))
+
+
+# Tarefas avulsas: o loop só guarda referência fraca às tasks, então elas ficam
+# neste conjunto até terminar; exceção de uma delas vai para o log.
+tarefas_avulsas: set[asyncio.Task] = set()
+
+
+def _fim_tarefa_avulsa(tarefa: asyncio.Task):
+    tarefas_avulsas.discard(tarefa)
+    if not tarefa.cancelled() and tarefa.exception() is not None:
+        logger.error(f"[{tarefa.get_name()}] Erro na tarefa em segundo plano", exc_info=tarefa.exception())
+
+
+def disparar_tarefa(coro, nome: str) -> asyncio.Task:
+    """Roda `coro` em segundo plano sem que a task se perca no meio do caminho."""
+    tarefa = asyncio.create_task(coro, name=nome)
+    tarefas_avulsas.add(tarefa)
+    tarefa.add_done_callback(_fim_tarefa_avulsa)
+    return tarefa
+
+
+async def parar_tarefas_periodicas():
+    for tarefa in tarefas_periodicas:
+        tarefa.cancel()
+    await asyncio.gather(*tarefas_periodicas, return_exceptions=True)
+    tarefas_periodicas.clear()
+
+
+# --- Migrações de schema ---
+# Cada migração roda uma única vez, em ordem de versão e dentro de uma transação,
+# e fica registrada em schema_version. Migração publicada não se edita: cria-se outra.
+MIGRACOES_LOCK_ID = 7_146_021_001  # chave do pg_advisory_lock de quem migra
+MIGRACOES: list[tuple[int, str, str]] = []
+
+
+def registrar_migracao(versao: int, descricao: str, sql: str) -> None:
+    if MIGRACOES and versao <= MIGRACOES[-1][0]:
+        raise ValueError(f"Migração {versao} fora de ordem (última: {MIGRACOES[-1][0]})")
+    MIGRACOES.append((versao, descricao, sql))
+
+
+registrar_migracao(1, "schema inicial", """
+CREATE TABLE IF NOT EXISTS usuarios (
+    user_id            BIGINT PRIMARY KEY,
+    username           TEXT NOT NULL DEFAULT 'vazio',
+    first_name         TEXT NOT NULL DEFAULT 'vazio',
+    last_name          TEXT NOT NULL DEFAULT 'vazio',
+    pontos             INTEGER NOT NULL DEFAULT 0,
+    nivel_atingido     INTEGER NOT NULL DEFAULT 0,
+    ultima_interacao   DATE,                                
+    inserido_em        TIMESTAMPTZ NOT NULL DEFAULT NOW(),    -- quando o usuário foi inserido
+    atualizado_em      TIMESTAMPTZ NOT NULL DEFAULT NOW(),     -- quando qualquer coluna for atualizada
+    display_choice     VARCHAR(20) NOT NULL DEFAULT 'indefinido',
+    nickname           VARCHAR(50) NOT NULL DEFAULT 'sem nick',
+    via_start          BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE IF NOT EXISTS historico_pontos (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT REFERENCES usuarios(user_id),
+    pontos INTEGER NOT NULL,
+    motivo TEXT NOT NULL DEFAULT 'Não Especificado',
+    data TIMESTAMPTZ  DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS config_checkin (  
+    chave TEXT PRIMARY KEY,  -- chave é adicionar pontos por checkin
+    valor TEXT NOT NULL   -- valor é true para pontuar por checkin e false pra nao pontuar
+);
+
+-- Cria tabela que registra o envio para carteira (sem alterar usuarios):
+CREATE TABLE IF NOT EXISTS envios_carteira (
+    user_id      BIGINT PRIMARY KEY,
+    enviado_em   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Cria tabela de carteiras
+CREATE TABLE IF NOT EXISTS wallet (
+    user_id    BIGINT PRIMARY KEY,
+    username   TEXT NOT NULL DEFAULT 'vazio',
+    first_name TEXT NOT NULL DEFAULT 'vazio',
+    last_name  TEXT NOT NULL DEFAULT 'vazio',
+    saldo      numeric(12,2) NOT NULL DEFAULT 0,
+    atualizado TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+
+CREATE TABLE IF NOT EXISTS admins (
+    user_id BIGINT PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS wallet_historico_user (
+    id          SERIAL PRIMARY KEY,
+    user_id     BIGINT NOT NULL,
+    valor       INTEGER NOT NULL,
+    tipo        TEXT NOT NULL CHECK (tipo IN ('credito', 'debito')),
+    descricao   TEXT NOT NULL,
+    criado_em   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+
+    -- duplicação leve de nome pra exibir no admin se quiser
+    username    TEXT NOT NULL DEFAULT 'vazio',
+    first_name  TEXT NOT NULL DEFAULT 'vazio',
+    last_name   TEXT NOT NULL DEFAULT 'vazio'
+);
+
+-- tabela de canais para uso em sorteio_config
+CREATE TABLE IF NOT EXISTS canais (
+    id   BIGINT PRIMARY KEY,
+    nome TEXT
+);
+
+CREATE TABLE IF NOT EXISTS ganhadores_bloqueados (
+    user_id BIGINT PRIMARY KEY,
+    bloqueado_em TIMESTAMP DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS movimentacoes_globais (
+    id             SERIAL PRIMARY KEY,
+    usuario_id     BIGINT       NOT NULL,
+    nome_usuario   TEXT         NOT NULL  DEFAULT 'vazio',
+    evento         TEXT         NOT NULL,
+    detalhes       JSONB        NOT NULL DEFAULT '{}' ,
+    criado_em      TIMESTAMPTZ  NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS fila_pagamento (
+    id          SERIAL PRIMARY KEY,
+    user_id     BIGINT    NOT NULL,
+    code        TEXT      NOT NULL,
+    created_em  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS sorteio_config (
+    id                          SERIAL PRIMARY KEY,
+    canal_id                    BIGINT REFERENCES canais(id) ON DELETE SET NULL,
+    criado_em                   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    ativo                       BOOLEAN    NOT NULL DEFAULT TRUE,
+
+    total_montante              NUMERIC    NOT NULL,
+    valor_premio                NUMERIC    NOT NULL,
+    premios_iniciais            INT        NOT NULL,
+    premios_restantes           INT        NOT NULL,
+
+    total_participantes_esperados INT     NOT NULL,  -- Nº base de participantes
+    tentativas_por_usuario        INT     NOT NULL DEFAULT 3,  -- Nº de tentativas antes do cooldown
+    cooldown_minutos              INT     NOT NULL DEFAULT 5,  -- Minutos de espera após esgotar
+    tentativa_atual               INT     NOT NULL DEFAULT 0,  -- Contador de tentativas no evento
+    numero_esperado_atual         INT     NOT NULL        -- Número que o usuário deve acertar
+);
+
+CREATE TABLE IF NOT EXISTS sorteio_tentativas (
+    event_id INT NOT NULL REFERENCES sorteio_config(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    tentado_em TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (event_id, user_id, tentado_em)
+);
+
+CREATE TABLE IF NOT EXISTS sorteio_ganhadores (
+    event_id INT NOT NULL REFERENCES sorteio_config(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    ganho_em TIMESTAMPTZ DEFAULT NOW(),
+    PRIMARY KEY (event_id, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS usuario_history (
+    id           SERIAL    PRIMARY KEY,
+    user_id      BIGINT    NOT NULL REFERENCES usuarios(user_id) ON DELETE CASCADE,
+    status       TEXT      NOT NULL,         -- 'Inserido' ou 'Atualizado'
+    username     TEXT      NOT NULL DEFAULT 'vazio',
+    first_name   TEXT      NOT NULL DEFAULT 'vazio',
+    last_name    TEXT      NOT NULL DEFAULT 'vazio',
+    inserido_em  TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    display_choice  VARCHAR(20) NOT NULL DEFAULT 'indefinido',
+    nickname        VARCHAR(50) NOT NULL DEFAULT 'sem nick',
+    via_start          BOOLEAN NOT NULL DEFAULT FALSE
+);
+""")
+
+
+registrar_migracao(2, "índices dos caminhos quentes", """
+-- rankings (top_ranking, /ranking, IndiceRanking) e listagens por pontos
+CREATE INDEX IF NOT EXISTS idx_usuarios_pontos
+    ON usuarios (pontos DESC, user_id DESC);
+-- check-ins do dia (checkins_do_dia)
+CREATE INDEX IF NOT EXISTS idx_usuarios_ultima_interacao
+    ON usuarios (ultima_interacao);
+-- /listar_via_start: índice parcial só com quem entrou pelo /start
+CREATE INDEX IF NOT EXISTS idx_usuarios_via_start
+    ON usuarios (inserido_em, user_id) WHERE via_start;
+-- estatísticas: novos usuários do dia
+CREATE INDEX IF NOT EXISTS idx_usuarios_inserido_em
+    ON usuarios (inserido_em);
+
+-- estatísticas: soma por usuário até uma data e filtros por dia
+CREATE INDEX IF NOT EXISTS idx_historico_pontos_user_data
+    ON historico_pontos (user_id, data);
+CREATE INDEX IF NOT EXISTS idx_historico_pontos_data
+    ON historico_pontos (data);
+
+-- /historico_usuario: por usuário, global e busca por nickname
+CREATE INDEX IF NOT EXISTS idx_usuario_history_user
+    ON usuario_history (user_id, inserido_em DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_usuario_history_inserido
+    ON usuario_history (inserido_em DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_usuario_history_nickname
+    ON usuario_history (nickname, inserido_em DESC);
+
+-- /pay_codigo e o INSERT ... WHERE NOT EXISTS da fila
+CREATE INDEX IF NOT EXISTS idx_fila_pagamento_code
+    ON fila_pagamento (code);
+CREATE INDEX IF NOT EXISTS idx_fila_pagamento_user
+    ON fila_pagamento (user_id);
+
+-- /timeline
+CREATE INDEX IF NOT EXISTS idx_movimentacoes_criado_em
+    ON movimentacoes_globais (criado_em DESC);
+""")
+
+registrar_migracao(3, "snapshots de ranking por janela", """
+-- período coberto pelo último snapshot de cada janela
+CREATE TABLE IF NOT EXISTS ranking_janelas (
+    janela      TEXT PRIMARY KEY,          -- 'diario' | 'semanal' | 'campanha'
+    inicio      TIMESTAMPTZ NOT NULL,
+    fim         TIMESTAMPTZ NOT NULL,
+    gerado_em   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS ranking_snapshots (
+    janela      TEXT    NOT NULL REFERENCES ranking_janelas(janela) ON DELETE CASCADE,
+    posicao     INTEGER NOT NULL,
+    user_id     BIGINT  NOT NULL,
+    pontos      INTEGER NOT NULL,
+    PRIMARY KEY (janela, posicao)
+);
+""")
+
+registrar_migracao(4, "mensagem de ranking persistente por chat", """
+CREATE TABLE IF NOT EXISTS ranking_mensagens (
+    chat_id        BIGINT PRIMARY KEY,
+    message_id     BIGINT NOT NULL,
+    atualizado_em  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+""")
+
+# Rollup diário do /estatisticas, mantido por triggers de statement (com transition
+# tables) em historico_pontos e usuarios: qualquer caminho de escrita atualiza, e o
+# lote de presença gera um único upsert por statement.
+registrar_migracao(5, "rollup stats_diarias", f"""
+CREATE TABLE IF NOT EXISTS stats_diarias (
+    dia                  DATE PRIMARY KEY,              -- data em America/Sao_Paulo
+    novos_usuarios       INTEGER NOT NULL DEFAULT 0,
+    usuarios_ativos      INTEGER NOT NULL DEFAULT 0,    -- pontuados (> 0) no dia
+    pontos_distribuidos  BIGINT  NOT NULL DEFAULT 0,
+    pontos_removidos     BIGINT  NOT NULL DEFAULT 0,
+    niveis_atingidos     INTEGER NOT NULL DEFAULT 0     -- usuários que subiram de nível no dia
+);
+
+-- quem já entrou em cada contador distinto do dia
+CREATE TABLE IF NOT EXISTS stats_usuarios_dia (
+    dia          DATE    NOT NULL,
+    user_id      BIGINT  NOT NULL,
+    ativo        BOOLEAN NOT NULL DEFAULT FALSE,
+    subiu_nivel  BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (dia, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_usuarios_com_nivel
+    ON usuarios (user_id) WHERE nivel_atingido > 0;
+
+CREATE OR REPLACE FUNCTION stats_historico_pontos() RETURNS trigger AS $$
+BEGIN
+    WITH linhas AS (
+        SELECT (COALESCE(data, NOW()) AT TIME ZONE 'America/Sao_Paulo')::date AS dia,
+               user_id, pontos
+          FROM novas
+    ),
+    ativos AS (
+        INSERT INTO stats_usuarios_dia AS d (dia, user_id, ativo)
+        SELECT DISTINCT dia, user_id, TRUE
+          FROM linhas
+         WHERE pontos > 0 AND user_id IS NOT NULL
+        ON CONFLICT (dia, user_id) DO UPDATE SET ativo = TRUE WHERE NOT d.ativo
+        RETURNING dia
+    ),
+    por_dia AS (
+        SELECT dia, SUM(GREATEST(pontos, 0)) AS dados, SUM(GREATEST(-pontos, 0)) AS removidos
+          FROM linhas
+         GROUP BY dia
+    )
+    INSERT INTO stats_diarias AS s (dia, usuarios_ativos, pontos_distribuidos, pontos_removidos)
+    SELECT p.dia, (SELECT COUNT(*) FROM ativos a WHERE a.dia = p.dia), p.dados, p.removidos
+      FROM por_dia p
+    ON CONFLICT (dia) DO UPDATE
+       SET usuarios_ativos     = s.usuarios_ativos + EXCLUDED.usuarios_ativos,
+           pontos_distribuidos = s.pontos_distribuidos + EXCLUDED.pontos_distribuidos,
+           pontos_removidos    = s.pontos_removidos + EXCLUDED.pontos_removidos;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- nível: conta quem teve nivel_atingido aumentado (ou já nasceu com nível) no dia
+CREATE OR REPLACE FUNCTION stats_registrar_niveis(p_usuarios BIGINT[]) RETURNS void AS $$
+DECLARE
+    v_hoje DATE := (NOW() AT TIME ZONE 'America/Sao_Paulo')::date;
+BEGIN
+    WITH marcados AS (
+        INSERT INTO stats_usuarios_dia AS d (dia, user_id, subiu_nivel)
+        SELECT v_hoje, u, TRUE FROM unnest(p_usuarios) AS u
+        ON CONFLICT (dia, user_id) DO UPDATE SET subiu_nivel = TRUE WHERE NOT d.subiu_nivel
+        RETURNING user_id
+    )
+    INSERT INTO stats_diarias AS s (dia, niveis_atingidos)
+    SELECT v_hoje, COUNT(*) FROM marcados
+    ON CONFLICT (dia) DO UPDATE
+       SET niveis_atingidos = s.niveis_atingidos + EXCLUDED.niveis_atingidos;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_usuarios_inseridos() RETURNS trigger AS $$
+DECLARE
+    v_subiram BIGINT[];
+BEGIN
+    INSERT INTO stats_diarias AS s (dia, novos_usuarios)
+    SELECT (inserido_em AT TIME ZONE 'America/Sao_Paulo')::date, COUNT(*)
+      FROM novos
+     GROUP BY 1
+    ON CONFLICT (dia) DO UPDATE
+       SET novos_usuarios = s.novos_usuarios + EXCLUDED.novos_usuarios;
+
+    SELECT array_agg(user_id) INTO v_subiram FROM novos WHERE nivel_atingido > 0;
+    IF v_subiram IS NOT NULL THEN
+        PERFORM stats_registrar_niveis(v_subiram);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_usuarios_atualizados() RETURNS trigger AS $$
+DECLARE
+    v_subiram BIGINT[];
+BEGIN
+    SELECT array_agg(n.user_id) INTO v_subiram
+      FROM novos n
+      JOIN antigos o ON o.user_id = n.user_id
+     WHERE n.nivel_atingido > o.nivel_atingido;
+    IF v_subiram IS NOT NULL THEN
+        PERFORM stats_registrar_niveis(v_subiram);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_stats_historico_pontos ON historico_pontos;
+CREATE TRIGGER trg_stats_historico_pontos
+    AFTER INSERT ON historico_pontos
+    REFERENCING NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_historico_pontos();
+
+DROP TRIGGER IF EXISTS trg_stats_usuarios_inseridos ON usuarios;
+CREATE TRIGGER trg_stats_usuarios_inseridos
+    AFTER INSERT ON usuarios
+    REFERENCING NEW TABLE AS novos
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_usuarios_inseridos();
+
+DROP TRIGGER IF EXISTS trg_stats_usuarios_atualizados ON usuarios;
+CREATE TRIGGER trg_stats_usuarios_atualizados
+    AFTER UPDATE ON usuarios
+    REFERENCING OLD TABLE AS antigos NEW TABLE AS novos
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_usuarios_atualizados();
+
+-- carga inicial a partir do que já existe
+INSERT INTO stats_diarias (dia, novos_usuarios)
+SELECT (inserido_em AT TIME ZONE 'America/Sao_Paulo')::date, COUNT(*)
+  FROM usuarios
+ GROUP BY 1;
+
+INSERT INTO stats_diarias AS s (dia, pontos_distribuidos, pontos_removidos)
+SELECT (data AT TIME ZONE 'America/Sao_Paulo')::date,
+       SUM(GREATEST(pontos, 0)), SUM(GREATEST(-pontos, 0))
+  FROM historico_pontos
+ WHERE data IS NOT NULL
+ GROUP BY 1
+ON CONFLICT (dia) DO UPDATE
+   SET pontos_distribuidos = EXCLUDED.pontos_distribuidos,
+       pontos_removidos    = EXCLUDED.pontos_removidos;
+
+INSERT INTO stats_usuarios_dia (dia, user_id, ativo)
+SELECT DISTINCT (data AT TIME ZONE 'America/Sao_Paulo')::date, user_id, TRUE
+  FROM historico_pontos
+ WHERE pontos > 0 AND user_id IS NOT NULL AND data IS NOT NULL;
+
+-- níveis do passado: saldo acumulado até a véspera vs. pontos positivos do dia
+WITH diario AS (
+    SELECT user_id,
+           (data AT TIME ZONE 'America/Sao_Paulo')::date AS dia,
+           SUM(pontos) AS saldo_dia,
+           COALESCE(SUM(pontos) FILTER (WHERE pontos > 0), 0) AS positivos
+      FROM historico_pontos
+     WHERE user_id IS NOT NULL AND data IS NOT NULL
+     GROUP BY 1, 2
+),
+acumulado AS (
+    SELECT user_id, dia, positivos,
+           COALESCE(SUM(saldo_dia) OVER (
+               PARTITION BY user_id ORDER BY dia
+               ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+           ), 0) AS antes
+      FROM diario
+)
+INSERT INTO stats_usuarios_dia AS d (dia, user_id, subiu_nivel)
+SELECT dia, user_id, TRUE
+  FROM acumulado a
+ WHERE a.positivos > 0
+   AND EXISTS (
+        SELECT 1 FROM unnest(ARRAY[{', '.join(str(n) for n in sorted(NIVEIS_BRINDES))}]) AS limiar
+         WHERE a.antes < limiar AND limiar <= a.antes + a.positivos
+       )
+ON CONFLICT (dia, user_id) DO UPDATE SET subiu_nivel = TRUE;
+
+UPDATE stats_diarias s
+   SET usuarios_ativos  = c.ativos,
+       niveis_atingidos = c.niveis
+  FROM (
+        SELECT dia,
+               COUNT(*) FILTER (WHERE ativo) AS ativos,
+               COUNT(*) FILTER (WHERE subiu_nivel) AS niveis
+          FROM stats_usuarios_dia
+         GROUP BY dia
+       ) c
+ WHERE s.dia = c.dia;
+""")
+
+# Particionamento mensal (por data em SP) das tabelas de histórico só-append. A tabela
+# antiga é renomeada, a nova herda a mesma sequence de ids e recebe as linhas; a
+# partição DEFAULT só pega o que cair fora das partições criadas pelo job.
+registrar_migracao(6, "particionamento mensal de historico_pontos e movimentacoes_globais", """
+CREATE OR REPLACE FUNCTION criar_particao_mensal(p_tabela TEXT, p_mes DATE) RETURNS void AS $$
+DECLARE
+    v_inicio DATE := date_trunc('month', p_mes)::date;
+    v_nome   TEXT := p_tabela || '_' || to_char(v_inicio, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+        v_nome, p_tabela,
+        v_inicio::timestamp AT TIME ZONE 'America/Sao_Paulo',
+        (v_inicio + INTERVAL '1 month')::timestamp AT TIME ZONE 'America/Sao_Paulo'
+    );
+END
+$$ LANGUAGE plpgsql;
+
+-- historico_pontos
+ALTER TABLE historico_pontos RENAME TO historico_pontos_legado;
+ALTER INDEX historico_pontos_pkey RENAME TO historico_pontos_legado_pkey;
+DROP INDEX IF EXISTS idx_historico_pontos_user_data;
+DROP INDEX IF EXISTS idx_historico_pontos_data;
+ALTER SEQUENCE historico_pontos_id_seq OWNED BY NONE;
+
+CREATE TABLE historico_pontos (
+    id       INTEGER NOT NULL DEFAULT nextval('historico_pontos_id_seq'),
+    user_id  BIGINT REFERENCES usuarios(user_id),
+    pontos   INTEGER NOT NULL,
+    motivo   TEXT NOT NULL DEFAULT 'Não Especificado',
+    data     TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, data)
+) PARTITION BY RANGE (data);
+ALTER SEQUENCE historico_pontos_id_seq OWNED BY historico_pontos.id;
+CREATE TABLE historico_pontos_padrao PARTITION OF historico_pontos DEFAULT;
+
+SELECT criar_particao_mensal('historico_pontos', m::date)
+  FROM generate_series(
+        date_trunc('month', COALESCE((SELECT MIN(data) FROM historico_pontos_legado), NOW())
+                            AT TIME ZONE 'America/Sao_Paulo'),
+        date_trunc('month', NOW() AT TIME ZONE 'America/Sao_Paulo') + INTERVAL '1 month',
+        INTERVAL '1 month'
+       ) AS m;
+
+INSERT INTO historico_pontos (id, user_id, pontos, motivo, data)
+SELECT id, user_id, pontos, motivo, COALESCE(data, NOW())
+  FROM historico_pontos_legado;
+DROP TABLE historico_pontos_legado;
+
+CREATE INDEX idx_historico_pontos_user_data ON historico_pontos (user_id, data);
+CREATE INDEX idx_historico_pontos_data ON historico_pontos (data);
+-- o trigger do rollup (migração 5) foi junto com a tabela antiga; recria no pai
+CREATE TRIGGER trg_stats_historico_pontos
+    AFTER INSERT ON historico_pontos
+    REFERENCING NEW TABLE AS novas
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_historico_pontos();
+
+-- movimentacoes_globais
+ALTER TABLE movimentacoes_globais RENAME TO movimentacoes_globais_legado;
+ALTER INDEX movimentacoes_globais_pkey RENAME TO movimentacoes_globais_legado_pkey;
+DROP INDEX IF EXISTS idx_movimentacoes_criado_em;
+ALTER SEQUENCE movimentacoes_globais_id_seq OWNED BY NONE;
+
+CREATE TABLE movimentacoes_globais (
+    id             INTEGER      NOT NULL DEFAULT nextval('movimentacoes_globais_id_seq'),
+    usuario_id     BIGINT       NOT NULL,
+    nome_usuario   TEXT         NOT NULL DEFAULT 'vazio',
+    evento         TEXT         NOT NULL,
+    detalhes       JSONB        NOT NULL DEFAULT '{}',
+    criado_em      TIMESTAMPTZ  NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (id, criado_em)
+) PARTITION BY RANGE (criado_em);
+ALTER SEQUENCE movimentacoes_globais_id_seq OWNED BY movimentacoes_globais.id;
+CREATE TABLE movimentacoes_globais_padrao PARTITION OF movimentacoes_globais DEFAULT;
+
+SELECT criar_particao_mensal('movimentacoes_globais', m::date)
+  FROM generate_series(
+        date_trunc('month', COALESCE((SELECT MIN(criado_em) FROM movimentacoes_globais_legado), NOW())
+                            AT TIME ZONE 'America/Sao_Paulo'),
+        date_trunc('month', NOW() AT TIME ZONE 'America/Sao_Paulo') + INTERVAL '1 month',
+        INTERVAL '1 month'
+       ) AS m;
+
+INSERT INTO movimentacoes_globais (id, usuario_id, nome_usuario, evento, detalhes, criado_em)
+SELECT id, usuario_id, nome_usuario, evento, detalhes, criado_em
+  FROM movimentacoes_globais_legado;
+DROP TABLE movimentacoes_globais_legado;
+
+CREATE INDEX idx_movimentacoes_criado_em ON movimentacoes_globais (criado_em DESC);
+""")
+
+registrar_migracao(7, "busca por trigramas em usuario_history", """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- um GIN por coluna: o planner combina as três num BitmapOr
+CREATE INDEX IF NOT EXISTS idx_usuario_history_nickname_trgm
+    ON usuario_history USING gin (nickname gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_usuario_history_username_trgm
+    ON usuario_history USING gin (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_usuario_history_first_name_trgm
+    ON usuario_history USING gin (first_name gin_trgm_ops);
+""")
+
+registrar_migracao(8, "índices da timeline paginada por (criado_em, id)", """
+DROP INDEX IF EXISTS idx_movimentacoes_criado_em;
+CREATE INDEX IF NOT EXISTS idx_movimentacoes_criado_em_id
+    ON movimentacoes_globais (criado_em DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_movimentacoes_usuario
+    ON movimentacoes_globais (usuario_id, criado_em DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_movimentacoes_evento
+    ON movimentacoes_globais (evento, criado_em DESC, id DESC);
+""")
+
+# niveis_atingidos conta a primeira vez que o usuário chega a um nível. Zerar os
+# pontos (resgate para a carteira) e subir de novo não é um nível novo: guarda o
+# maior nível já atingido e só conta o que passar dele.
+registrar_migracao(9, "níveis contados só acima do máximo histórico", f"""
+CREATE TABLE IF NOT EXISTS stats_nivel_maximo (
+    user_id  BIGINT  PRIMARY KEY,
+    nivel    INTEGER NOT NULL
+);
+
+-- carga inicial: nível atual ou o do maior saldo acumulado no histórico
+INSERT INTO stats_nivel_maximo (user_id, nivel)
+SELECT user_id, MAX(nivel)
+  FROM (
+        SELECT user_id, nivel_atingido AS nivel FROM usuarios
+        UNION ALL
+        SELECT user_id,
+               (SELECT COUNT(*)
+                  FROM unnest(ARRAY[{', '.join(str(n) for n in sorted(NIVEIS_BRINDES))}]) AS limiar
+                 WHERE limiar <= saldo)::int
+          FROM (
+                SELECT user_id, SUM(pontos) OVER (PARTITION BY user_id ORDER BY data, id) AS saldo
+                  FROM historico_pontos
+                 WHERE user_id IS NOT NULL
+               ) AS acumulado
+       ) AS niveis
+ WHERE nivel > 0
+ GROUP BY user_id;
+
+DROP FUNCTION IF EXISTS stats_registrar_niveis(BIGINT[]);
+
+CREATE OR REPLACE FUNCTION stats_registrar_niveis(p_usuarios BIGINT[], p_niveis INTEGER[]) RETURNS void AS $$
+DECLARE
+    v_hoje DATE := (NOW() AT TIME ZONE 'America/Sao_Paulo')::date;
+BEGIN
+    WITH recordes AS (
+        INSERT INTO stats_nivel_maximo AS m (user_id, nivel)
+        SELECT u, n FROM unnest(p_usuarios, p_niveis) AS t(u, n)
+        ON CONFLICT (user_id) DO UPDATE SET nivel = EXCLUDED.nivel WHERE m.nivel < EXCLUDED.nivel
+        RETURNING user_id
+    ),
+    marcados AS (
+        INSERT INTO stats_usuarios_dia AS d (dia, user_id, subiu_nivel)
+        SELECT v_hoje, user_id, TRUE FROM recordes
+        ON CONFLICT (dia, user_id) DO UPDATE SET subiu_nivel = TRUE WHERE NOT d.subiu_nivel
+        RETURNING user_id
+    )
+    INSERT INTO stats_diarias AS s (dia, niveis_atingidos)
+    SELECT v_hoje, COUNT(*) FROM marcados
+    ON CONFLICT (dia) DO UPDATE
+       SET niveis_atingidos = s.niveis_atingidos + EXCLUDED.niveis_atingidos;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_usuarios_inseridos() RETURNS trigger AS $$
+DECLARE
+    v_usuarios BIGINT[];
+    v_niveis   INTEGER[];
+BEGIN
+    INSERT INTO stats_diarias AS s (dia, novos_usuarios)
+    SELECT (inserido_em AT TIME ZONE 'America/Sao_Paulo')::date, COUNT(*)
+      FROM novos
+     GROUP BY 1
+    ON CONFLICT (dia) DO UPDATE
+       SET novos_usuarios = s.novos_usuarios + EXCLUDED.novos_usuarios;
+
+    SELECT array_agg(user_id), array_agg(nivel_atingido) INTO v_usuarios, v_niveis
+      FROM novos WHERE nivel_atingido > 0;
+    IF v_usuarios IS NOT NULL THEN
+        PERFORM stats_registrar_niveis(v_usuarios, v_niveis);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_usuarios_atualizados() RETURNS trigger AS $$
+DECLARE
+    v_usuarios BIGINT[];
+    v_niveis   INTEGER[];
+BEGIN
+    -- subir em relação à linha anterior é só o filtro barato; quem decide é o máximo
+    SELECT array_agg(n.user_id), array_agg(n.nivel_atingido) INTO v_usuarios, v_niveis
+      FROM novos n
+      JOIN antigos o ON o.user_id = n.user_id
+     WHERE n.nivel_atingido > o.nivel_atingido;
+    IF v_usuarios IS NOT NULL THEN
+        PERFORM stats_registrar_niveis(v_usuarios, v_niveis);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+""")
+
+# Se a job de partições falhar por um mês (ou chegar um timestamp adiantado), as
+# linhas do mês vão para a DEFAULT e o CREATE ... PARTITION OF passa a falhar para
+# sempre. A partição agora nasce como tabela solta, recebe as linhas do mês que
+# estavam na DEFAULT e só então é anexada, tudo na mesma transação.
+registrar_migracao(10, "criar_particao_mensal resgata linhas da partição DEFAULT", """
+DROP FUNCTION IF EXISTS criar_particao_mensal(TEXT, DATE);
+
+CREATE FUNCTION criar_particao_mensal(p_tabela TEXT, p_mes DATE) RETURNS BIGINT AS $$
+DECLARE
+    v_inicio  DATE := date_trunc('month', p_mes)::date;
+    v_nome    TEXT := p_tabela || '_' || to_char(v_inicio, 'YYYY_MM');
+    v_de      TIMESTAMPTZ := v_inicio::timestamp AT TIME ZONE 'America/Sao_Paulo';
+    v_ate     TIMESTAMPTZ := (v_inicio + INTERVAL '1 month')::timestamp AT TIME ZONE 'America/Sao_Paulo';
+    v_coluna  TEXT;
+    v_movidas BIGINT;
+BEGIN
+    -- dois processos do bot podem chamar ao mesmo tempo
+    PERFORM pg_advisory_xact_lock(hashtext(v_nome));
+    IF to_regclass(v_nome) IS NOT NULL THEN
+        RETURN 0;
+    END IF;
+
+    SELECT a.attname INTO v_coluna
+      FROM pg_partitioned_table pt
+      JOIN pg_attribute a ON a.attrelid = pt.partrelid AND a.attnum = pt.partattrs[0]
+     WHERE pt.partrelid = p_tabela::regclass;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', v_nome, p_tabela);
+    EXECUTE format(
+        'WITH movidas AS (DELETE FROM %I WHERE %I >= %L AND %I < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM movidas',
+        p_tabela || '_padrao', v_coluna, v_de, v_coluna, v_ate, v_nome
+    );
+    GET DIAGNOSTICS v_movidas = ROW_COUNT;
+    EXECUTE format(
+        'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        p_tabela, v_nome, v_de, v_ate
+    );
+    RETURN v_movidas;
+END
+$$ LANGUAGE plpgsql;
+""")
+
+# o total "já atingiram algum nível" passou a vir de stats_nivel_maximo
+registrar_migracao(11, "remove índice parcial sem uso em usuarios", """
+DROP INDEX IF EXISTS idx_usuarios_com_nivel;
+""")
+
+
+async def versoes_aplicadas(conn: asyncpg.Connection) -> set[int]:
+    existe = await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not existe:
+        return set()
+    return {r["versao"] for r in await conn.fetch("SELECT versao FROM schema_version")}
+
+
+async def aplicar_migracoes(conn: asyncpg.Connection) -> None:
+    """
+    Aplica as migrações pendentes. Com o schema em dia, só lê schema_version e sai;
+    caso contrário, serializa via advisory lock para que só um processo migre.
+    """
+    if {v for v, _, _ in MIGRACOES} <= await versoes_aplicadas(conn):
+        return
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRACOES_LOCK_ID)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                versao       INTEGER PRIMARY KEY,
+                descricao    TEXT NOT NULL,
+                aplicado_em  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+        """)
+        # Relê com o lock: outro processo pode ter migrado enquanto esperávamos
+        aplicadas = await versoes_aplicadas(conn)
+        for versao, descricao, sql in MIGRACOES:
+            if versao in aplicadas:
+                continue
+            logger.info(f"[migracao] aplicando {versao:04d} — {descricao}")
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_version (versao, descricao) VALUES ($1, $2)",
+                    versao, descricao
+                )
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRACOES_LOCK_ID)
 
 
 async def init_db_pool():
     global pool
-    pool = await asyncpg.create_pool(dsn=DATABASE_URL, min_size=1, max_size=10)
 
+    # As migrações rodam antes do pool: o hook `init` prepara as consultas do
+    # registro e elas precisam que as tabelas já existam.
+    conn = await asyncpg.connect(dsn=DATABASE_URL)
+    try:
+        await aplicar_migracoes(conn)
+    finally:
+        await conn.close()
+
+    pool = await asyncpg.create_pool(
+        dsn=DATABASE_URL,
+        min_size=1,
+        max_size=10,
+        connection_class=ConexaoPontuador,
+        init=consultas.preparar
+    )
+
+
+# --- Partições mensais ---
+TABELAS_PARTICIONADAS = ("historico_pontos", "movimentacoes_globais")
+PARTICOES_INTERVALO_SEG = 6 * 3600
+
+
+async def criar_particoes_mensais():
+    """Garante as partições do mês corrente e do próximo (idempotente)."""
+    mes_atual = hoje_data_sp().replace(day=1)
+    proximo_mes = (mes_atual + timedelta(days=32)).replace(day=1)
     async with pool.acquire() as conn:
-        await conn.execute("""
-       CREATE TABLE IF NOT EXISTS usuarios (
-            user_id            BIGINT PRIMARY KEY,
-            username           TEXT NOT NULL DEFAULT 'vazio',
-            first_name         TEXT NOT NULL DEFAULT 'vazio',
-            last_name          TEXT NOT NULL DEFAULT 'vazio',
-            pontos             INTEGER NOT NULL DEFAULT 0,
-            nivel_atingido     INTEGER NOT NULL DEFAULT 0,
-            ultima_interacao   DATE,                                
-            inserido_em        TIMESTAMPTZ NOT NULL DEFAULT NOW(),    -- quando o usuário foi inserido
-            atualizado_em      TIMESTAMPTZ NOT NULL DEFAULT NOW(),     -- quando qualquer coluna for atualizada
-            display_choice     VARCHAR(20) NOT NULL DEFAULT 'indefinido',
-            nickname           VARCHAR(50) NOT NULL DEFAULT 'sem nick',
-            via_start          BOOLEAN NOT NULL DEFAULT FALSE
-        );
-
-       CREATE TABLE IF NOT EXISTS historico_pontos (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT REFERENCES usuarios(user_id),
-            pontos INTEGER NOT NULL,
-            motivo TEXT NOT NULL DEFAULT 'Não Especificado',
-            data TIMESTAMPTZ  DEFAULT CURRENT_TIMESTAMP
-        );
-
-       CREATE TABLE IF NOT EXISTS config_checkin (  
-            chave TEXT PRIMARY KEY,  -- chave é adicionar pontos por checkin
-            valor TEXT NOT NULL   -- valor é true para pontuar por checkin e false pra nao pontuar
-        );
-
-       -- Cria tabela que registra o envio para carteira (sem alterar usuarios):
-       CREATE TABLE IF NOT EXISTS envios_carteira (
-            user_id      BIGINT PRIMARY KEY,
-            enviado_em   TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-
-       -- Cria tabela de carteiras
-       CREATE TABLE IF NOT EXISTS wallet (
-            user_id    BIGINT PRIMARY KEY,
-            username   TEXT NOT NULL DEFAULT 'vazio',
-            first_name TEXT NOT NULL DEFAULT 'vazio',
-            last_name  TEXT NOT NULL DEFAULT 'vazio',
-            saldo      numeric(12,2) NOT NULL DEFAULT 0,
-            atualizado TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-
-
-       CREATE TABLE IF NOT EXISTS admins (
-            user_id BIGINT PRIMARY KEY
-        );
-
-       CREATE TABLE IF NOT EXISTS wallet_historico_user (
-            id          SERIAL PRIMARY KEY,
-            user_id     BIGINT NOT NULL,
-            valor       INTEGER NOT NULL,
-            tipo        TEXT NOT NULL CHECK (tipo IN ('credito', 'debito')),
-            descricao   TEXT NOT NULL,
-            criado_em   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-
-            -- duplicação leve de nome pra exibir no admin se quiser
-            username    TEXT NOT NULL DEFAULT 'vazio',
-            first_name  TEXT NOT NULL DEFAULT 'vazio',
-            last_name   TEXT NOT NULL DEFAULT 'vazio'
-        );
-
-       -- tabela de canais para uso em sorteio_config
-       CREATE TABLE IF NOT EXISTS canais (
-            id   BIGINT PRIMARY KEY,
-            nome TEXT
-        );
-
-       CREATE TABLE IF NOT EXISTS ganhadores_bloqueados (
-            user_id BIGINT PRIMARY KEY,
-            bloqueado_em TIMESTAMP DEFAULT NOW()
-        );
-
-       CREATE TABLE IF NOT EXISTS movimentacoes_globais (
-            id             SERIAL PRIMARY KEY,
-            usuario_id     BIGINT       NOT NULL,
-            nome_usuario   TEXT         NOT NULL  DEFAULT 'vazio',
-            evento         TEXT         NOT NULL,
-            detalhes       JSONB        NOT NULL DEFAULT '{}' ,
-            criado_em      TIMESTAMPTZ  NOT NULL DEFAULT NOW()
-        );
-
-       CREATE TABLE IF NOT EXISTS fila_pagamento (
-            id          SERIAL PRIMARY KEY,
-            user_id     BIGINT    NOT NULL,
-            code        TEXT      NOT NULL,
-            created_em  TIMESTAMPTZ NOT NULL DEFAULT NOW()
-        );
-
-       CREATE TABLE IF NOT EXISTS sorteio_config (
-            id                          SERIAL PRIMARY KEY,
-            canal_id                    BIGINT REFERENCES canais(id) ON DELETE SET NULL,
-            criado_em                   TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-            ativo                       BOOLEAN    NOT NULL DEFAULT TRUE,
-
-            total_montante              NUMERIC    NOT NULL,
-            valor_premio                NUMERIC    NOT NULL,
-            premios_iniciais            INT        NOT NULL,
-            premios_restantes           INT        NOT NULL,
-
-            total_participantes_esperados INT     NOT NULL,  -- Nº base de participantes
-            tentativas_por_usuario        INT     NOT NULL DEFAULT 3,  -- Nº de tentativas antes do cooldown
-            cooldown_minutos              INT     NOT NULL DEFAULT 5,  -- Minutos de espera após esgotar
-            tentativa_atual               INT     NOT NULL DEFAULT 0,  -- Contador de tentativas no evento
-            numero_esperado_atual         INT     NOT NULL        -- Número que o usuário deve acertar
-        );
-
-       CREATE TABLE IF NOT EXISTS sorteio_tentativas (
-            event_id INT NOT NULL REFERENCES sorteio_config(id) ON DELETE CASCADE,
-            user_id BIGINT NOT NULL,
-            tentado_em TIMESTAMPTZ DEFAULT NOW(),
-            PRIMARY KEY (event_id, user_id, tentado_em)
-        );
-
-       CREATE TABLE IF NOT EXISTS sorteio_ganhadores (
-            event_id INT NOT NULL REFERENCES sorteio_config(id) ON DELETE CASCADE,
-            user_id BIGINT NOT NULL,
-            ganho_em TIMESTAMPTZ DEFAULT NOW(),
-            PRIMARY KEY (event_id, user_id)
-        );
-
-       CREATE TABLE IF NOT EXISTS usuario_history (
-            id           SERIAL    PRIMARY KEY,
-            user_id      BIGINT    NOT NULL REFERENCES usuarios(user_id) ON DELETE CASCADE,
-            status       TEXT      NOT NULL,         -- 'Inserido' ou 'Atualizado'
-            username     TEXT      NOT NULL DEFAULT 'vazio',
-            first_name   TEXT      NOT NULL DEFAULT 'vazio',
-            last_name    TEXT      NOT NULL DEFAULT 'vazio',
-            inserido_em  TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
-            display_choice  VARCHAR(20) NOT NULL DEFAULT 'indefinido',
-            nickname        VARCHAR(50) NOT NULL DEFAULT 'sem nick',
-            via_start          BOOLEAN NOT NULL DEFAULT FALSE
-        );
-        """)
+        for tabela in TABELAS_PARTICIONADAS:
+            for mes in (mes_atual, proximo_mes):
+                try:
+                    movidas = await conn.fetchval("SELECT criar_particao_mensal($1, $2)", tabela, mes)
+                except Exception:
+                    # segue para as outras: uma tabela com problema não segura as demais
+                    logger.exception(
+                        f"[particoes] Falha ao criar a partição de {tabela} para {mes:%m/%Y}; "
+                        f"confira as linhas desse mês em {tabela}_padrao"
+                    )
+                    continue
+                if movidas:
+                    logger.warning(
+                        f"[particoes] {movidas} linhas de {mes:%m/%Y} estavam em {tabela}_padrao "
+                        f"e foram movidas para a partição do mês"
+                    )
+
+
+# --- Paginação por cursor (keyset) ---
+# As listagens paginadas não usam OFFSET: o botão carrega no callback_data a chave
+# de ordenação da última (ou primeira) linha exibida e a consulta seguinte parte dela
+# pelo índice. 'p' = próxima página (após o cursor), 'a' = anterior (antes do cursor).
+EPOCA = datetime(1970, 1, 1, tzinfo=ZoneInfo("UTC"))
+CONTAGEM_CACHE_TTL = 120          # segundos
+CONTAGEM_EXATA_ATE = 10_000       # abaixo disso, COUNT(*) é barato e mais preciso
+
+contagens_cache = CacheTTL(max_itens=256, ttl=CONTAGEM_CACHE_TTL)
+
+
+def ts_para_cursor(dt: datetime) -> int:
+    """Converte um timestamptz em microssegundos desde a época (cabe no callback_data)."""
+    return (dt - EPOCA) // timedelta(microseconds=1)
+
+
+def cursor_para_ts(micros: int) -> datetime:
+    return EPOCA + timedelta(microseconds=micros)
+
+
+async def contagem_cacheada(chave: str, sql: str, *args) -> int:
+    """Executa um COUNT filtrado no máximo uma vez a cada CONTAGEM_CACHE_TTL segundos."""
+    total = contagens_cache.obter(chave)
+    if total is None:
+        total = await pool.fetchval(sql, *args)
+        contagens_cache.definir(chave, total)
+    return total
+
+
+async def contagem_aproximada(tabela: str) -> int:
+    """
+    Total aproximado de linhas a partir das estatísticas do catálogo (pg_class.reltuples).
+    Tabelas pequenas ou nunca analisadas caem num COUNT(*) exato, também cacheado.
+    """
+    estimativa = await pool.fetchval(
+        "SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass($1)",
+        tabela
+    )
+    if estimativa is not None and estimativa >= CONTAGEM_EXATA_ATE:
+        return estimativa
+    return await contagem_cacheada(f"count:{tabela}", f"SELECT COUNT(*) FROM {tabela}")
 
 
 # --- Helpers de usuário (asyncpg) ---
@@ -245,6 +1103,45 @@ PAGE_SIZE = 16
 MAX_MESSAGE_LENGTH = 4000
 
 
+SQL_UPSERT_USUARIO = consultas.registrar("upsert_usuario", """
+WITH salvo AS (
+    INSERT INTO usuarios
+        (user_id, username, first_name, last_name,
+         display_choice, nickname,
+         inserido_em, ultima_interacao, pontos, via_start)
+    VALUES ($1, $2, $3, $4, $5, $6, NOW(), NULL, 0, $7)
+    ON CONFLICT (user_id) DO UPDATE
+       SET username       = EXCLUDED.username,
+           first_name     = EXCLUDED.first_name,
+           last_name      = EXCLUDED.last_name,
+           display_choice = EXCLUDED.display_choice,
+           nickname       = EXCLUDED.nickname,
+           atualizado_em  = NOW()
+     -- perfil igual: nada é escrito
+     WHERE (usuarios.username, usuarios.first_name, usuarios.last_name,
+            usuarios.display_choice, usuarios.nickname)
+           IS DISTINCT FROM
+           (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name,
+            EXCLUDED.display_choice, EXCLUDED.nickname)
+    RETURNING usuarios.*,
+              CASE WHEN xmax = 0 THEN 'Inserido' ELSE 'Atualizado' END AS status
+),
+hist AS (
+    INSERT INTO usuario_history
+        (user_id, status, username, first_name, last_name, display_choice, nickname, via_start)
+    SELECT user_id, status, username, first_name, last_name, display_choice, nickname,
+           status = 'Inserido' AND via_start
+      FROM salvo
+)
+SELECT * FROM salvo
+UNION ALL
+SELECT u.*, NULL
+  FROM usuarios u
+ WHERE u.user_id = $1
+   AND NOT EXISTS (SELECT 1 FROM salvo)
+""")
+
+
 async def adicionar_usuario_db(
         user_id: int,
         username: str = "vazio",
@@ -254,82 +1151,43 @@ async def adicionar_usuario_db(
         nickname: str = "sem nick",
         via_start: bool = False,
         pool_override: asyncpg.Pool | None = None,
-):
-    pg = pool_override or pool
-    async with pg.acquire() as conn:
-        async with conn.transaction():
-            old = await conn.fetchrow(
-                """
-                SELECT username, first_name, last_name,
-                       display_choice, nickname, ultima_interacao
-                  FROM usuarios
-                 WHERE user_id = $1::bigint
-                """,
-                user_id
-            )
-
-            if old:
-                # Verifica o que mudou
-                mudou_username = old['username'] != username
-                mudou_firstname = old['first_name'] != first_name
-                mudou_lastname = old['last_name'] != last_name
-                mudou_display_choice = old['display_choice'] != display_choice
-                mudou_nickname = old['nickname'] != nickname
-
-                if mudou_username or mudou_firstname or mudou_lastname or mudou_display_choice or mudou_nickname:
-                    logger.info(
-                        f"[DB] {user_id} Atualizado: username: {username} "
-                        f"firstname: {first_name} lastname: {last_name} "
-                        f"dischoice: {display_choice} nickname: {nickname}"
-                    )
-                    await conn.execute(
-                        """
-                        UPDATE usuarios
-                           SET username      = $1,
-                               first_name    = $2,
-                               last_name     = $3,
-                               display_choice     = $4,
-                               nickname      = $5,
-                               atualizado_em = NOW()
-                         WHERE user_id      = $6::bigint
-                        """,
-                        username, first_name, last_name, display_choice, nickname, user_id
-                    )
-
-                    await conn.execute(
-                        """
-                        INSERT INTO usuario_history
-                          (user_id, status, username, first_name, last_name, display_choice, nickname)
-                        VALUES ($1::bigint, 'Atualizado', $2, $3, $4, $5, $6)
-                        """,
-                        user_id, username, first_name, last_name, display_choice, nickname
-                    )
-            else:
-                logger.info(
-                    f"[DB] {user_id} Inserido: via_start={via_start}, username: {username} "
-                    f"firstname: {first_name} lastname: {last_name} "
-                    f"display_choice: {display_choice} nickname: {nickname}"
-                )
-                await conn.execute(
-                    """
-                    INSERT INTO usuarios
-                      (user_id, username, first_name, last_name,
-                       display_choice, nickname,
-                       inserido_em, ultima_interacao, pontos, via_start)
-                    VALUES ($1, $2, $3, $4, $5, $6, NOW(), NULL, 0, $7)
-                    """,
-                    user_id, username, first_name, last_name,
-                    display_choice, nickname, via_start
-                )
-
-                await conn.execute(
-                    """
-                    INSERT INTO usuario_history
-                      (user_id, status, username, first_name, last_name, display_choice, nickname, via_start)
-                    VALUES ($1::bigint, 'Inserido', $2, $3, $4, $5, $6, $7)
-                    """,
-                    user_id, username, first_name, last_name, display_choice, nickname, via_start
-                )
+) -> asyncpg.Record:
+    """
+    Insere ou atualiza o usuário numa única ida ao banco e devolve a linha de
+    `usuarios` resultante. O histórico só é gravado quando algo mudou; a coluna
+    extra `status` vem como 'Inserido', 'Atualizado' ou None (sem alteração).
+    """
+    args = (user_id, username, first_name, last_name, display_choice, nickname, via_start)
+    if pool_override is not None:
+        linha = await pool_override.fetchrow(SQL_UPSERT_USUARIO, *args)
+    else:
+        linha = await consultas.fetchrow("upsert_usuario", *args)
+
+    if linha is None:
+        # Corrida com o primeiro upsert do mesmo usuário: o ON CONFLICT esperou o
+        # outro commit, achou o perfil igual e não escreveu nada, mas o SELECT de
+        # reserva roda com o snapshot de antes desse commit. Um novo comando já vê
+        # a linha (sem a coluna `status`: nada mudou).
+        logger.info(f"[DB] {user_id} inserido por upsert concorrente; relendo a linha")
+        if pool_override is not None:
+            return await pool_override.fetchrow(consultas.sql["usuario_por_id"], user_id)
+        return await consultas.fetchrow("usuario_por_id", user_id)
+
+    if linha["status"] == "Inserido":
+        logger.info(
+            f"[DB] {user_id} Inserido: via_start={via_start}, username: {username} "
+            f"firstname: {first_name} lastname: {last_name} "
+            f"display_choice: {display_choice} nickname: {nickname}"
+        )
+        registrar_pontos(user_id, linha["pontos"], linha)
+    elif linha["status"] == "Atualizado":
+        logger.info(
+            f"[DB] {user_id} Atualizado: username: {username} "
+            f"firstname: {first_name} lastname: {last_name} "
+            f"dischoice: {display_choice} nickname: {nickname}"
+        )
+        placar_top.atualizar_perfil(linha)
+    return linha
 
 
 async def obter_ou_criar_usuario_db(
@@ -339,13 +1197,13 @@ async def obter_ou_criar_usuario_db(
         last_name: str = "vazio",
         via_start: bool = False
 ):
-    perfil = await pool.fetchrow("SELECT * FROM usuarios WHERE user_id = $1", user_id)
+    perfil = await consultas.fetchrow("usuario_por_id", user_id)
 
     if perfil:
         return perfil  # Já existe, retorna
 
-    # Não existe: chama a função que já trata de inserir
-    await adicionar_usuario_db(
+    # Não existe: chama a função que já trata de inserir (e devolve a linha)
+    return await adicionar_usuario_db(
         user_id=user_id,
         username=username,
         first_name=first_name,
@@ -353,22 +1211,138 @@ async def obter_ou_criar_usuario_db(
         via_start=via_start
     )
 
-    # Agora busca de novo e retorna
-    perfil = await pool.fetchrow("SELECT * FROM usuarios WHERE user_id = $1", user_id)
-    return perfil
+
+class PerfilRequisicao:
+    """
+    Linha de `usuarios` do autor do update, lida no máximo uma vez por handler.
+    Escritas que devolvem a linha (RETURNING) a repassam via `atualizar`,
+    então as leituras seguintes não vão ao banco.
+    """
+
+    def __init__(self, user: User):
+        self.user = user
+        self._linha: asyncpg.Record | None = None
+        self._carregado = False
+
+    async def obter(self) -> asyncpg.Record | None:
+        if not self._carregado:
+            self._linha = await consultas.fetchrow("usuario_por_id", self.user.id)
+            self._carregado = True
+        return self._linha
+
+    async def obter_ou_criar(self, via_start: bool = False) -> asyncpg.Record:
+        linha = await self.obter()
+        if linha is None:
+            linha = await adicionar_usuario_db(
+                user_id=self.user.id,
+                username=self.user.username or "vazio",
+                first_name=self.user.first_name or "vazio",
+                last_name=self.user.last_name or "vazio",
+                via_start=via_start
+            )
+            self.atualizar(linha)
+        return linha
+
+    def atualizar(self, linha: asyncpg.Record | None):
+        if linha is not None:
+            self._linha = linha
+            self._carregado = True
+
+
+consultas.registrar("registrar_historico", """
+    INSERT INTO historico_pontos (user_id, pontos, motivo)
+    VALUES ($1, $2, $3)
+""")
 
 
 async def registrar_historico_db(user_id: int, pontos: int, motivo: str | None = None):
     """
     Insere um registro de pontos no histórico.
     """
-    await pool.execute(
-        """
-        INSERT INTO historico_pontos (user_id, pontos, motivo)
-        VALUES ($1, $2, $3)
-        """,
-        user_id, pontos, motivo
+    await consultas.execute("registrar_historico", user_id, pontos, motivo)
+
+
+# --- Cache da config_checkin ---
+# Carregado uma vez no startup; ativar/desativar publicam um NOTIFY e todos os
+# processos do bot recarregam a cópia local na hora.
+CANAL_NOTIFY_CONFIG = "config_checkin"
+config_cache: dict[str, str] = {}
+_conexao_config: asyncpg.Connection | None = None
+_reconexao_config: asyncio.Task | None = None
+
+
+async def carregar_config():
+    rows = await consultas.fetch("config_checkin")
+    config_cache.clear()
+    config_cache.update({r["chave"]: r["valor"] for r in rows})
+    logger.info(f"[config] Configuração carregada: {config_cache}")
+
+
+def obter_config(chave: str, padrao: str | None = None) -> str | None:
+    return config_cache.get(chave, padrao)
+
+
+consultas.registrar("salvar_config", """
+    WITH salvo AS (
+        INSERT INTO config_checkin (chave, valor) VALUES ($1, $2)
+        ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor
+        RETURNING chave
     )
+    SELECT pg_notify($3, chave) FROM salvo
+""")
+
+
+async def salvar_config(chave: str, valor: str):
+    """
+    Grava a chave e avisa (NOTIFY) os outros processos no mesmo statement.
+    """
+    await consultas.execute("salvar_config", chave, valor, CANAL_NOTIFY_CONFIG)
+    config_cache[chave] = valor
+
+
+def _ao_notificar_config(conn, pid, canal, chave):
+    logger.info(f"[config] NOTIFY recebido (pid={pid}) para chave '{chave}'")
+    disparar_tarefa(carregar_config(), "config")
+
+
+def _ao_perder_conexao_config(conn):
+    global _reconexao_config
+    if _reconexao_config is not None and not _reconexao_config.done():
+        return  # já tem uma reconexão em andamento
+    logger.warning("[config] Conexão do LISTEN perdida, reconectando...")
+    _reconexao_config = disparar_tarefa(_reconectar_config(), "config:reconectar")
+
+
+async def _reconectar_config():
+    while True:
+        await asyncio.sleep(5)
+        try:
+            await escutar_config()
+            await carregar_config()  # pode ter perdido algum NOTIFY
+        except Exception as e:
+            logger.error(f"[config] Falha ao reconectar o LISTEN: {e}")
+            continue
+        # se a conexão nova caiu enquanto esta tarefa rodava, o aviso foi ignorado
+        if not _conexao_config.is_closed():
+            return
+
+
+async def escutar_config():
+    global _conexao_config
+    _conexao_config = await asyncpg.connect(dsn=DATABASE_URL)
+    await _conexao_config.add_listener(CANAL_NOTIFY_CONFIG, _ao_notificar_config)
+    _conexao_config.add_termination_listener(_ao_perder_conexao_config)
+
+
+async def parar_escuta_config():
+    global _conexao_config
+    if _reconexao_config is not None:
+        _reconexao_config.cancel()
+    if _conexao_config is None:
+        return
+    _conexao_config.remove_termination_listener(_ao_perder_conexao_config)
+    await _conexao_config.close()
+    _conexao_config = None
 
 
 def escape_markdown_v2(text: str) -> str:
@@ -379,20 +1353,175 @@ def escape_markdown_v2(text: str) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
-async def verificar_canal(user_id: int, bot: Bot) -> tuple[bool, str]:
+# --- Paginação de mensagens longas ---
+# O texto já renderizado (e escapado) é quebrado em páginas só entre linhas, então
+# nenhuma formatação é cortada no meio. As páginas ficam em cache e os botões
+# "pg:<token>:<n>" só trocam o texto da mensagem, sem refazer a consulta.
+MAX_ENTIDADES = 100          # limite de entidades de formatação por mensagem
+PAGINAS_CACHE_TTL = 30 * 60  # segundos
+RESERVA_RODAPE = 40          # espaço para o "📄 Página x/y"
+
+paginas_cache = CacheTTL(max_itens=500, ttl=PAGINAS_CACHE_TTL)
+
+_RE_ENTIDADE_HTML = re.compile(r"<(?!/)[a-z]")
+_RE_ENTIDADE_MD = re.compile(r"(?<!\\)(\|\||[*_`~\[])")
+
+
+def tamanho_telegram(texto: str) -> int:
+    """O Telegram mede mensagens em unidades UTF-16 (emojis contam 2)."""
+    return len(texto.encode("utf-16-le")) // 2
+
+
+def contar_entidades(texto: str, parse_mode: str | None) -> int:
+    if parse_mode == ParseMode.HTML:
+        return len(_RE_ENTIDADE_HTML.findall(texto))
+    if parse_mode == ParseMode.MARKDOWN_V2:
+        marcadores = _RE_ENTIDADE_MD.findall(texto)
+        # cada entidade abre e fecha com o mesmo marcador; "[" já conta como uma
+        return sum(1 for m in marcadores if m == "[") + sum(1 for m in marcadores if m != "[") // 2
+    return 0
+
+
+def paginar(linhas: list[str], cabecalho: str = "", parse_mode: str | None = None) -> list[str]:
+    """Agrupa as linhas em páginas dentro dos limites de tamanho e de entidades."""
+    limite = MAX_MESSAGE_LENGTH - RESERVA_RODAPE
+    base_tamanho = tamanho_telegram(cabecalho)
+    base_entidades = contar_entidades(cabecalho, parse_mode)
+
+    paginas, atual = [], []
+    tamanho, entidades = base_tamanho, base_entidades
+    for linha in linhas:
+        t = tamanho_telegram(linha) + 1  # +1 do "\n"
+        e = contar_entidades(linha, parse_mode)
+        if atual and (tamanho + t > limite or entidades + e > MAX_ENTIDADES):
+            paginas.append(atual)
+            atual, tamanho, entidades = [], base_tamanho, base_entidades
+        # uma linha sozinha maior que o limite vai numa página própria
+        atual.append(linha)
+        tamanho += t
+        entidades += e
+    if atual or not paginas:
+        paginas.append(atual)
+
+    return [(cabecalho + "\n".join(p)) for p in paginas]
+
+
+def _teclado_paginas(token: str | None, n: int, total: int, botoes_extra: list | None):
+    linhas = []
+    if token and total > 1:
+        nav = []
+        if n > 0:
+            nav.append(InlineKeyboardButton("⬅️", callback_data=f"pg:{token}:{n - 1}"))
+        nav.append(InlineKeyboardButton(f"{n + 1}/{total}", callback_data=f"pg:{token}:{n}"))
+        if n < total - 1:
+            nav.append(InlineKeyboardButton("➡️", callback_data=f"pg:{token}:{n + 1}"))
+        linhas.append(nav)
+    if botoes_extra:
+        linhas.append(botoes_extra)
+    return InlineKeyboardMarkup(linhas) if linhas else None
+
+
+def _com_rodape(pagina: str, n: int, total: int, parse_mode: str | None) -> str:
+    if total <= 1:
+        return pagina
+    rodape = f"📄 Página {n + 1}/{total}"
+    if parse_mode == ParseMode.MARKDOWN_V2:
+        rodape = escape_markdown_v2(rodape)
+    return f"{pagina}\n\n{rodape}"
+
+
+async def enviar_paginas(update: Update, paginas: list[str], parse_mode: str | None = None,
+                         botoes_extra: list | None = None, editar: bool = False):
+    """
+    Envia (ou edita, se `editar`) a 1ª página; as demais ficam em cache para o
+    callback "pg:". `botoes_extra` é uma linha de botões repetida em todas as páginas.
+    """
+    token = None
+    if len(paginas) > 1:
+        token = secrets.token_urlsafe(6)
+        paginas_cache.definir(token, (paginas, parse_mode, botoes_extra))
+
+    texto = _com_rodape(paginas[0], 0, len(paginas), parse_mode)
+    markup = _teclado_paginas(token, 0, len(paginas), botoes_extra)
+    if editar:
+        await update.callback_query.edit_message_text(texto, parse_mode=parse_mode, reply_markup=markup)
+    else:
+        await update.message.reply_text(texto, parse_mode=parse_mode, reply_markup=markup)
+
+
+async def callback_pagina(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    if query.from_user.id not in ADMINS:
+        return await query.answer()
+    _, token, n = query.data.split(":")
+    guardado = paginas_cache.obter(token)
+    if guardado is None:
+        await query.answer("⌛ Essa lista expirou. Rode o comando de novo.", show_alert=True)
+        return
+    await query.answer()
+
+    paginas, parse_mode, botoes_extra = guardado
+    n = min(int(n), len(paginas) - 1)
     try:
-        membro = await bot.get_chat_member(chat_id="@cupomnavitrine", user_id=user_id)
-        if membro.status not in ("member", "administrator", "creator"):
+        await query.edit_message_text(
+            _com_rodape(paginas[n], n, len(paginas), parse_mode),
+            parse_mode=parse_mode,
+            reply_markup=_teclado_paginas(token, n, len(paginas), botoes_extra)
+        )
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():  # clique na página atual
+            raise
+
+
+# --- Cache de inscrição no canal ---
+# Positivos e negativos têm TTLs diferentes; o ChatMemberHandler do canal
+# atualiza a entrada na hora em que o usuário entra ou sai.
+CANAL_USERNAME = "@cupomnavitrine"
+STATUS_INSCRITO = ("member", "administrator", "creator")
+INSCRITO_CACHE_TTL = 30 * 60  # segundos
+NAO_INSCRITO_CACHE_TTL = 60  # segundos
+
+inscricoes_canal = CacheTTL(50000, INSCRITO_CACHE_TTL)
+
+
+def lembrar_inscricao(user_id: int, inscrito: bool):
+    inscricoes_canal.definir(user_id, inscrito, None if inscrito else NAO_INSCRITO_CACHE_TTL)
+
+
+async def verificar_canal(user_id: int, bot: Bot) -> tuple[bool, str]:
+    inscrito = inscricoes_canal.obter(user_id)
+    if inscrito is None:
+        try:
+            membro = await bot.get_chat_member(chat_id=CANAL_USERNAME, user_id=user_id)
+        except:
             return False, (
-                "🚫 Para usar esse recurso, você precisa estar inscrito no canal @cupomnavitrine.\n"
-                "👉 Acesse: https://t.me/cupomnavitrine"
+                "🚫 Não foi possível verificar sua inscrição no canal.\n"
+                "Tente novamente mais tarde."
             )
-        return True, ""
-    except:
+        inscrito = membro.status in STATUS_INSCRITO
+        lembrar_inscricao(user_id, inscrito)
+
+    if not inscrito:
         return False, (
-            "🚫 Não foi possível verificar sua inscrição no canal.\n"
-            "Tente novamente mais tarde."
+            "🚫 Para usar esse recurso, você precisa estar inscrito no canal @cupomnavitrine.\n"
+            "👉 Acesse: https://t.me/cupomnavitrine"
         )
+    return True, ""
+
+
+async def atualizar_inscricao_canal(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Recebe entradas/saídas do canal (o bot precisa ser admin dele) e
+    atualiza o cache de inscrição.
+    """
+    alteracao = update.chat_member
+    if (alteracao.chat.username or "").lower() != CANAL_USERNAME.lstrip("@").lower():
+        return
+
+    novo = alteracao.new_chat_member
+    inscrito = novo.status in STATUS_INSCRITO
+    lembrar_inscricao(novo.user.id, inscrito)
+    logger.info(f"[canal] user_id={novo.user.id} status={novo.status} inscrito={inscrito}")
 
 
 async def setup_commands(app):
@@ -472,17 +1601,22 @@ ADMIN_MENU = (
     "/pay – pagar compra\n"
     "/limpar_fila – limpar pedidos na fila\n"
     "/historico_usuario – historico de nomes de usuario\n"
+    "/buscar – busca aproximada por nome/nickname\n"
     "/rem – remover admin\n"
     "/listar_usuarios – lista de usuarios cadastrados\n"
+    "/importar_usuarios – importar usuarios em massa (CSV/JSON)\n"
     "/estatisticas – quantidade total cadastrados\n"
     "/listar_via_start – que se cadastraram via start\n"
     "/checkin_on – ativa pontos no checkin\n"
     "/checkin_off – desativa pontos no checkin\n"
+    "/campanha – definir período do ranking de campanha\n"
     "/configurar_sort – configurar novo sorteio\n"
     "/sort_status – ver status do sorteio\n"
     "/cancelar_sort – cancelar sorteio\n"
     "/list_ganhadores_sort – listar ganhadores atuais\n"
-    "/backup – Fazer backup\n")
+    "/backup – Fazer backup\n"
+    "/exportar – exportar tabela em CSV (gzip)\n"
+    "/consultas – estatísticas das consultas SQL\n")
 
 
 # Comando de admin
@@ -550,7 +1684,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username or "vazio"
     first_name = user.first_name or "vazio"
-    last_name = user.last_name or "vazio"
 
     logger.info(f"[start] Início para user_id={user_id}, username={username}, first_name={first_name}")
 
@@ -562,25 +1695,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Checa valor da configuração 'adicionar_pontos'
-    config_checkin = await pool.fetchrow("SELECT valor FROM config_checkin WHERE chave = 'adicionar_pontos'")
+    config_checkin = obter_config("adicionar_pontos")
     if config_checkin:
-        logger.info(f"[start] Config_checkin 'adicionar_pontos' = {config_checkin['valor']}")
+        logger.info(f"[start] Config_checkin 'adicionar_pontos' = {config_checkin}")
     else:
         logger.warning("[start] Config_checkin 'adicionar_pontos' não encontrada")
 
     # 1) Verifica se já existe registro; só insere uma vez
-    perfil = await obter_ou_criar_usuario_db(
-        user_id=user_id,
-        username=username,
-        first_name=first_name,
-        last_name=last_name,
-        via_start=True
-    )
+    perfil_req = PerfilRequisicao(user)
+    perfil = await perfil_req.obter_ou_criar(via_start=True)
     logger.info(f"[start] Perfil obtido/criado: {perfil}")
 
     await processar_presenca_diaria(
         perfil=perfil,  # passa o perfil direto
-        bot=context.bot
+        bot=context.bot,
+        perfil_req=perfil_req
     )
 
     # Pergunta como ele quer aparecer
@@ -669,16 +1798,20 @@ async def receber_nickname(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
-async def perfil_invalido_ou_nao_inscrito(user_id: int, bot: Bot) -> tuple[bool, str]:
+async def perfil_invalido_ou_nao_inscrito(
+        user_id: int,
+        bot: Bot,
+        perfil_req: PerfilRequisicao | None = None
+) -> tuple[bool, str]:
     # 1️⃣ Verifica se está no canal, usando o méto do já pronto
     ok, msg = await verificar_canal(user_id, bot)
     if not ok:
         return True, msg
 
-    perfil = await pool.fetchrow(
-        "SELECT display_choice, first_name, username, nickname FROM usuarios WHERE user_id = $1",
-        user_id
-    )
+    if perfil_req is not None:
+        perfil = await perfil_req.obter()
+    else:
+        perfil = await consultas.fetchrow("usuario_por_id", user_id)
 
     if not perfil or perfil["display_choice"] == "indefinido":
         return True, (
@@ -691,22 +1824,59 @@ async def perfil_invalido_ou_nao_inscrito(user_id: int, bot: Bot) -> tuple[bool,
 USUARIOS_POR_PAGINA = 20
 
 
-async def listar_via_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def listar_via_start(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                           cursor: tuple[str, int, int] | None = None):
+    """
+    Lista quem entrou via /start, por ordem de chegada. A navegação usa o cursor
+    (inserido_em, user_id) vindo do botão; /listar_via_start <página> salta direto
+    para a página pedida (único caso que ainda usa OFFSET).
+    """
     page = int(context.args[0]) if context.args and context.args[0].isdigit() else 1
+    page = max(page, 1)
     offset = (page - 1) * USUARIOS_POR_PAGINA
 
     try:
-        total = await pool.fetchval("SELECT COUNT(*) FROM usuarios WHERE via_start = TRUE")
-        usuarios = await pool.fetch(
-            """
-            SELECT user_id, username, first_name, last_name, inserido_em
-              FROM usuarios
-             WHERE via_start = TRUE
-             ORDER BY inserido_em ASC
-             LIMIT $1 OFFSET $2
-            """,
-            USUARIOS_POR_PAGINA, offset
+        total = await contagem_cacheada(
+            "count:via_start", "SELECT COUNT(*) FROM usuarios WHERE via_start = TRUE"
         )
+        colunas = "SELECT user_id, username, first_name, last_name, inserido_em FROM usuarios"
+        if cursor is None:
+            usuarios = await pool.fetch(
+                f"""
+                {colunas}
+                 WHERE via_start = TRUE
+                 ORDER BY inserido_em ASC, user_id ASC
+                 LIMIT $1 OFFSET $2
+                """,
+                USUARIOS_POR_PAGINA + 1, offset
+            )
+        elif cursor[0] == "p":
+            usuarios = await pool.fetch(
+                f"""
+                {colunas}
+                 WHERE via_start = TRUE
+                   AND (inserido_em, user_id) > ($1, $2)
+                 ORDER BY inserido_em ASC, user_id ASC
+                 LIMIT $3
+                """,
+                cursor_para_ts(cursor[1]), cursor[2], USUARIOS_POR_PAGINA + 1
+            )
+        else:
+            usuarios = await pool.fetch(
+                f"""
+                {colunas}
+                 WHERE via_start = TRUE
+                   AND (inserido_em, user_id) < ($1, $2)
+                 ORDER BY inserido_em DESC, user_id DESC
+                 LIMIT $3
+                """,
+                cursor_para_ts(cursor[1]), cursor[2], USUARIOS_POR_PAGINA
+            )
+            usuarios = list(reversed(usuarios))
+
+        # Voltando uma página, sabemos que existe a seguinte (viemos dela)
+        tem_proxima = len(usuarios) > USUARIOS_POR_PAGINA or (cursor is not None and cursor[0] == "a")
+        usuarios = usuarios[:USUARIOS_POR_PAGINA]
 
         if not usuarios:
             await update.message.reply_text("Nenhum usuário encontrado nesta página.")
@@ -717,21 +1887,29 @@ async def listar_via_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             nome = u["first_name"] or ""
             sobrenome = u["last_name"] or ""
             username = f"@{u['username']}" if u["username"] != "vazio" else "nao tem"
-            inserido_em = u["inserido_em"]
             data_registro = format_dt_sp(u["inserido_em"], "%d/%m/%Y %H:%M:%S")
 
             linhas.append(
                 f"• Data: {data_registro} ID: `{u['user_id']}` Nome: {nome}  Sobrenome: {sobrenome} Username: {username}".strip()
             )
         texto = "*Usuários que entraram via /start:*\n\n" + "\n".join(linhas)
-        texto += f"\n\nPágina {page} de {((total - 1) // USUARIOS_POR_PAGINA) + 1}"
+        texto += f"\n\nPágina {page} de {max(1, ((total - 1) // USUARIOS_POR_PAGINA) + 1)}"
 
-        # Botões de paginação
+        # Botões de paginação: o cursor é a chave da primeira/última linha exibida
+        primeiro, ultimo = usuarios[0], usuarios[-1]
         botoes = []
         if page > 1:
-            botoes.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"via_start:{page - 1}"))
-        if offset + USUARIOS_POR_PAGINA < total:
-            botoes.append(InlineKeyboardButton("Próxima ➡️", callback_data=f"via_start:{page + 1}"))
+            botoes.append(InlineKeyboardButton(
+                "⬅️ Anterior",
+                callback_data=f"via_start:{page - 1}:a:"
+                              f"{ts_para_cursor(primeiro['inserido_em'])}:{primeiro['user_id']}"
+            ))
+        if tem_proxima:
+            botoes.append(InlineKeyboardButton(
+                "Próxima ➡️",
+                callback_data=f"via_start:{page + 1}:p:"
+                              f"{ts_para_cursor(ultimo['inserido_em'])}:{ultimo['user_id']}"
+            ))
 
         markup = InlineKeyboardMarkup([botoes]) if botoes else None
 
@@ -750,22 +1928,21 @@ async def paginacao_via_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not data.startswith("via_start:"):
         return
 
-    page = int(data.split(":")[1])
-    context.args = [str(page)]
+    # "via_start:<página>:<a|p>:<inserido_em em µs>:<user_id>"
+    _, page, direcao, micros, user_id = data.split(":")
+    context.args = [page]
     update.message = query.message
-    await listar_via_start(update, context)
+    await listar_via_start(update, context, cursor=(direcao, int(micros), int(user_id)))
 
 
 async def meus_pontos(update: Update, context: CallbackContext):
     user = update.effective_user
     user_id = user.id
-    username = user.username or ""
-    first_name = user.first_name or ""
-    last_name = user.last_name or ""
+    perfil_req = PerfilRequisicao(user)
 
     # Validação de canal se for no privado
     if update.effective_chat.type == "private":
-        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot)
+        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot, perfil_req)
         if invalido:
             await update.message.reply_text(msg)
             return
@@ -778,28 +1955,18 @@ async def meus_pontos(update: Update, context: CallbackContext):
 
     try:
         # 1) Processa presença diária (vai dar 1 ponto se ainda não pontuou hoje)
-        perfil = await obter_ou_criar_usuario_db(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
+        perfil = await perfil_req.obter_ou_criar()
 
-        await processar_presenca_diaria(perfil, context.bot)
+        await processar_presenca_diaria(perfil, context.bot, perfil_req)
 
-        # 2) Busca o perfil já com os pontos atualizados
-        perfil = await pool.fetchrow(
-            "SELECT pontos, nivel_atingido FROM usuarios WHERE user_id = $1",
-            user_id
-        )
+        # 2) Perfil já com os pontos atualizados (devolvido pelo check-in, sem nova leitura)
+        perfil = await perfil_req.obter()
         pontos = perfil['pontos']
         nivel = perfil['nivel_atingido']
 
         # Calcula a posição do usuário no ranking geral
-        posicao = await pool.fetchval(
-            "SELECT COUNT(*) + 1 FROM usuarios WHERE pontos > $1",
-            pontos
-        )
+        indice_ranking.atualizar(user_id, pontos)  # corrige se outro processo alterou
+        posicao = indice_ranking.posicao(pontos)
         await update.message.reply_text(
             f"🎉 Você tem {pontos} pontos.🏅 {posicao}º lugar."
         )
@@ -972,21 +2139,241 @@ async def del_pontos_quantidade(update: Update, context: ContextTypes.DEFAULT_TY
 #     return ConversationHandler.END
 
 
+# --- Cache de perfis do Telegram ---
+# Alimentado pelo effective_user de cada update; get_chat só em caso de miss,
+# e em segundo plano, para não segurar a atualização de pontos.
+PERFIL_CACHE_MAX = 20000
+PERFIL_CACHE_TTL = 6 * 60 * 60  # segundos
+
+perfis_telegram = CacheTTL(PERFIL_CACHE_MAX, PERFIL_CACHE_TTL)
+_buscas_perfil: dict[int, asyncio.Task] = {}  # uma busca por usuário de cada vez
+
+
+def lembrar_perfil(user: User):
+    perfis_telegram.definir(user.id, (
+        user.username or "vazio",
+        user.first_name or "vazio",
+        user.last_name or "vazio",
+    ))
+
+
+async def registrar_perfil_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if user is not None and not user.is_bot:
+        lembrar_perfil(user)
+
+
+consultas.registrar("completar_nome_usuario", """
+    WITH salvo AS (
+        UPDATE usuarios
+           SET username = $2, first_name = $3, last_name = $4, atualizado_em = NOW()
+         WHERE user_id = $1
+           AND username = 'vazio' AND first_name = 'vazio' AND last_name = 'vazio'
+           AND (username, first_name, last_name) IS DISTINCT FROM ($2, $3, $4)
+        RETURNING usuarios.*
+    ),
+    hist AS (
+        INSERT INTO usuario_history
+            (user_id, status, username, first_name, last_name, display_choice, nickname)
+        SELECT user_id, 'Atualizado', username, first_name, last_name, display_choice, nickname
+          FROM salvo
+    )
+    SELECT * FROM salvo
+""")
+
+
+async def _buscar_perfil_telegram(user_id: int, bot: Bot):
+    try:
+        chat = await bot.get_chat(user_id)
+    except Exception as e:
+        logger.info(f"[perfil] get_chat falhou para user_id={user_id}: {e}")
+        return
+
+    username = chat.username or "vazio"
+    first_name = chat.first_name or "vazio"
+    last_name = chat.last_name or "vazio"
+    perfis_telegram.definir(user_id, (username, first_name, last_name))
+
+    # Se o usuário acabou de ser criado só com os placeholders, completa o nome
+    linha = await consultas.fetchrow("completar_nome_usuario", user_id, username, first_name, last_name)
+    if linha is not None:
+        logger.info(
+            f"[perfil] {user_id} nome completado: username: {username} "
+            f"firstname: {first_name} lastname: {last_name}"
+        )
+        placar_top.atualizar_perfil(linha)
+
+
+def obter_perfil_telegram(user_id: int, bot: Bot | None) -> tuple[str, str, str]:
+    perfil = perfis_telegram.obter(user_id)
+    if perfil is not None:
+        return perfil
+
+    if bot is not None and user_id not in _buscas_perfil:
+        tarefa = disparar_tarefa(_buscar_perfil_telegram(user_id, bot), f"perfil:{user_id}")
+        _buscas_perfil[user_id] = tarefa
+        tarefa.add_done_callback(lambda _: _buscas_perfil.pop(user_id, None))
+    return "vazio", "vazio", "vazio"
+
+
+class IndiceRanking:
+    """
+    Pontos de todos os usuários num multiset ordenado em memória: a posição
+    no ranking sai de uma busca binária, sem COUNT(*) no banco.
+    """
+
+    def __init__(self):
+        self._pontos: dict[int, int] = {}
+        self._ordenados: list[int] = []
+        # atualizações que chegam enquanto a carga espera o banco; são mais novas
+        # que o snapshot e são reaplicadas por cima dele
+        self._durante_carga: dict[int, int] | None = None
+
+    async def carregar(self):
+        self._durante_carga = {}
+        try:
+            rows = await consultas.fetch("pontos_todos")
+        finally:
+            recentes, self._durante_carga = self._durante_carga, None
+        self._pontos = {r["user_id"]: r["pontos"] for r in rows}
+        self._pontos.update(recentes)
+        self._ordenados = sorted(self._pontos.values())
+        logger.info(f"[indice_ranking] {len(self._pontos)} usuários carregados")
+
+    def atualizar(self, user_id: int, pontos: int):
+        if self._durante_carga is not None:
+            self._durante_carga[user_id] = pontos
+        antigo = self._pontos.get(user_id)
+        if antigo == pontos:
+            return
+        if antigo is not None:
+            del self._ordenados[bisect_left(self._ordenados, antigo)]
+        insort(self._ordenados, pontos)
+        self._pontos[user_id] = pontos
+
+    def posicao(self, pontos: int) -> int:
+        """Equivale a SELECT COUNT(*) + 1 FROM usuarios WHERE pontos > $1."""
+        return len(self._ordenados) - bisect_right(self._ordenados, pontos) + 1
+
+
+indice_ranking = IndiceRanking()
+
+
+# --- Top do ranking geral em memória ---
+TOP_RANKING = 20
+TOP_RANKING_MARGEM = 30  # candidatos extras para absorver quem cai do top
+RANKING_RECONCILIAR_SEG = 5 * 60            # placar: uma consulta com LIMIT
+INDICE_RECONCILIAR_SEG = 6 * 60 * 60        # índice: relê todos os usuários
+CAMPOS_PLACAR = ("user_id", "username", "first_name", "display_choice", "nickname", "pontos")
+
+
+class PlacarTop:
+    """
+    Os `k + margem` maiores pontuadores, com os campos de exibição, mantidos em
+    memória. Invariante: ninguém fora do placar tem mais pontos que o menor de
+    dentro. Quando não dá para garantir isso sem o banco, marca para recarregar.
+    """
+
+    def __init__(self, k: int, margem: int):
+        self.k = k
+        self.capacidade = k + margem
+        self._linhas: dict[int, dict] = {}
+        self._todos = False  # o banco inteiro cabe no placar
+        self._recarregar = True
+        self._durante_carga: dict[int, tuple] | None = None  # como no IndiceRanking
+
+    async def carregar(self):
+        self._durante_carga = {}
+        try:
+            rows = await consultas.fetch("top_ranking", self.capacidade)
+        finally:
+            recentes, self._durante_carga = self._durante_carga, None
+        self._linhas = {r["user_id"]: {c: r[c] for c in CAMPOS_PLACAR} for r in rows}
+        self._todos = len(rows) < self.capacidade
+        self._recarregar = False
+        for user_id, (pontos, linha) in recentes.items():
+            self.atualizar_pontos(user_id, pontos, linha)
+
+    def _piso(self) -> int | None:
+        return min(l["pontos"] for l in self._linhas.values()) if self._linhas else None
+
+    def atualizar_pontos(self, user_id: int, pontos: int, linha: asyncpg.Record | dict | None = None):
+        if self._durante_carga is not None:
+            self._durante_carga[user_id] = (pontos, linha)
+        piso = self._piso()
+        atual = self._linhas.get(user_id)
+
+        if atual is not None:
+            if self._todos or piso is None or pontos >= piso:
+                atual["pontos"] = pontos
+            else:
+                # caiu abaixo do piso: pode haver alguém de fora na frente
+                del self._linhas[user_id]
+        elif self._todos or piso is None or pontos > piso:
+            if linha is None:
+                # entrou no top mas não temos os campos de exibição
+                self._recarregar = True
+                return
+            self._linhas[user_id] = {c: linha[c] for c in CAMPOS_PLACAR}
+            self._linhas[user_id]["pontos"] = pontos
+            while len(self._linhas) > self.capacidade:
+                menor = min(self._linhas.values(), key=lambda l: l["pontos"])
+                del self._linhas[menor["user_id"]]
+                self._todos = False
+
+        if len(self._linhas) < self.k and not self._todos:
+            self._recarregar = True
+
+    def atualizar_perfil(self, linha: asyncpg.Record | dict):
+        atual = self._linhas.get(linha["user_id"])
+        if atual is not None:
+            for campo in ("username", "first_name", "display_choice", "nickname"):
+                atual[campo] = linha[campo]
+
+    async def top(self) -> list[dict]:
+        if self._recarregar:
+            await self.carregar()
+        ordenados = sorted(self._linhas.values(), key=lambda l: (-l["pontos"], l["user_id"]))
+        return ordenados[:self.k]
+
+
+placar_top = PlacarTop(TOP_RANKING, TOP_RANKING_MARGEM)
+
+
+def registrar_pontos(user_id: int, pontos: int, linha: asyncpg.Record | dict | None = None):
+    """
+    Avisa as estruturas em memória de que os pontos do usuário mudaram.
+    `linha` (a linha de `usuarios`, se disponível) permite incluir o usuário
+    no placar sem reler o banco.
+    """
+    indice_ranking.atualizar(user_id, pontos)
+    placar_top.atualizar_pontos(user_id, pontos, linha)
+
+
+async def reconciliar_rankings():
+    """
+    Corrige no placar desvios causados por escritas de outros processos. O índice
+    é mantido incrementalmente e só é relido de INDICE_RECONCILIAR_SEG em
+    INDICE_RECONCILIAR_SEG (job próprio), pois a carga lê todos os usuários.
+    """
+    await placar_top.carregar()
+
+
+consultas.registrar("gravar_pontos", """
+    UPDATE usuarios
+       SET pontos = $1,
+           nivel_atingido = $2
+     WHERE user_id = $3::bigint
+""")
+
+
 async def atualizar_pontos(
         user_id: int,
         delta: int,
         motivo: str = None,
         bot: Bot = None
 ) -> int | None:
-    try:
-        chat = await bot.get_chat(user_id)
-        username = chat.username or "vazio"
-        first_name = chat.first_name or "vazio"
-        last_name = chat.last_name or "vazio"
-    except Exception:
-        username = "vazio"
-        first_name = "vazio"
-        last_name = "vazio"
+    username, first_name, last_name = obter_perfil_telegram(user_id, bot)
 
     usuario = await obter_ou_criar_usuario_db(
         user_id, username, first_name, last_name
@@ -1003,15 +2390,8 @@ async def atualizar_pontos(
 
     nivel = sum(1 for limiar in NIVEIS_BRINDES if novos >= limiar)
 
-    await pool.execute(
-        """
-        UPDATE usuarios
-           SET pontos = $1,
-               nivel_atingido = $2
-         WHERE user_id = $3::bigint
-        """,
-        novos, nivel, user_id
-    )
+    await consultas.execute("gravar_pontos", novos, nivel, user_id)
+    registrar_pontos(user_id, novos)
     logger.info(f"[atualizar_pontos] Pontos atualizados no banco para user_id={user_id}")
     return novos
 
@@ -1049,87 +2429,481 @@ async def atualizar_pontos(
 #     await update.message.reply_text("🗒️ Seu histórico de pontos:\n\n" + "\n\n".join(lines))
 #
 
+consultas.registrar("top_ranking", """
+    SELECT
+        user_id,
+        username,
+        first_name,
+        display_choice,
+        nickname,
+        pontos
+    FROM usuarios
+    ORDER BY pontos DESC
+    LIMIT $1
+""")
+
+
+MEDALHAS = ["🥇", "🥈", "🥉"] + ["🏅"] * 17
+
+
+def nome_no_ranking(u) -> str:
+    """Nome exibido nos rankings conforme o display_choice escolhido no /start (já escapado p/ HTML)."""
+    choice = u["display_choice"]
+    if choice == "first_name":
+        display = u["first_name"] or u["username"] or "Usuário"
+    elif choice in ("nickname", "anonymous"):
+        display = u["nickname"] or u["username"] or "Usuário"
+    elif choice == "indefinido":
+        display = "Esp. interação"
+    else:
+        display = u["username"] or u["first_name"] or "Usuário"
+    return html.escape(display)
+
+
 async def ranking_tops(update: Update, context: CallbackContext):
     user = update.effective_user
     user_id = user.id
-    username = user.username or ""
-    first_name = user.first_name or ""
-    last_name = user.last_name or ""
     chat_id = update.effective_chat.id
 
-    # 1) Presença diária unificada — agora com 5 args:
-    perfil = await obter_ou_criar_usuario_db(
-        user_id=user_id,
-        username=username,
-        first_name=first_name,
-        last_name=last_name
-    )
+    # 1) Presença diária unificada
+    perfil_req = PerfilRequisicao(user)
+    perfil = await perfil_req.obter_ou_criar()
 
     if update.effective_chat.type == "private":
         await processar_presenca_diaria(
             perfil=perfil,
-            bot=context.bot
+            bot=context.bot,
+            perfil_req=perfil_req
         )
-        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot)
+        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot, perfil_req)
         if invalido:
             await update.message.reply_text(msg)
             return
 
-    mensagem_antiga_id = ranking_mensagens_top.get(chat_id)
-    if mensagem_antiga_id:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=mensagem_antiga_id)
-        except:
-            pass  # Ignora erro se a mensagem já tiver sido apagada manualmente
+    publicador_ranking.solicitar(chat_id, context.bot)
+
+
+# --- Mensagem de ranking por chat (editada no lugar) ---
+# Cada chat tem uma única mensagem de ranking, cujo id fica em ranking_mensagens e
+# sobrevive a reinícios. Pedidos repetidos dentro de RANKING_DEBOUNCE_SEG viram uma
+# única edição extra ao fim da janela.
+RANKING_DEBOUNCE_SEG = float(os.getenv("RANKING_DEBOUNCE_SEG", "3"))
+
+consultas.registrar("ranking_mensagens", "SELECT chat_id, message_id FROM ranking_mensagens")
+consultas.registrar("salvar_ranking_mensagem", """
+    INSERT INTO ranking_mensagens (chat_id, message_id) VALUES ($1, $2)
+    ON CONFLICT (chat_id) DO UPDATE
+       SET message_id = EXCLUDED.message_id, atualizado_em = NOW()
+""")
 
-    # Busca top 10
-    top = await pool.fetch(
-        """
-        SELECT
-            user_id,
-            username,
-            first_name,
-            display_choice,
-            nickname,
-            pontos
-        FROM usuarios
-        ORDER BY pontos DESC
-        LIMIT 20
-        """
-    )
 
+async def carregar_mensagens_ranking():
+    rows = await consultas.fetch("ranking_mensagens")
+    ranking_mensagens_top.clear()
+    ranking_mensagens_top.update({r["chat_id"]: r["message_id"] for r in rows})
+
+
+async def texto_ranking_top() -> str:
+    # Top 20 direto da memória
+    top = await placar_top.top()
     if not top:
-        msg = await update.message.reply_text("🏅 Nenhum usuário cadastrado no ranking.")
-        ranking_mensagens_top[chat_id] = msg.message_id
-        return
+        return "🏅 Nenhum usuário cadastrado no ranking."
 
     linhas = ["🏆 <b>Ranking Geral Top 20</b>\n"]
-    medalhas = ["🥇", "🥈", "🥉"] + ["🏅"] * 17
-
     for i, u in enumerate(top):
-        choice = u["display_choice"]
-        if choice == "first_name":
-            display = u["first_name"] or u["username"] or "Usuário"
-        elif choice in ("nickname", "anonymous"):
-            display = u["nickname"] or u["username"] or "Usuário"
-        elif choice == "indefinido":
-            display = "Esp. interação"
-        else:
-            display = u["username"] or u["first_name"] or "Usuário"
+        medalha = MEDALHAS[i] if i < len(MEDALHAS) else "🎖️"
+        linhas.append(f"{medalha} <b>{nome_no_ranking(u)}</b> — <code>{u['pontos']} pts</code>")
+    return "\n".join(linhas)
 
-        pontos = u["pontos"]
-        medalha = medalhas[i] if i < len(medalhas) else "🎖️"
 
-        linhas.append(f"{medalha} <b>{display}</b> — <code>{pontos} pts</code>")
+async def publicar_ranking(bot: Bot, chat_id: int):
+    """Edita a mensagem de ranking do chat; se ela não existir mais, envia uma nova."""
+    texto = await texto_ranking_top()
 
-    texto = "\n".join(linhas)
+    message_id = ranking_mensagens_top.get(chat_id)
+    if message_id:
+        try:
+            await bot.edit_message_text(
+                texto, chat_id=chat_id, message_id=message_id, parse_mode=ParseMode.HTML
+            )
+            return
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return  # ranking não mudou desde a última edição
+            logger.info(f"[ranking] Mensagem {message_id} do chat {chat_id} não editável ({e}), enviando nova")
 
-    msg = await update.message.reply_text(
-        texto,
-        parse_mode=ParseMode.HTML  # ou telegram.constants.ParseMode.HTML, dependendo da sua versão
+    msg = await bot.send_message(chat_id, texto, parse_mode=ParseMode.HTML)
+    ranking_mensagens_top[chat_id] = msg.message_id
+    await consultas.execute("salvar_ranking_mensagem", chat_id, msg.message_id)
+
+
+class PublicadorRanking:
+    """
+    Debounce por chat: o primeiro pedido publica na hora; os que chegarem durante
+    os `intervalo` segundos seguintes só marcam o chat, que recebe uma edição final.
+    """
+
+    def __init__(self, intervalo: float):
+        self.intervalo = intervalo
+        self._tarefas: dict[int, asyncio.Task] = {}
+        self._pendentes: set[int] = set()
+
+    def solicitar(self, chat_id: int, bot: Bot):
+        if chat_id in self._tarefas:
+            self._pendentes.add(chat_id)
+            return
+        self._tarefas[chat_id] = asyncio.create_task(self._executar(chat_id, bot))
+
+    async def _executar(self, chat_id: int, bot: Bot):
+        try:
+            while True:
+                try:
+                    await publicar_ranking(bot, chat_id)
+                except Exception:
+                    logger.exception(f"[ranking] Falha ao publicar ranking no chat {chat_id}")
+                await asyncio.sleep(self.intervalo)
+                if chat_id not in self._pendentes:
+                    return
+                self._pendentes.discard(chat_id)
+        finally:
+            self._tarefas.pop(chat_id, None)
+
+    async def parar(self):
+        tarefas = list(self._tarefas.values())
+        for tarefa in tarefas:
+            tarefa.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        self._pendentes.clear()
+
+
+publicador_ranking = PublicadorRanking(RANKING_DEBOUNCE_SEG)
+
+
+# --- Rankings por janela (diário / semanal / campanha) ---
+# Um job periódico agrega o historico_pontos de cada janela em ranking_snapshots;
+# o /ranking <janela> só lê o snapshot, nunca o histórico bruto.
+JANELAS_RANKING = {
+    "diario": "Ranking do Dia",
+    "semanal": "Ranking da Semana",
+    "campanha": "Ranking da Campanha",
+}
+RANKING_SNAPSHOT_SEG = int(os.getenv("RANKING_SNAPSHOT_SEG", "300"))
+
+SQL_SNAPSHOT_RANKING = """
+INSERT INTO ranking_snapshots (janela, posicao, user_id, pontos)
+SELECT $1, ROW_NUMBER() OVER (ORDER BY pontos DESC, user_id), user_id, pontos
+  FROM (
+        SELECT user_id, SUM(pontos)::int AS pontos
+          FROM historico_pontos
+         WHERE data >= $2 AND data < $3
+           AND user_id IS NOT NULL
+         GROUP BY user_id
+        HAVING SUM(pontos) > 0
+         ORDER BY pontos DESC, user_id
+         LIMIT $4
+       ) AS agregado
+"""
+
+consultas.registrar("ranking_janela_meta", "SELECT inicio, fim, gerado_em FROM ranking_janelas WHERE janela = $1")
+consultas.registrar("ranking_janela", """
+    SELECT s.posicao, s.pontos,
+           u.username, u.first_name, u.display_choice, u.nickname
+      FROM ranking_snapshots s
+      JOIN usuarios u ON u.user_id = s.user_id
+     WHERE s.janela = $1
+     ORDER BY s.posicao
+""")
+
+
+def periodo_janela(janela: str) -> tuple[datetime, datetime] | None:
+    """[início, fim) da janela no fuso de SP; None se a campanha não estiver configurada."""
+    hoje = hoje_data_sp()
+    if janela == "diario":
+        return intervalo_dia_sp(hoje)
+    if janela == "semanal":
+        segunda = hoje - timedelta(days=hoje.weekday())
+        return intervalo_dia_sp(segunda)[0], intervalo_dia_sp(segunda + timedelta(days=6))[1]
+    inicio, fim = obter_config("campanha_inicio"), obter_config("campanha_fim")
+    if not inicio or not fim:
+        return None
+    return (intervalo_dia_sp(date.fromisoformat(inicio))[0],
+            intervalo_dia_sp(date.fromisoformat(fim))[1])
+
+
+async def gerar_snapshot_ranking(janela: str):
+    periodo = periodo_janela(janela)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if periodo is None:
+                await conn.execute("DELETE FROM ranking_janelas WHERE janela = $1", janela)
+                return
+            inicio, fim = periodo
+            await conn.execute(
+                """
+                INSERT INTO ranking_janelas (janela, inicio, fim, gerado_em)
+                VALUES ($1, $2, $3, NOW())
+                ON CONFLICT (janela) DO UPDATE
+                   SET inicio = EXCLUDED.inicio, fim = EXCLUDED.fim, gerado_em = NOW()
+                """,
+                janela, inicio, fim
+            )
+            await conn.execute("DELETE FROM ranking_snapshots WHERE janela = $1", janela)
+            await conn.execute(SQL_SNAPSHOT_RANKING, janela, inicio, fim, TOP_RANKING)
+
+
+async def gerar_snapshots_ranking():
+    for janela in JANELAS_RANKING:
+        await gerar_snapshot_ranking(janela)
+
+
+async def ranking_janela(update: Update, context: CallbackContext):
+    """/ranking <diario|semanal|campanha> — lê o snapshot mais recente da janela."""
+    args = context.args or []
+    janela = args[0].lower() if args else ""
+    if janela not in JANELAS_RANKING:
+        await update.message.reply_text(
+            "Uso: /ranking <janela>\nJanelas: " + ", ".join(JANELAS_RANKING)
+        )
+        return
+
+    meta = await consultas.fetchrow("ranking_janela_meta", janela)
+    if meta is None:
+        await update.message.reply_text("ℹ️ Nenhuma campanha configurada no momento.")
+        return
+
+    top = await consultas.fetch("ranking_janela", janela)
+    periodo = (
+        f"{format_dt_sp(meta['inicio'], '%d/%m')} a "
+        f"{format_dt_sp(meta['fim'] - timedelta(microseconds=1), '%d/%m')}"
     )
+    linhas = [f"🏆 <b>{JANELAS_RANKING[janela]}</b> ({periodo})\n"]
+    if not top:
+        linhas.append("🏅 Ninguém pontuou nesse período ainda.")
+    for u in top:
+        i = u["posicao"] - 1
+        medalha = MEDALHAS[i] if i < len(MEDALHAS) else "🎖️"
+        linhas.append(f"{medalha} <b>{nome_no_ranking(u)}</b> — <code>{u['pontos']} pts</code>")
+    linhas.append(f"\n<i>Atualizado às {format_dt_sp(meta['gerado_em'], '%H:%M')}</i>")
 
-    ranking_mensagens_top[chat_id] = msg.message_id
+    await update.message.reply_text("\n".join(linhas), parse_mode=ParseMode.HTML)
+
+
+async def definir_campanha(update: Update, context: CallbackContext):
+    """/campanha <dd/mm/aaaa> <dd/mm/aaaa> — define o período do ranking de campanha."""
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("🚫 Você não tem permissão.")
+
+    args = context.args or []
+    try:
+        inicio, fim = (datetime.strptime(a, "%d/%m/%Y").date() for a in args)
+    except ValueError:
+        return await update.message.reply_text("Uso: /campanha <dd/mm/aaaa> <dd/mm/aaaa>")
+    if fim < inicio:
+        return await update.message.reply_text("❌ A data final é anterior à inicial.")
+
+    await salvar_config("campanha_inicio", inicio.isoformat())
+    await salvar_config("campanha_fim", fim.isoformat())
+    await gerar_snapshot_ranking("campanha")
+    await update.message.reply_text(
+        f"✅ Campanha definida de {inicio:%d/%m/%Y} a {fim:%d/%m/%Y}."
+    )
+
+
+# --- Presença em grupos (escrita em lote) ---
+PONTOS_PRESENCA = 5
+PRESENCA_FLUSH_MS = int(os.getenv("PRESENCA_FLUSH_MS", "500"))  # intervalo máximo entre gravações
+PRESENCA_FLUSH_MAX = int(os.getenv("PRESENCA_FLUSH_MAX", "200"))  # grava antes se o lote encher
+
+SQL_PRESENCA_LOTE = consultas.registrar("presenca_lote", """
+WITH ativo AS (
+    SELECT EXISTS (
+        SELECT 1 FROM config_checkin WHERE chave = 'adicionar_pontos' AND valor = 'true'
+    ) AS ligado
+),
+-- um único dia por chamada, sem user_id repetido (ver AgregadorPresenca.flush)
+lote AS (
+    SELECT user_id, dia, username, first_name, last_name
+      FROM unnest($1::bigint[], $2::date[], $3::text[], $4::text[], $5::text[])
+           AS l(user_id, dia, username, first_name, last_name)
+),
+novos AS (
+    -- usuários ainda não cadastrados já entram com a presença do dia
+    INSERT INTO usuarios
+        (user_id, username, first_name, last_name, pontos, nivel_atingido, ultima_interacao)
+    SELECT l.user_id, l.username, l.first_name, l.last_name,
+           CASE WHEN a.ligado THEN $6 ELSE 0 END,
+           CASE WHEN a.ligado
+                THEN (SELECT COUNT(*) FROM unnest($7::int[]) AS n(limiar) WHERE $6 >= n.limiar)
+                ELSE 0 END,
+           CASE WHEN a.ligado THEN l.dia END
+      FROM lote l CROSS JOIN ativo a
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING user_id, username, first_name, last_name, pontos, ultima_interacao
+),
+hist_novos AS (
+    INSERT INTO usuario_history (user_id, status, username, first_name, last_name)
+    SELECT user_id, 'Inserido', username, first_name, last_name FROM novos
+),
+creditados AS (
+    UPDATE usuarios u
+       SET pontos = u.pontos + $6,
+           nivel_atingido = (
+               SELECT COUNT(*) FROM unnest($7::int[]) AS n(limiar) WHERE u.pontos + $6 >= n.limiar
+           ),
+           ultima_interacao = l.dia
+      FROM lote l, ativo a
+     WHERE u.user_id = l.user_id
+       AND a.ligado
+       AND u.ultima_interacao IS DISTINCT FROM l.dia
+    RETURNING u.user_id, u.pontos, l.dia
+),
+pontuados AS (
+    SELECT user_id, pontos, dia FROM creditados
+    UNION ALL
+    SELECT user_id, pontos, ultima_interacao FROM novos WHERE ultima_interacao IS NOT NULL
+),
+hist_pontos AS (
+    INSERT INTO historico_pontos (user_id, pontos, motivo)
+    SELECT user_id, $6, 'Presença diária' FROM pontuados
+)
+SELECT user_id, pontos, dia, TRUE AS creditado FROM pontuados
+UNION ALL
+-- quem já tinha feito check-in no dia (ex.: por outro processo)
+SELECT u.user_id, u.pontos, l.dia, FALSE
+  FROM usuarios u
+  JOIN lote l ON l.user_id = u.user_id
+ WHERE u.ultima_interacao = l.dia
+""")
+
+
+class CheckinsDoDia:
+    """
+    Conjunto dos user_ids que já fizeram check-in na data de hoje (SP).
+    É zerado sozinho na virada do dia e serve de atalho antes de ir ao banco.
+    """
+
+    def __init__(self):
+        self.dia = hoje_data_sp()
+        self._ids: set[int] = set()
+
+    def _virar_dia(self):
+        hoje = hoje_data_sp()
+        if hoje != self.dia:
+            self.dia = hoje
+            self._ids.clear()
+
+    def __contains__(self, user_id: int) -> bool:
+        self._virar_dia()
+        return user_id in self._ids
+
+    def marcar(self, user_id: int, dia: date | None = None):
+        self._virar_dia()
+        if dia is None or dia == self.dia:
+            self._ids.add(user_id)
+
+    async def carregar(self):
+        self._virar_dia()
+        rows = await consultas.fetch("checkins_do_dia", self.dia)
+        self._ids = {r["user_id"] for r in rows}
+        logger.info(f"[checkins_hoje] {len(self._ids)} check-ins carregados para {self.dia}")
+
+
+checkins_hoje = CheckinsDoDia()
+
+
+class AgregadorPresenca:
+    """
+    Acumula as presenças dos grupos em memória, uma por (user_id, data SP),
+    e grava tudo num único statement a cada `intervalo_ms` ou `max_itens`.
+    """
+
+    def __init__(self, intervalo_ms: int, max_itens: int):
+        self.intervalo = intervalo_ms / 1000
+        self.max_itens = max_itens
+        self._buffer: dict[tuple[int, date], tuple[str, str, str]] = {}
+        self._cheio = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._tarefa: asyncio.Task | None = None
+
+    def registrar(self, user: User):
+        self._buffer[(user.id, hoje_data_sp())] = (
+            user.username or "vazio",
+            user.first_name or "vazio",
+            user.last_name or "vazio",
+        )
+        if len(self._buffer) >= self.max_itens:
+            self._cheio.set()
+
+    async def flush(self) -> list[asyncpg.Record]:
+        async with self._lock:
+            if not self._buffer:
+                return []
+            lote, self._buffer = self._buffer, {}
+
+            # Um lote pode ter o mesmo usuário em dois dias (janela que cruza a meia-noite,
+            # lote devolvido após falha): grava dia a dia, do mais antigo ao mais novo,
+            # para que a presença da véspera não se perca.
+            por_dia: dict[date, dict[int, tuple[str, str, str]]] = defaultdict(dict)
+            for (user_id, dia), perfil in lote.items():
+                por_dia[dia][user_id] = perfil
+            dias = sorted(por_dia)
+
+            linhas = []
+            for i, dia in enumerate(dias):
+                perfis = por_dia[dia]
+                try:
+                    linhas_dia = await consultas.fetch(
+                        "presenca_lote",
+                        list(perfis), [dia] * len(perfis),
+                        [p[0] for p in perfis.values()],
+                        [p[1] for p in perfis.values()],
+                        [p[2] for p in perfis.values()],
+                        PONTOS_PRESENCA, sorted(NIVEIS_BRINDES)
+                    )
+                except Exception:
+                    # devolve os dias não gravados sem sobrescrever o que chegou depois
+                    for pendente in dias[i:]:
+                        for user_id, perfil in por_dia[pendente].items():
+                            self._buffer.setdefault((user_id, pendente), perfil)
+                    raise
+
+                for r in linhas_dia:
+                    checkins_hoje.marcar(r["user_id"], r["dia"])
+                    registrar_pontos(r["user_id"], r["pontos"])
+                linhas.extend(linhas_dia)
+
+            pontuadas = sum(1 for r in linhas if r["creditado"])
+            logger.info(f"[presenca] Lote gravado: {len(lote)} presenças, {pontuadas} pontuadas")
+            return linhas
+
+    async def _executar(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._cheio.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._cheio.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("[presenca] Erro ao gravar lote de presenças")
+
+    def iniciar(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.create_task(self._executar())
+
+    async def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            try:
+                await self._tarefa
+            except asyncio.CancelledError:
+                pass
+            self._tarefa = None
+        await self.flush()
+
+
+agregador_presenca = AgregadorPresenca(PRESENCA_FLUSH_MS, PRESENCA_FLUSH_MAX)
 
 
 async def tratar_presenca(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1137,52 +2911,163 @@ async def tratar_presenca(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user is None or user.is_bot:
         return
 
-    perfil = await obter_ou_criar_usuario_db(
-        user_id=user.id,
-        username=user.username or "vazio",
-        first_name=user.first_name or "vazio",
-        last_name=user.last_name or "vazio"
-    )
+    # Já fez check-in hoje: nada a gravar
+    if user.id in checkins_hoje:
+        return
 
-    await processar_presenca_diaria(perfil, context.bot)
+    # Só registra em memória; o AgregadorPresenca grava no banco em lote
+    agregador_presenca.registrar(user)
 
 
 logger = logging.getLogger(__name__)
 
 
-async def processar_presenca_diaria(perfil: asyncpg.Record | dict, bot: Bot) -> int | None:
+SQL_CHECKIN = consultas.registrar("checkin", """
+WITH creditado AS (
+    UPDATE usuarios u
+       SET pontos = u.pontos + $2,
+           nivel_atingido = (
+               SELECT COUNT(*) FROM unnest($3::int[]) AS n(limiar) WHERE u.pontos + $2 >= n.limiar
+           ),
+           ultima_interacao = $4
+     WHERE u.user_id = $1
+       AND u.ultima_interacao IS DISTINCT FROM $4
+    RETURNING u.*
+),
+hist AS (
+    INSERT INTO historico_pontos (user_id, pontos, motivo)
+    SELECT user_id, $2, 'Presença diária' FROM creditado
+)
+SELECT * FROM creditado
+""")
+
+
+async def registrar_checkin_db(user_id: int, dia: date) -> asyncpg.Record | None:
+    """
+    Check-in diário numa única ida ao banco: soma os pontos, recalcula o nível,
+    marca a ultima_interacao e grava o histórico, só se ainda não pontuou em `dia`.
+    Retorna a linha atualizada de `usuarios` ou None se o check-in já tinha sido feito.
+    """
+    return await consultas.fetchrow(
+        "checkin",
+        user_id, PONTOS_PRESENCA, sorted(NIVEIS_BRINDES), dia
+    )
+
+
+async def processar_presenca_diaria(
+        perfil: asyncpg.Record | dict,
+        bot: Bot,
+        perfil_req: PerfilRequisicao | None = None
+) -> int | None:
+    if perfil["user_id"] in checkins_hoje:
+        return None
+
     logger.info(
         f"[processar_presenca_diaria] user_id={perfil['user_id']} última interação: {perfil['ultima_interacao']}")
 
-    resultado = await pool.fetchrow("SELECT valor FROM config_checkin WHERE chave = 'adicionar_pontos'")
-    if not resultado or resultado["valor"] != "true":
+    if obter_config("adicionar_pontos") != "true":
         logger.info("[processar_presenca_diaria] Check-in desativado na configuração")
         return None
 
     user_id = perfil["user_id"]
     ultima_interacao = perfil["ultima_interacao"]
 
-    if ultima_interacao != hoje_data_sp():
-        novo_total = await atualizar_pontos(user_id, 5, "Presença diária", bot)
-
-        await pool.execute(
-            "UPDATE usuarios SET ultima_interacao = $1 WHERE user_id = $2::bigint",
-            hoje_data_sp(), user_id
-        )
-        return novo_total
+    hoje = hoje_data_sp()
+    if ultima_interacao != hoje:
+        # O UPDATE só casa se ultima_interacao != hoje, então mensagens
+        # simultâneas não pontuam duas vezes
+        linha = await registrar_checkin_db(user_id, hoje)
+        checkins_hoje.marcar(user_id, hoje)
+        if linha is None:
+            return None
+        registrar_pontos(user_id, linha["pontos"], linha)
+        if perfil_req is not None:
+            perfil_req.atualizar(linha)
+        logger.info(f"[processar_presenca_diaria] user_id={user_id} novo_total={linha['pontos']}")
+        return linha["pontos"]
+
+    checkins_hoje.marcar(user_id)
     return None
 
 
-async def cancel(update: Update, conText: ContextTypes.DEFAULT_TYPE):
-    # Limpa tudo que já havia sido armazenado
-    conText.user_data.clear()
-    await update.message.reply_text(
-        "❌ Operação cancelada. Nenhum dado foi salvo."
-    )
-    return ConversationHandler.END
+async def cancel(update: Update, conText: ContextTypes.DEFAULT_TYPE):
+    # Limpa tudo que já havia sido armazenado
+    conText.user_data.clear()
+    await update.message.reply_text(
+        "❌ Operação cancelada. Nenhum dado foi salvo."
+    )
+    return ConversationHandler.END
+
+
+# --- Busca aproximada de nomes (pg_trgm) ---
+BUSCA_MIN_CARACTERES = 3  # abaixo disso não há trigramas para o índice usar
+BUSCA_LIMITE = 15
+
+# $1 = texto, $2 = padrão ILIKE (%texto%), $3 = limite. Cada usuário aparece uma vez,
+# com a melhor similaridade entre todos os nomes que já usou.
+consultas.registrar("buscar_nomes", """
+    WITH achados AS (
+        SELECT user_id,
+               MAX(GREATEST(similarity(nickname, $1),
+                            similarity(username, $1),
+                            similarity(first_name, $1))) AS score
+          FROM usuario_history
+         WHERE nickname % $1 OR username % $1 OR first_name % $1
+            OR nickname ILIKE $2 OR username ILIKE $2 OR first_name ILIKE $2
+         GROUP BY user_id
+         ORDER BY score DESC, user_id
+         LIMIT $3
+    )
+    SELECT a.user_id, a.score, u.username, u.first_name, u.nickname
+      FROM achados a
+      LEFT JOIN usuarios u ON u.user_id = a.user_id
+     ORDER BY a.score DESC, a.user_id
+""")
+
+
+def padrao_ilike(texto: str) -> str:
+    """'%texto%' com os curingas do LIKE escapados (usernames costumam ter '_')."""
+    return "%" + re.sub(r"([\\%_])", r"\\\1", texto) + "%"
+
+
+async def buscar_usuarios_por_nome(texto: str, limite: int = BUSCA_LIMITE):
+    return await consultas.fetch("buscar_nomes", texto, padrao_ilike(texto), limite)
+
+
+async def buscar(update: Update, context: CallbackContext):
+    """/buscar <texto> — procura nicknames, usernames e nomes (atuais e antigos)."""
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text("🔒 Você precisa autenticar: use /admin primeiro.")
+        return
+
+    texto = " ".join(context.args or []).strip()
+    if len(texto) < BUSCA_MIN_CARACTERES:
+        await update.message.reply_text(
+            f"Uso: /buscar <texto> (mínimo {BUSCA_MIN_CARACTERES} caracteres)"
+        )
+        return
 
+    rows = await buscar_usuarios_por_nome(texto)
+    if not rows:
+        await update.message.reply_text("🔎 Nenhum usuário encontrado.")
+        return
 
-async def historico_usuario(update: Update, context: CallbackContext):
+    linhas = [f"🔎 <b>Resultados para</b> <code>{html.escape(texto)}</code>\n"]
+    for r in rows:
+        nomes = " / ".join(
+            html.escape(v) for v in (
+                f"@{r['username']}" if r["username"] and r["username"] != "vazio" else None,
+                r["first_name"] if r["first_name"] != "vazio" else None,
+                r["nickname"] if r["nickname"] != "sem nick" else None,
+            ) if v
+        ) or "sem nome"
+        linhas.append(f"<code>{r['user_id']}</code> — {nomes} ({r['score']:.0%})")
+    linhas.append("\nUse /historico_usuario &lt;user_id&gt; para ver o histórico.")
+    await update.message.reply_text("\n".join(linhas), parse_mode=ParseMode.HTML)
+
+
+async def historico_usuario(update: Update, context: CallbackContext,
+                            cursor: tuple[str, int, int] | None = None):
     # 0) Autenticação de admin
     requester_id = update.effective_user.id
 
@@ -1254,33 +3139,55 @@ async def historico_usuario(update: Update, context: CallbackContext):
         if row:
             target_id = row["user_id"]
         else:
-            await update.message.reply_text(
-                f"⚠️ Nickname `{escape_markdown_v2(nickname)}` não encontrado no histórico",
-                parse_mode="MarkdownV2"
+            texto = f"⚠️ Nickname `{escape_markdown_v2(nickname)}` não encontrado no histórico"
+            # Sem match exato: sugere os nomes mais parecidos
+            sugestoes = (
+                await buscar_usuarios_por_nome(nickname, limite=5)
+                if len(nickname) >= BUSCA_MIN_CARACTERES else []
             )
+            if sugestoes:
+                texto += "\n\nParecidos:\n" + "\n".join(
+                    f"`{s['user_id']}` — {escape_markdown_v2(s['nickname'] or '')} "
+                    f"{escape_markdown_v2('@' + s['username'] if s['username'] not in (None, 'vazio') else '')}"
+                    for s in sugestoes
+                )
+            await update.message.reply_text(texto, parse_mode="MarkdownV2")
             return ConversationHandler.END
 
-    # 4) Executa a query (sem definir header aqui)
-    if target_id is None:
-        sql = (
-            "SELECT id, user_id, status, username, first_name, last_name, display_choice, nickname, inserido_em "
-            "FROM usuario_history "
-            "ORDER BY inserido_em DESC, id DESC "
-            "LIMIT $1 OFFSET $2"
-        )
-        params = (PAGE_SIZE + 1, offset)
-    else:
-        sql = (
-            "SELECT id, user_id, status, username, first_name, last_name, display_choice, nickname, inserido_em "
-            "FROM usuario_history "
-            "WHERE user_id = $1 "
-            "ORDER BY inserido_em DESC, id DESC "
-            "LIMIT $2 OFFSET $3"
-        )
-        params = (target_id, PAGE_SIZE + 1, offset)
+    # 4) Executa a query (sem definir header aqui). Com cursor, parte da chave
+    #    (inserido_em, id) da linha de borda; sem cursor, salta com OFFSET.
+    condicoes, params = [], []
+    if target_id is not None:
+        params.append(target_id)
+        condicoes.append(f"user_id = ${len(params)}")
+    ordem = "DESC"
+    if cursor is not None:
+        direcao, micros, id_cursor = cursor
+        params += [cursor_para_ts(micros), id_cursor]
+        comparador = "<" if direcao == "p" else ">"
+        condicoes.append(f"(inserido_em, id) {comparador} (${len(params) - 1}, ${len(params)})")
+        if direcao == "a":
+            ordem = "ASC"
+    params.append(PAGE_SIZE + 1 if cursor is None or cursor[0] == "p" else PAGE_SIZE)
+    limite = f"LIMIT ${len(params)}"
+    if cursor is None:
+        params.append(offset)
+        limite += f" OFFSET ${len(params)}"
+
+    sql = (
+        "SELECT id, user_id, status, username, first_name, last_name, display_choice, nickname, inserido_em "
+        "FROM usuario_history "
+        + (f"WHERE {' AND '.join(condicoes)} " if condicoes else "")
+        + f"ORDER BY inserido_em {ordem}, id {ordem} "
+        + limite
+    )
 
     rows = await pool.fetch(sql, *params)
-    tem_mais = len(rows) > PAGE_SIZE
+    if cursor is not None and cursor[0] == "a":
+        rows = list(reversed(rows))
+        tem_mais = True
+    else:
+        tem_mais = len(rows) > PAGE_SIZE
     rows = rows[:PAGE_SIZE]
 
     # 5) Se não há registros
@@ -1323,43 +3230,31 @@ async def historico_usuario(update: Update, context: CallbackContext):
             f"nickname: `{escape_markdown_v2(r['nickname'])}`"
         )
 
-    # 8) Truncamento linha a linha (nunca cortando no meio de uma formatação)
-    final_lines = []
-    total_length = 0
-
-    for line in lines:
-        # +1 para contabilizar o '\n' que será inserido
-        if total_length + len(line) + 1 > MAX_MESSAGE_LENGTH - 50:
-            final_lines.append("⚠️ Atenção: parte da mensagem omitida por exceder o limite")
-            break
-        final_lines.append(line)
-        total_length += len(line) + 1
+    # 8) Divide em páginas de mensagem (só entre linhas, sem cortar formatação)
+    paginas = paginar(lines[1:], lines[0] + "\n", ParseMode.MARKDOWN_V2)
+    texto = paginas[0]
 
-    texto = "\n".join(final_lines)
-
-    # 9) Botões de navegação
+    # 9) Botões de navegação: "hist:<alvo>:<página>:<a|p>:<inserido_em em µs>:<id>"
+    primeiro, ultimo = rows[0], rows[-1]
     botoes = []
     if page > 1:
         botoes.append(
             InlineKeyboardButton(
                 "◀️ Anterior",
-                callback_data=f"hist:{target_id or 0}:{page - 1}"
+                callback_data=f"hist:{target_id or 0}:{page - 1}:a:"
+                              f"{ts_para_cursor(primeiro['inserido_em'])}:{primeiro['id']}"
             )
         )
     if tem_mais:
         botoes.append(
             InlineKeyboardButton(
                 "Próximo ▶️",
-                callback_data=f"hist:{target_id or 0}:{page + 1}"
+                callback_data=f"hist:{target_id or 0}:{page + 1}:p:"
+                              f"{ts_para_cursor(ultimo['inserido_em'])}:{ultimo['id']}"
             )
         )
-    markup = InlineKeyboardMarkup([botoes]) if botoes else None
     try:
-        await update.message.reply_text(
-            texto,
-            parse_mode="MarkdownV2",
-            reply_markup=markup
-        )
+        await enviar_paginas(update, paginas, ParseMode.MARKDOWN_V2, botoes_extra=botoes or None)
     except BadRequest as err:
         # 1) Extrair o “byte offset” da mensagem de erro
         #    Normalmente a mensagem do err tem algo como:
@@ -1412,11 +3307,12 @@ async def callback_historico(update: Update, context: CallbackContext):
     await query.answer()
 
     try:
-        prefixo, user_id_str, page_str = query.data.split(":")
+        prefixo, user_id_str, page_str, *resto = query.data.split(":")
         if prefixo != "hist":
             return
         target_id = int(user_id_str)
         page = int(page_str)
+        cursor = (resto[0], int(resto[1]), int(resto[2])) if resto else None
     except Exception:
         await query.edit_message_text("❌ Erro ao processar paginação")
         return
@@ -1432,7 +3328,7 @@ async def callback_historico(update: Update, context: CallbackContext):
     fake_update = FakeUpdate(query.from_user, query.message, query)
     context.args = [str(target_id)] if target_id != 0 else []
     context.args.append(str(page))
-    await historico_usuario(fake_update, context)
+    await historico_usuario(fake_update, context, cursor=cursor)
 
 
 async def rem_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1499,11 +3395,14 @@ async def listar_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Exemplo:
       /listar_usuarios        → página 1
       /listar_usuarios 2      → página 2
+
+    Os botões navegam por cursor: context.args = [página, 'a'|'p', user_id de borda].
     """
     # 1) Determinar qual página está sendo solicitada (default = 1)
     args = context.args or []
     try:
         page = int(args[0]) if args else 1
+        direcao, cursor = (args[1], int(args[2])) if len(args) >= 3 else (None, None)
     except ValueError:
         await update.message.reply_text("❌ Página inválida. Use /listar_usuarios <número>.")
         return
@@ -1511,34 +3410,51 @@ async def listar_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if page < 1:
         page = 1
 
-    # 2) Calcular total de usuários para saber quantas páginas existem
+    # 2) Total aproximado (estatísticas do catálogo) só para exibição
     try:
-        total_usuarios = await pool.fetchval("SELECT COUNT(*) FROM usuarios")
+        total_usuarios = await contagem_aproximada("usuarios")
     except Exception as e:
         logger.error(f"Erro ao contar usuários: {e}")
         await update.message.reply_text("❌ Não foi possível obter o total de usuários.")
         return
 
     total_paginas = max(1, math.ceil(total_usuarios / PAGE_SIZE_LISTAR))
-    if page > total_paginas:
+    if direcao is None and page > total_paginas:
         await update.message.reply_text(
             f"ℹ️ A página {page} não existe. Só há {total_paginas} páginas"
         )
         return
 
-    # 3) Buscar só os usuários daquela página
+    # 3) Buscar só os usuários daquela página (uma linha a mais para saber se há próxima)
     offset = (page - 1) * PAGE_SIZE_LISTAR
     try:
-        rows = await pool.fetch(
-            "SELECT user_id, first_name, username FROM usuarios ORDER BY user_id LIMIT $1 OFFSET $2",
-            PAGE_SIZE_LISTAR,
-            offset
-        )
+        if direcao == "p":
+            rows = await pool.fetch(
+                "SELECT user_id, first_name, username FROM usuarios "
+                "WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+                cursor, PAGE_SIZE_LISTAR + 1
+            )
+        elif direcao == "a":
+            rows = await pool.fetch(
+                "SELECT user_id, first_name, username FROM usuarios "
+                "WHERE user_id < $1 ORDER BY user_id DESC LIMIT $2",
+                cursor, PAGE_SIZE_LISTAR
+            )
+            rows = list(reversed(rows))
+        else:
+            rows = await pool.fetch(
+                "SELECT user_id, first_name, username FROM usuarios ORDER BY user_id LIMIT $1 OFFSET $2",
+                PAGE_SIZE_LISTAR + 1,
+                offset
+            )
     except Exception as e:
         logger.error(f"Erro ao buscar usuários: {e}")
         await update.message.reply_text("❌ Não foi possível acessar a lista de usuários.")
         return
 
+    tem_proxima = direcao == "a" or len(rows) > PAGE_SIZE_LISTAR
+    rows = rows[:PAGE_SIZE_LISTAR]
+
     if not rows:
         await update.message.reply_text("ℹ️ Nenhum usuário encontrado nesta página.")
         return
@@ -1567,18 +3483,18 @@ async def listar_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines.append(f"{indice_global}\\.`{user_id}` — {display_esc}")
 
     # 5) Texto final
-    header = f"👥 **Usuários cadastrados \\(página {page}/{total_paginas}, total {total_usuarios}\\):**\n\n"
+    header = f"👥 **Usuários cadastrados \\(página {page}/{total_paginas}, total ≈{total_usuarios}\\):**\n\n"
     texto = header + "\n".join(lines)
 
-    # 6) Botões de navegação (Anterior / Próximo) se houver mais de uma página
+    # 6) Botões de navegação (Anterior / Próximo), levando o user_id de borda como cursor
     buttons = []
     if page > 1:
         buttons.append(
-            InlineKeyboardButton("◀️ Anterior", callback_data=f"usuarios|{page - 1}")
+            InlineKeyboardButton("◀️ Anterior", callback_data=f"usuarios|{page - 1}|a|{rows[0]['user_id']}")
         )
-    if page < total_paginas:
+    if tem_proxima:
         buttons.append(
-            InlineKeyboardButton("Próximo ▶️", callback_data=f"usuarios|{page + 1}")
+            InlineKeyboardButton("Próximo ▶️", callback_data=f"usuarios|{page + 1}|p|{rows[-1]['user_id']}")
         )
     reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
 
@@ -1605,158 +3521,323 @@ async def callback_listar_usuarios(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
 
-    # O callback_data foi definido como "usuarios|<pagina>"
+    # O callback_data foi definido como "usuarios|<pagina>|<a|p>|<user_id de borda>"
     data = query.data.split("|")
     if data[0] != "usuarios":
         return  # não é o callback esperado
     try:
         nova_pagina = int(data[1])
+        direcao, cursor = data[2], int(data[3])
     except (IndexError, ValueError):
         return
 
     # Simula args e chama listar_usuarios novamente, agora em modo callback
-    context.args = [str(nova_pagina)]
+    context.args = [str(nova_pagina), direcao, str(cursor)]
     # Reaproveita a mesma função para editar a mensagem
     await listar_usuarios(update, context)
 
 
-async def estatisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# --- Importação em massa de usuários ---
+IMPORTAR_ARQUIVO = 0
+COLUNAS_IMPORTACAO = ["user_id", "username", "first_name", "last_name"]
+
+SQL_MERGE_IMPORTACAO = """
+WITH lote AS (
+    SELECT DISTINCT ON (user_id) user_id, username, first_name, last_name
+      FROM importacao_usuarios
+     ORDER BY user_id
+),
+salvo AS (
+    INSERT INTO usuarios (user_id, username, first_name, last_name)
+    SELECT user_id, username, first_name, last_name FROM lote
+    ON CONFLICT (user_id) DO UPDATE
+       SET username      = EXCLUDED.username,
+           first_name    = EXCLUDED.first_name,
+           last_name     = EXCLUDED.last_name,
+           atualizado_em = NOW()
+     WHERE (usuarios.username, usuarios.first_name, usuarios.last_name)
+           IS DISTINCT FROM
+           (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name)
+    RETURNING usuarios.*,
+              CASE WHEN xmax = 0 THEN 'Inserido' ELSE 'Atualizado' END AS status
+),
+hist AS (
+    INSERT INTO usuario_history
+        (user_id, status, username, first_name, last_name, display_choice, nickname)
+    SELECT user_id, status, username, first_name, last_name, display_choice, nickname
+      FROM salvo
+)
+SELECT COALESCE(array_agg(user_id) FILTER (WHERE status = 'Inserido'), '{}') AS ids_inseridos,
+       COUNT(*) FILTER (WHERE status = 'Atualizado') AS atualizados
+  FROM salvo
+"""
+
+
+def ler_registros_importacao(nome_arquivo: str, conteudo: bytes) -> list[tuple[int, str, str, str]]:
     """
-    Comando que exibe estatísticas agregadas “no tempo t odo” e “hoje”:
+    Lê um CSV (com cabeçalho) ou JSON (lista de objetos) com as colunas
+    user_id, username, first_name, last_name. Só user_id é obrigatório.
+    O arquivo é lido inteiro em memória antes do COPY. Lança ValueError
+    indicando o registro inválido (ou csv.Error para CSV malformado).
+    """
+    texto = conteudo.decode("utf-8-sig")
+    if nome_arquivo.lower().endswith(".json"):
+        itens = json.loads(texto)
+        if not isinstance(itens, list):
+            raise ValueError("o JSON deve ser uma lista de objetos")
+    else:
+        itens = csv.DictReader(io.StringIO(texto))
 
-    ➤ No tempo t odo (All time):
-      1. Total de usuários cadastrados
-      2. Usuários que já interagiram (receberam pelo menos 1 ponto)
-      3. Usuários que já atingiram algum nível (nivel_atingido > 0)
-      4. Total de pontos distribuídos
-      5. Total de pontos removidos
+    registros = []
+    for i, item in enumerate(itens, start=1):
+        try:
+            user_id = int(str(item["user_id"]).strip())
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"registro {i} sem user_id válido")
+        registros.append((
+            user_id,
+            (str(item.get("username") or "").strip().lstrip("@")) or "vazio",
+            (str(item.get("first_name") or "").strip()) or "vazio",
+            (str(item.get("last_name") or "").strip()) or "vazio",
+        ))
+    return registros
 
-    ➤ Hoje:
-      1. Novos usuários cadastrados hoje
-      2. Usuários que interagiram (pontuados) hoje
-      3. Usuários que atingiram nível hoje
-      4. Total de pontos distribuídos hoje
-      5. Total de pontos removidos hoje
+
+async def importar_usuarios_db(registros: list[tuple[int, str, str, str]]) -> tuple[int, int]:
+    """
+    Envia os registros via COPY para uma tabela temporária e faz o merge em
+    `usuarios` + `usuario_history` com um único statement. Os registros não
+    devem repetir user_id. Retorna (inseridos, atualizados).
     """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(
+                """
+                CREATE TEMP TABLE importacao_usuarios (
+                    user_id    BIGINT NOT NULL,
+                    username   TEXT   NOT NULL,
+                    first_name TEXT   NOT NULL,
+                    last_name  TEXT   NOT NULL
+                ) ON COMMIT DROP
+                """
+            )
+            await conn.copy_records_to_table(
+                "importacao_usuarios",
+                records=registros,
+                columns=COLUNAS_IMPORTACAO
+            )
+            resultado = await conn.fetchrow(SQL_MERGE_IMPORTACAO)
+
+    # novos usuários entram no ranking em memória com 0 pontos, como no /start
+    for uid in resultado["ids_inseridos"]:
+        registrar_pontos(uid, 0)
+    return len(resultado["ids_inseridos"]), resultado["atualizados"]
+
+
+async def importar_usuarios(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text("🔒 Você precisa autenticar: use /admin primeiro.")
+        return ConversationHandler.END
+
+    await update.message.reply_text(
+        "📎 Envie o arquivo .csv (com cabeçalho) ou .json com as colunas "
+        "user_id, username, first_name, last_name.\n"
+        "Digite /cancelar para desistir."
+    )
+    return IMPORTAR_ARQUIVO
+
+
+async def receber_arquivo_importacao(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    documento = update.message.document
+    nome_arquivo = documento.file_name or ""
+
     try:
-        hoje = hoje_data_sp()  # data de hoje em America/Sao_Paulo
+        arquivo = await documento.get_file()
+        conteudo = await arquivo.download_as_bytearray()
+        registros = ler_registros_importacao(nome_arquivo, bytes(conteudo))
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        await update.message.reply_text(f"❌ Arquivo inválido: {e}")
+        return IMPORTAR_ARQUIVO
+
+    if not registros:
+        await update.message.reply_text("ℹ️ O arquivo não tem nenhum registro.")
+        return ConversationHandler.END
 
-        # === NO TEMPO T'ODO ===
+    # user_id repetido no arquivo: vale a última linha, e as outras são contadas à parte
+    unicos = list({r[0]: r for r in registros}.values())
+    duplicados = len(registros) - len(unicos)
 
-        # Total de usuários cadastrados (all time)
-        total_usuarios = await pool.fetchval(
-            "SELECT COUNT(*) FROM usuarios"
-        )
+    await update.message.reply_text(f"🔄 Importando {len(registros)} registros...")
+    inicio = time.perf_counter()
+    try:
+        inseridos, atualizados = await importar_usuarios_db(unicos)
+    except Exception as e:
+        logger.error(f"Erro na importação de usuários: {e}", exc_info=True)
+        await update.message.reply_text("❌ Erro ao importar os usuários. Veja os logs do servidor.")
+        return ConversationHandler.END
+    duracao = time.perf_counter() - inicio
 
-        # Usuários que já atingiram algum nível (nivel_atingido > 0)
-        usuarios_nivel_total = await pool.fetchval(
-            "SELECT COUNT(*) FROM usuarios WHERE nivel_atingido > 0"
-        )
+    logger.info(
+        f"[importar_usuarios] admin={update.effective_user.id} registros={len(registros)} "
+        f"duplicados={duplicados} inseridos={inseridos} atualizados={atualizados} em {duracao:.2f}s"
+    )
+    await update.message.reply_text(
+        "✅ Importação concluída\n"
+        f"• Registros no arquivo: {len(registros)}\n"
+        f"• Novos usuários: {inseridos}\n"
+        f"• Atualizados: {atualizados}\n"
+        f"• Sem alteração: {len(unicos) - inseridos - atualizados}\n"
+        f"• user_id repetido no arquivo: {duplicados} (vale a última linha)\n"
+        f"• Tempo: {duracao:.2f}s ({len(registros) / max(duracao, 1e-6):.0f} linhas/s)"
+    )
+    return ConversationHandler.END
 
-        # Total de pontos distribuídos (soma de pontos positivos, all time)
-        pontos_distribuidos_total = await pool.fetchval(
-            "SELECT COALESCE(SUM(pontos), 0) FROM historico_pontos WHERE pontos > 0"
-        )
 
-        # 5) Total de pontos removidos (soma absoluta de pontos negativos, all time)
-        pontos_removidos_total = await pool.fetchval(
-            "SELECT COALESCE(SUM(ABS(pontos)), 0) FROM historico_pontos WHERE pontos < 0"
-        )
+# --- Motor de relatórios de admin ---
+# Relatórios nomeados: pedidos simultâneos do mesmo relatório (com os mesmos
+# argumentos) compartilham uma única execução, e o resultado fica em cache por
+# RELATORIO_TTL_SEG. Passar "atualizar" no comando força uma nova execução.
+RELATORIO_TTL_SEG = float(os.getenv("RELATORIO_TTL_SEG", "30"))
+FLAG_ATUALIZAR = "atualizar"
+_SEM_VALOR = object()
+
+
+class MotorRelatorios:
+    def __init__(self, ttl: float):
+        self._geradores = {}
+        self._cache = CacheTTL(max_itens=128, ttl=ttl)
+        self._em_andamento: dict[tuple, asyncio.Task] = {}
+        self._geracoes: dict[tuple, int] = {}
+
+    def relatorio(self, nome: str):
+        """Decorador que registra `async def gerador(*args)` sob `nome`."""
+        def registrar(gerador):
+            if nome in self._geradores:
+                raise ValueError(f"Relatório '{nome}' registrado duas vezes")
+            self._geradores[nome] = gerador
+            return gerador
+        return registrar
+
+    async def obter(self, nome: str, *args, forcar: bool = False):
+        chave = (nome, *args)
+        if forcar:
+            # nunca reaproveita uma execução que começou antes deste pedido
+            self._invalidar_chave(chave)
+        else:
+            valor = self._cache.obter(chave, _SEM_VALOR)
+            if valor is not _SEM_VALOR:
+                return valor
+
+        tarefa = self._em_andamento.get(chave)
+        if tarefa is None:
+            geracao = self._geracoes.get(chave, 0)
+            tarefa = asyncio.create_task(self._gerar(chave, nome, args, geracao))
+            self._em_andamento[chave] = tarefa
+        # shield: se um dos admins desistir, a execução segue para os outros
+        return await asyncio.shield(tarefa)
+
+    async def _gerar(self, chave: tuple, nome: str, args: tuple, geracao: int):
+        try:
+            valor = await self._geradores[nome](*args)
+            # se houve escrita (invalidar) durante a leitura, o valor já nasceu velho
+            if self._geracoes.get(chave, 0) == geracao:
+                self._cache.definir(chave, valor)
+            return valor
+        finally:
+            if self._em_andamento.get(chave) is asyncio.current_task():
+                del self._em_andamento[chave]
 
-        # === HOJE ===
+    def _invalidar_chave(self, chave: tuple):
+        self._geracoes[chave] = self._geracoes.get(chave, 0) + 1
+        self._cache.remover(chave)
+        self._em_andamento.pop(chave, None)
 
-        # Novos usuários cadastrados hoje (DATE(inserido_em) = hoje)
-        inseridos_hoje = await pool.fetchval(
-            "SELECT COUNT(*) FROM usuarios WHERE DATE(inserido_em) = $1",
-            hoje
-        )
+    def invalidar(self, nome: str, *args):
+        """Chamar depois de toda escrita que muda o relatório."""
+        self._invalidar_chave((nome, *args))
 
-        # Usuários que interagiram (pontuados) hoje
-        interagiram_hoje = await pool.fetchval(
-            """
-            SELECT COUNT(DISTINCT user_id)
-              FROM historico_pontos
-             WHERE pontos > 0
-               AND DATE(data) = $1
-            """,
-            hoje
-        )
 
-        # Usuários que atingiram nível hoje
-        #   -> Para cada user_id com soma positiva hoje, checar se cruzou um limiar de NIVEIS_BRINDES
-        rows_dia = await pool.fetch(
-            """
-            SELECT user_id, SUM(pontos) AS soma_dia
-              FROM historico_pontos
-             WHERE pontos > 0
-               AND DATE(data) = $1
-          GROUP BY user_id
-            """,
-            hoje
-        )
+relatorios = MotorRelatorios(RELATORIO_TTL_SEG)
 
-        niveis = sorted(NIVEIS_BRINDES.keys())  # [200, 300, 500, 750, 1000]
-        usuarios_nivel_hoje = 0
 
-        for rec in rows_dia:
-            uid = rec["user_id"]
-            soma_dia = rec["soma_dia"] or 0
+def separar_flag_atualizar(args: list[str] | None) -> tuple[list[str], bool]:
+    """Tira o "atualizar" dos argumentos do comando e diz se ele estava lá."""
+    args = list(args or [])
+    forcar = FLAG_ATUALIZAR in (a.lower() for a in args)
+    return [a for a in args if a.lower() != FLAG_ATUALIZAR], forcar
 
-            soma_antes = await pool.fetchval(
-                """
-                SELECT COALESCE(SUM(pontos), 0)
-                  FROM historico_pontos
-                 WHERE user_id = $1
-                   AND DATE(data) < $2
-                """,
-                uid,
-                hoje
-            )
 
-            total_hoje = soma_antes + soma_dia
+# Totais de todo o período e do dia pedido, lidos do rollup stats_diarias
+consultas.registrar("estatisticas", """
+    SELECT COALESCE(SUM(novos_usuarios), 0)      AS total_usuarios,
+           (SELECT COUNT(*) FROM stats_nivel_maximo WHERE nivel > 0) AS usuarios_nivel_total,
+           COALESCE(SUM(pontos_distribuidos), 0) AS pontos_distribuidos_total,
+           COALESCE(SUM(pontos_removidos), 0)    AS pontos_removidos_total,
+           COALESCE(SUM(novos_usuarios)      FILTER (WHERE dia = $1), 0) AS inseridos_dia,
+           COALESCE(SUM(usuarios_ativos)     FILTER (WHERE dia = $1), 0) AS interagiram_dia,
+           COALESCE(SUM(niveis_atingidos)    FILTER (WHERE dia = $1), 0) AS niveis_dia,
+           COALESCE(SUM(pontos_distribuidos) FILTER (WHERE dia = $1), 0) AS distribuidos_dia,
+           COALESCE(SUM(pontos_removidos)    FILTER (WHERE dia = $1), 0) AS removidos_dia
+      FROM stats_diarias
+""")
 
-            # Verifica se cruzou algum limiar hoje
-            cruzou = any(soma_antes < limiar <= total_hoje for limiar in niveis)
-            if cruzou:
-                usuarios_nivel_hoje += 1
 
-        # Total de pontos distribuídos hoje (soma de pontos positivos)
-        pontos_distribuidos_hoje = await pool.fetchval(
-            """
-            SELECT COALESCE(SUM(pontos), 0)
-              FROM historico_pontos
-             WHERE pontos > 0
-               AND DATE(data) = $1
-            """,
-            hoje
-        )
+@relatorios.relatorio("estatisticas")
+async def relatorio_estatisticas(dia: date):
+    return await consultas.fetchrow("estatisticas", dia)
 
-        # Total de pontos removidos hoje (soma absoluta de pontos negativos)
-        pontos_removidos_hoje = await pool.fetchval(
-            """
-            SELECT COALESCE(SUM(ABS(pontos)), 0)
-              FROM historico_pontos
-             WHERE pontos < 0
-               AND DATE(data) = $1
-            """,
-            hoje
-        )
 
+async def estatisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Comando que exibe estatísticas agregadas “no tempo t odo” e de um dia
+    (hoje, ou a data passada em /estatisticas <dd/mm/aaaa>):
+
+    ➤ No tempo t odo (All time):
+      1. Total de usuários cadastrados
+      2. Usuários que já atingiram algum nível (stats_nivel_maximo), mesmo que
+         tenham resgatado os pontos depois
+      3. Total de pontos distribuídos
+      4. Total de pontos removidos
+
+    ➤ No dia:
+      1. Novos usuários cadastrados
+      2. Usuários que interagiram (pontuados)
+      3. Usuários que atingiram nível
+      4. Total de pontos distribuídos
+      5. Total de pontos removidos
+
+    Tudo vem da tabela stats_diarias, mantida pelos triggers da migração 5.
+    """
+    hoje = hoje_data_sp()  # data de hoje em America/Sao_Paulo
+    args, forcar = separar_flag_atualizar(context.args)
+    if args:
+        try:
+            dia = datetime.strptime(args[0], "%d/%m/%Y").date()
+        except ValueError:
+            await update.message.reply_text("Uso: /estatisticas [dd/mm/aaaa] [atualizar]")
+            return
+    else:
+        dia = hoje
+
+    try:
+        r = await relatorios.obter("estatisticas", dia, forcar=forcar)
+
+        quando = "hoje" if dia == hoje else "no dia"
         # Monta mensagem final
         texto = (
             "📊 *Estatísticas de Usuários*\n\n"
             "*No tempo todo:*\n"
-            f"• Total de usuários cadastrados: *{total_usuarios}*\n"
-            f"• Usuários que já atingiram nível: *{usuarios_nivel_total}*\n"
-            f"• Total de pontos distribuídos: *{pontos_distribuidos_total}*\n"
-            f"• Total de pontos removidos: *{pontos_removidos_total}*\n\n"
-            "*Hoje \\({hoje_str}\\):*\n"
-            f"• Novos usuários cadastrados: *{inseridos_hoje}*\n"
-            f"• Usuários que interagiram hoje: *{interagiram_hoje}*\n"
-            f"• Usuários que atingiram nível hoje: *{usuarios_nivel_hoje}*\n"
-            f"• Pontos distribuídos hoje: *{pontos_distribuidos_hoje}*\n"
-            f"• Pontos removidos hoje: *{pontos_removidos_hoje}*"
-        ).replace("{hoje_str}", hoje.strftime("%d/%m/%Y"))
+            f"• Total de usuários cadastrados: *{r['total_usuarios']}*\n"
+            f"• Usuários que já atingiram nível: *{r['usuarios_nivel_total']}*\n"
+            f"• Total de pontos distribuídos: *{r['pontos_distribuidos_total']}*\n"
+            f"• Total de pontos removidos: *{r['pontos_removidos_total']}*\n\n"
+            f"*{'Hoje' if dia == hoje else 'Dia'} \\({dia.strftime('%d/%m/%Y')}\\):*\n"
+            f"• Novos usuários cadastrados: *{r['inseridos_dia']}*\n"
+            f"• Usuários que interagiram {quando}: *{r['interagiram_dia']}*\n"
+            f"• Usuários que atingiram nível {quando}: *{r['niveis_dia']}*\n"
+            f"• Pontos distribuídos {quando}: *{r['distribuidos_dia']}*\n"
+            f"• Pontos removidos {quando}: *{r['removidos_dia']}*"
+        )
 
         await update.message.reply_text(texto, parse_mode="MarkdownV2")
 
@@ -1765,6 +3846,19 @@ async def estatisticas(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Não foi possível gerar as estatísticas no momento")
 
 
+async def consultas_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        await update.message.reply_text("🔒 Você precisa autenticar: use /admin primeiro.")
+        return
+
+    linhas = ["📈 <b>Consultas SQL</b> (chamadas — total — média)\n"]
+    for nome, chamadas, total in consultas.estatisticas():
+        media_ms = (total / chamadas * 1000) if chamadas else 0
+        linhas.append(f"<code>{nome}</code>: {chamadas} — {total * 1000:.0f} ms — {media_ms:.2f} ms")
+
+    await update.message.reply_text("\n".join(linhas), parse_mode=ParseMode.HTML)
+
+
 async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     if user_id not in ADMINS:
@@ -1821,19 +3915,103 @@ async def cmd_backup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await update.message.reply_document(document=InputFile(caminho), filename=nome)
 
 
+# --- Exportação em CSV (COPY TO STDOUT) ---
+# tabela -> coluna de data usada nos filtros [desde] [ate]
+TABELAS_EXPORTAVEIS = {
+    "historico_pontos": "data",
+    "usuarios": "inserido_em",
+    "usuario_history": "inserido_em",
+    "movimentacoes_globais": "criado_em",
+}
+LIMITE_DOCUMENTO_BOT = 50 * 1024 * 1024  # limite de upload da Bot API
+EXPORTACAO_BLOCO = 1024 * 1024  # bytes de CSV juntados antes de cada compressão
+
+
+async def exportar_csv_gz(tabela: str, desde: date | None, ate: date | None, destino) -> None:
+    """
+    Faz o COPY da tabela (filtrada por dia em SP, `ate` inclusivo) direto para um
+    gzip em `destino`, pedaço a pedaço, sem montar registros em Python. A
+    compressão e a escrita no arquivo rodam numa thread, em blocos de
+    EXPORTACAO_BLOCO, para não travar o event loop em tabelas grandes.
+    """
+    coluna = TABELAS_EXPORTAVEIS[tabela]
+    condicoes, params = [], []
+    if desde:
+        params.append(intervalo_dia_sp(desde)[0])
+        condicoes.append(f"{coluna} >= ${len(params)}")
+    if ate:
+        params.append(intervalo_dia_sp(ate)[1])
+        condicoes.append(f"{coluna} < ${len(params)}")
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+
+    buffer = bytearray()
+    with gzip.GzipFile(fileobj=destino, mode="wb") as gz:
+        async def escrever(pedaco: bytes):
+            buffer.extend(pedaco)
+            if len(buffer) >= EXPORTACAO_BLOCO:
+                bloco = bytes(buffer)
+                buffer.clear()
+                # o COPY espera este await: só um bloco por vez no GzipFile
+                await asyncio.to_thread(gz.write, bloco)
+
+        async with pool.acquire() as conn:
+            await conn.copy_from_query(
+                f"SELECT * FROM {tabela} {where} ORDER BY {coluna}",
+                *params,
+                output=escrever,
+                format="csv",
+                header=True
+            )
+        if buffer:
+            await asyncio.to_thread(gz.write, bytes(buffer))
+
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/exportar <tabela> [desde dd/mm/aaaa] [ate dd/mm/aaaa] — envia a tabela como .csv.gz"""
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("🚫 Você não tem permissão.")
+
+    args = context.args or []
+    if not args or args[0] not in TABELAS_EXPORTAVEIS or len(args) > 3:
+        return await update.message.reply_text(
+            "Uso: /exportar <tabela> [desde dd/mm/aaaa] [ate dd/mm/aaaa]\n"
+            "Tabelas: " + ", ".join(TABELAS_EXPORTAVEIS)
+        )
+    tabela = args[0]
+    try:
+        desde, ate = (
+            [datetime.strptime(a, "%d/%m/%Y").date() for a in args[1:]] + [None, None]
+        )[:2]
+    except ValueError:
+        return await update.message.reply_text("❌ Data inválida. Use dd/mm/aaaa.")
+
+    await update.message.reply_text("🔄 Exportando... aguarde.")
+    nome = f"{tabela}_{hoje_hora_sp():%Y%m%d_%H%M%S}.csv.gz"
+    with tempfile.TemporaryFile() as arquivo:
+        try:
+            await exportar_csv_gz(tabela, desde, ate, arquivo)
+        except Exception as e:
+            logger.error(f"[exportar] Falha ao exportar {tabela}: {e}")
+            return await update.message.reply_text("❌ Erro ao exportar. Veja os logs do servidor.")
+
+        tamanho = arquivo.tell()
+        if tamanho >= LIMITE_DOCUMENTO_BOT:
+            return await update.message.reply_text(
+                f"⚠️ O arquivo ficou com {tamanho / 1024 / 1024:.1f} MB, acima do limite do Telegram. "
+                "Use um intervalo de datas menor."
+            )
+        arquivo.seek(0)
+        await update.message.reply_document(document=arquivo, filename=nome)
+    logger.info(f"[exportar] Admin {update.effective_user.id} exportou {tabela} ({tamanho} bytes)")
+
+
 async def ativar_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await pool.execute(
-        "INSERT INTO config_checkin (chave, valor) VALUES ('adicionar_pontos', 'true') "
-        "ON CONFLICT (chave) DO UPDATE SET valor = 'true'"
-    )
+    await salvar_config("adicionar_pontos", "true")
     await update.message.reply_text("✅ Check-in ativado. Usuários agora ganham pontos.")
 
 
 async def desativar_checkin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await pool.execute(
-        "INSERT INTO config_checkin (chave, valor) VALUES ('adicionar_pontos', 'false') "
-        "ON CONFLICT (chave) DO UPDATE SET valor = 'false'"
-    )
+    await salvar_config("adicionar_pontos", "false")
     await update.message.reply_text("❌ Check-in desativado. Nenhum usuário ganhará pontos.")
 
 
@@ -1996,6 +4174,7 @@ async def confirmar_sorteio(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Limpa tentativas e ganhadores anteriores
     await context.bot_data["pool"].execute("DELETE FROM sorteio_tentativas")
     await context.bot_data["pool"].execute("DELETE FROM sorteio_ganhadores")
+    relatorios.invalidar("sort_status")
 
     await query.edit_message_text("✅ Sorteio configurado com sucesso!")
     return ConversationHandler.END
@@ -2013,6 +4192,7 @@ async def cancelar_sort(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot_data["pool"].execute(
         "DELETE FROM sorteio_ganhadores WHERE event_id = (SELECT id FROM sorteio_config ORDER BY criado_em DESC LIMIT 1)"
     )
+    relatorios.invalidar("sort_status")
     # Notifica o admin
     await update.message.reply_text("❌ Sorteio vigente cancelado e dados limpos. Pronto para nova configuração.")
 
@@ -2087,6 +4267,7 @@ async def sortear(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "UPDATE sorteio_config SET tentativa_atual = $1 WHERE id = $2",
         tentativa_atual, evento["id"]
     )
+    relatorios.invalidar("sort_status")
 
     # Verifica se acertou o número esperado
     if tentativa_atual == evento["numero_esperado_atual"]:
@@ -2099,6 +4280,7 @@ async def sortear(update: Update, context: ContextTypes.DEFAULT_TYPE):
             random.randint(1, evento["total_participantes_esperados"]),
             evento["id"]
         )
+        relatorios.invalidar("sort_status")
 
         # Nome do usuário com fallback
         if user.username:
@@ -2161,11 +4343,13 @@ async def liberar_ganhadores(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return await update.message.reply_text("❌ Apenas administradores podem usar este comando.")
 
     await context.bot_data["pool"].execute("DELETE FROM sorteio_bloqueados")
+    relatorios.invalidar("sort_status")
     await update.message.reply_text("✅ Todos os ganhadores foram liberados para participar novamente.")
 
 
-async def sort_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    estado = await context.bot_data["pool"].fetchrow(
+@relatorios.relatorio("sort_status")
+async def relatorio_sort_status():
+    return await pool.fetchrow(
         """
         SELECT premios_restantes, tentativa_atual, numero_esperado_atual
           FROM sorteio_config
@@ -2174,6 +4358,11 @@ async def sort_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
          LIMIT 1
         """
     )
+
+
+async def sort_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _, forcar = separar_flag_atualizar(context.args)
+    estado = await relatorios.obter("sort_status", forcar=forcar)
     if not estado:
         return await update.message.reply_text("❌ Nenhum sorteio ativo.")
     await update.message.reply_text(
@@ -2208,39 +4397,66 @@ PAGE_SIZE_RANKING = 50
 
 async def listar_pontuadores(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1) Determina a página (default = 1)
+    # Botões mandam context.args = [página, 'a'|'p', pontos, user_id] (cursor da borda)
     args = context.args or []
     try:
         page = int(args[0]) if args else 1
+        cursor = (args[1], int(args[2]), int(args[3])) if len(args) >= 4 else None
     except ValueError:
         await update.message.reply_text("❌ Página inválida. Use /ranking <número>.")
         return
     if page < 1:
         page = 1
 
-    # 2) Conta só quem tem ≥X pontos ➡️
-    total_usuarios = await pool.fetchval(
+    # 2) Conta só quem tem ≥X pontos ➡️ (cacheado por alguns minutos)
+    total_usuarios = await contagem_cacheada(
+        "count:pontuadores",
         "SELECT COUNT(*) FROM usuarios WHERE pontos >= $1",
         200
     )
     total_paginas = max(1, math.ceil(total_usuarios / PAGE_SIZE_RANKING))
-    if page > total_paginas:
+    if cursor is None and page > total_paginas:
         await update.message.reply_text(
             f"ℹ️ A página {page} não existe. Só há {total_paginas} páginas."
         )
         return
 
-    # 3) Busca a página atual, do maior para o menor ➡️
+    # 3) Busca a página atual, do maior para o menor, em ordem estável (pontos, user_id) ➡️
     offset = (page - 1) * PAGE_SIZE_RANKING
-    rows = await pool.fetch(
-        """
-        SELECT user_id, pontos, display_choice, first_name, nickname
-        FROM usuarios
-        WHERE pontos >= $1
-        ORDER BY pontos DESC
-        LIMIT $2 OFFSET $3
-        """,
-        100, PAGE_SIZE_RANKING, offset
-    )
+    colunas = "SELECT user_id, pontos, display_choice, first_name, nickname FROM usuarios"
+    if cursor is None:
+        rows = await pool.fetch(
+            f"""
+            {colunas}
+            WHERE pontos >= $1
+            ORDER BY pontos DESC, user_id DESC
+            LIMIT $2 OFFSET $3
+            """,
+            100, PAGE_SIZE_RANKING + 1, offset
+        )
+    elif cursor[0] == "p":
+        rows = await pool.fetch(
+            f"""
+            {colunas}
+            WHERE pontos >= $1 AND (pontos, user_id) < ($2, $3)
+            ORDER BY pontos DESC, user_id DESC
+            LIMIT $4
+            """,
+            100, cursor[1], cursor[2], PAGE_SIZE_RANKING + 1
+        )
+    else:
+        rows = await pool.fetch(
+            f"""
+            {colunas}
+            WHERE pontos >= $1 AND (pontos, user_id) > ($2, $3)
+            ORDER BY pontos ASC, user_id ASC
+            LIMIT $4
+            """,
+            100, cursor[1], cursor[2], PAGE_SIZE_RANKING
+        )
+        rows = list(reversed(rows))
+    tem_proxima = (cursor is not None and cursor[0] == "a") or len(rows) > PAGE_SIZE_RANKING
+    rows = rows[:PAGE_SIZE_RANKING]
 
     # 4) Monta o texto mostrando o display escolhido em /start
     lines = []
@@ -2264,10 +4480,18 @@ async def listar_pontuadores(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # 5) Botões de navegação
     buttons = []
-    if page > 1:
-        buttons.append(InlineKeyboardButton("◀️ Anterior", callback_data=f"ranking|{page - 1}"))
-    if page < total_paginas:
-        buttons.append(InlineKeyboardButton("Próximo ▶️", callback_data=f"ranking|{page + 1}"))
+    if rows and page > 1:
+        primeiro = rows[0]
+        buttons.append(InlineKeyboardButton(
+            "◀️ Anterior",
+            callback_data=f"ranking|{page - 1}|a|{primeiro['pontos']}|{primeiro['user_id']}"
+        ))
+    if rows and tem_proxima:
+        ultimo = rows[-1]
+        buttons.append(InlineKeyboardButton(
+            "Próximo ▶️",
+            callback_data=f"ranking|{page + 1}|p|{ultimo['pontos']}|{ultimo['user_id']}"
+        ))
     reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
 
     # 6) Envia ou edita mensagem
@@ -2285,9 +4509,8 @@ async def listar_pontuadores(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # Callback para tratar os cliques
 async def callback_listar_ranking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.callback_query.answer()  # para parar o spinner
-    # Extrai a nova página de "ranking|<n>"
-    _, nova_pagina = update.callback_query.data.split("|")
-    context.args = [nova_pagina]
+    # Extrai página e cursor de "ranking|<n>|<a|p>|<pontos>|<user_id>"
+    context.args = update.callback_query.data.split("|")[1:]
     await listar_pontuadores(update, context)
 
 
@@ -2302,10 +4525,11 @@ ADMIN_CHANNEL_ID = -1002681288915  # coloque aqui o chat_id do canal/admin
 async def resgatar(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = user.id
+    perfil_req = PerfilRequisicao(user)
 
     # 1️⃣ Se for chat privado, valida perfil completo (start feito) ⬅️
     if update.effective_chat.type == "private":
-        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot)
+        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot, perfil_req)
         if invalido:
             await update.message.reply_text(msg)
             return
@@ -2318,30 +4542,18 @@ async def resgatar(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         # 3️⃣ (Opcional) Garante que exista usuário e processa check-in ⬅️
-        perfil = await obter_ou_criar_usuario_db(
-            user_id=user_id,
-            username=user.username or "vazio",
-            first_name=user.first_name or "vazio",
-            last_name=user.last_name or "vazio",
-            via_start=False
-        )
-        await processar_presenca_diaria(perfil, context.bot)
+        perfil = await perfil_req.obter_ou_criar()
+        await processar_presenca_diaria(perfil, context.bot, perfil_req)
 
-        existe_na_wallet = await pool.fetchval(
-            "SELECT 1 FROM wallet WHERE user_id = $1",
-            user_id
-        )
+        existe_na_wallet = await consultas.fetchval("existe_wallet", user_id)
         if existe_na_wallet:
             await update.message.reply_text(
                 "⚠️ Você já enviou seus créditos para a carteira e não pode resgatar de novo. acesse /wallet pra ver seu saldo"
             )
             return
 
-        # 4️⃣ Busca pontos atuais ⬅️
-        pontos = await pool.fetchval(
-            "SELECT pontos FROM usuarios WHERE user_id = $1",
-            user_id
-        )
+        # 4️⃣ Pontos atuais (já atualizados pelo check-in) ⬅️
+        pontos = (await perfil_req.obter())["pontos"]
 
         # 5️⃣ Determina qual brinde (faixa) atingiu ⬅️
         validos = [n for n in NIVEIS_BRINDES.keys() if n <= pontos]
@@ -2388,7 +4600,7 @@ async def iniciar_resgatar_codigo(update: Update, context: ContextTypes.DEFAULT_
 
     # só permite envio de código se tiver ≥1 crédito na carteira
     user_id = update.effective_user.id
-    saldo = await pool.fetchval("SELECT saldo FROM wallet WHERE user_id = $1", user_id) or 0
+    saldo = await consultas.fetchval("saldo_wallet", user_id) or 0
     if saldo < 1:
         await update.callback_query.edit_message_text(
             "❌ Créditos insuficientes para usar agora. Você pode mover para a carteira e acumular mais.")
@@ -2486,7 +4698,8 @@ async def confirmar_codigo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "ON CONFLICT(user_id) DO UPDATE SET saldo=wallet.saldo+EXCLUDED.saldo, atualizado=NOW()",
             uid, cred
         )
-        await pool.execute("UPDATE usuarios SET pontos=0 WHERE user_id=$1", uid)
+        await consultas.execute("zerar_pontos", uid)
+        registrar_pontos(uid, 0)
         # 3️⃣ histórico pessoal
         await pool.execute(
             """
@@ -2581,8 +4794,9 @@ async def enviar_carteira(update: Update, context: ContextTypes.DEFAULT_TYPE):
         target = update.message
 
     # 1️⃣ Valida perfil e canal
+    perfil_req = PerfilRequisicao(user)
     if update.effective_chat.type == "private":
-        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot)
+        invalido, msg = await perfil_invalido_ou_nao_inscrito(user_id, context.bot, perfil_req)
         if invalido:
             await target.reply_text(msg)
             return
@@ -2592,19 +4806,14 @@ async def enviar_carteira(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # 2️⃣ Verifica se já existe registro
-    existente = await pool.fetchval(
-        "SELECT 1 FROM wallet WHERE user_id = $1",
-        user_id
-    )
+    existente = await consultas.fetchval("existe_wallet", user_id)
     if existente:
         await target.reply_text("⚠️ Você já enviou seus créditos para a carteira e não pode reenviar.")
         return
 
     # 3️⃣ Busca pontos e calcula créditos
-    pontos = await pool.fetchval(
-        "SELECT pontos FROM usuarios WHERE user_id = $1",
-        user_id
-    )
+    perfil = await perfil_req.obter()
+    pontos = perfil["pontos"] if perfil else 0
     validos = [n for n in NIVEIS_BRINDES.keys() if n <= pontos]
     nivel = max(validos) if validos else 0
     _, creditos = NIVEIS_BRINDES.get(nivel, ("", 0))
@@ -2614,7 +4823,8 @@ async def enviar_carteira(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "INSERT INTO wallet (user_id, saldo) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
         user_id, creditos
     )
-    await pool.execute("UPDATE usuarios SET pontos = 0 WHERE user_id = $1", user_id)
+    await consultas.execute("zerar_pontos", user_id)
+    registrar_pontos(user_id, 0)
 
     # 5️⃣ Histórico pessoal
     await pool.execute(
@@ -2661,10 +4871,7 @@ async def wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # 2️⃣ Busca o saldo na wallet
-    row = await pool.fetchrow(
-        "SELECT saldo, atualizado FROM wallet WHERE user_id = $1",
-        user_id
-    )
+    row = await consultas.fetchrow("wallet_usuario", user_id)
     # ⬇️ Se não existir registro ou saldo zero:
     if not row or row["saldo"] <= 0:
         await update.message.reply_text(
@@ -2693,7 +4900,7 @@ async def iniciar_utilizar_wallet(update: Update, context: ContextTypes.DEFAULT_
     await update.callback_query.answer()
     user_id = update.effective_user.id
     # Valida saldo mínimo na carteira antes de permitir uso
-    saldo = await pool.fetchval("SELECT saldo FROM wallet WHERE user_id = $1", user_id) or 0
+    saldo = await consultas.fetchval("saldo_wallet", user_id) or 0
 
     if saldo < 1:
         await update.callback_query.edit_message_text(
@@ -2708,6 +4915,14 @@ async def iniciar_utilizar_wallet(update: Update, context: ContextTypes.DEFAULT_
     return DIGITANDO_WALLET  # passa para o estado de receber o código
 
 
+consultas.registrar("fila_inserir", """
+    INSERT INTO fila_pagamento (user_id, code, created_em)
+    SELECT $1, $2, NOW()
+    WHERE NOT EXISTS (SELECT 1 FROM fila_pagamento WHERE user_id = $1)
+    RETURNING id
+""")
+
+
 # ─── Recebe o código de uso da carteira ───
 async def receber_codigo_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
@@ -2731,15 +4946,8 @@ async def receber_codigo_wallet(update: Update, context: ContextTypes.DEFAULT_TY
 
     # INSERÇÃO ATÔMICA: só insere se NÃO existir pedido pendente para este user
     try:
-        row_id = await pool.fetchval(
-            """
-            INSERT INTO fila_pagamento (user_id, code, created_em)
-            SELECT $1, $2, NOW()
-            WHERE NOT EXISTS (SELECT 1 FROM fila_pagamento WHERE user_id = $1)
-            RETURNING id
-            """,
-            uid, codigo
-        )
+        row_id = await consultas.fetchval("fila_inserir", uid, codigo)
+        relatorios.invalidar("pay_fila")
     except Exception:
         logger.exception("Erro ao inserir na fila_pagamento")
         await update.message.reply_text("❌ Erro ao registrar pedido. Tente novamente mais tarde.")
@@ -2834,54 +5042,155 @@ async def ver_historico_wallet(update: Update, context: ContextTypes.DEFAULT_TYP
     )
 
 
-async def timeline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Só admins
-    if update.effective_user.id not in ADMINS:
-        return await update.message.reply_text("🚫 Você não tem permissão.")
+# --- Timeline (movimentacoes_globais) ---
+# Filtros ficam em user_data["timeline_filtros"]; os botões levam só o cursor
+# (criado_em, id) da borda: "tl:<a|p>:<criado_em em µs>:<id>".
+TIMELINE_POR_PAGINA = 25
+AJUDA_TIMELINE = (
+    "Uso: /timeline [evento=<nome>] [usuario=<user_id>] "
+    "[desde=dd/mm/aaaa] [ate=dd/mm/aaaa] [atualizar]"
+)
 
-    rows = await pool.fetch(
-        """
-        SELECT usuario_id, evento, detalhes, criado_em
+
+def ler_filtros_timeline(args: list[str]) -> tuple:
+    """Converte "chave=valor" em (evento, usuario_id, desde, ate). ValueError se inválido."""
+    filtros = {"evento": None, "usuario": None, "desde": None, "ate": None}
+    for arg in args:
+        chave, sep, valor = arg.partition("=")
+        chave = chave.lower()
+        if not sep or chave not in filtros or not valor:
+            raise ValueError(arg)
+        if chave == "usuario":
+            filtros[chave] = int(valor)
+        elif chave in ("desde", "ate"):
+            filtros[chave] = datetime.strptime(valor, "%d/%m/%Y").date()
+        else:
+            filtros[chave] = valor
+    return filtros["evento"], filtros["usuario"], filtros["desde"], filtros["ate"]
+
+
+@relatorios.relatorio("timeline")
+async def relatorio_timeline(filtros: tuple, cursor: tuple | None):
+    evento, usuario_id, desde, ate = filtros
+    condicoes, params = [], []
+    if evento:
+        params.append(evento)
+        condicoes.append(f"evento = ${len(params)}")
+    if usuario_id:
+        params.append(usuario_id)
+        condicoes.append(f"usuario_id = ${len(params)}")
+    if desde:
+        params.append(intervalo_dia_sp(desde)[0])
+        condicoes.append(f"criado_em >= ${len(params)}")
+    if ate:
+        params.append(intervalo_dia_sp(ate)[1])
+        condicoes.append(f"criado_em < ${len(params)}")
+
+    ordem = "DESC"
+    if cursor is not None:
+        direcao, micros, id_cursor = cursor
+        params += [cursor_para_ts(micros), id_cursor]
+        comparador = "<" if direcao == "p" else ">"
+        condicoes.append(f"(criado_em, id) {comparador} (${len(params) - 1}, ${len(params)})")
+        if direcao == "a":
+            ordem = "ASC"
+    params.append(TIMELINE_POR_PAGINA + 1)
+
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    return await pool.fetch(
+        f"""
+        SELECT id, usuario_id, nome_usuario, evento, detalhes, criado_em
           FROM movimentacoes_globais
-         ORDER BY criado_em DESC
-         LIMIT 50
-        """
+         {where}
+         ORDER BY criado_em {ordem}, id {ordem}
+         LIMIT ${len(params)}
+        """,
+        *params
     )
-    if not rows:
-        return await update.message.reply_text("🗒️ Sem registros ainda.")
 
-    texto = "🕒 *Linha do Tempo de Atividades* (ultimas 50)\n\n"
+
+async def enviar_timeline(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                          cursor: tuple | None = None, forcar: bool = False):
+    filtros = context.user_data.get("timeline_filtros", (None, None, None, None))
+    rows = list(await relatorios.obter("timeline", filtros, cursor, forcar=forcar))
+
+    # Uma linha a mais indica que há página seguinte na direção pedida
+    mais_na_direcao = len(rows) > TIMELINE_POR_PAGINA
+    rows = rows[:TIMELINE_POR_PAGINA]
+    if cursor is not None and cursor[0] == "a":
+        rows.reverse()
+        tem_recentes, tem_antigas = mais_na_direcao, True
+    else:
+        tem_recentes, tem_antigas = cursor is not None, mais_na_direcao
+
+    linhas = []
     for r in rows:
-        ts = r["criado_em"].astimezone(ZoneInfo("America/Sao_Paulo")) \
-            .strftime("%d/%m %H:%M")
-        uid = r["usuario_id"]
-        nome = (
-                r.get("username")
-                or r.get("first_name")
-                or r.get("last_name")
-                or "sem nome"
-        )
-        evt = r["evento"].replace("_", " ").title()
-        det = json.loads(r["detalhes"])  # <-- CONVERTE JSON string para dict
+        ts = format_dt_sp(r["criado_em"], "%d/%m %H:%M")
+        nome = html.escape(r["nome_usuario"] or "sem nome")
+        evt = html.escape(r["evento"].replace("_", " ").title())
+        det = r["detalhes"]  # já vem como dict (codec jsonb do pool)
 
         # Ex: detalhar créditos ou motivo
         extra = ""
         if 'creditos' in det:
             extra = f" — {det['creditos']} créditos"
         if 'descricao' in det:
-            extra += f" ({det['descricao']})"
+            extra += f" ({html.escape(str(det['descricao']))})"
+
+        linhas.append(f"📆 <code>{ts}</code> — Usuário <code>{r['usuario_id']}</code> ({nome}): <b>{evt}</b>{extra}")
+
+    botoes = []
+    if rows and tem_recentes:
+        primeiro = rows[0]
+        botoes.append(InlineKeyboardButton(
+            "◀️ Mais recentes",
+            callback_data=f"tl:a:{ts_para_cursor(primeiro['criado_em'])}:{primeiro['id']}"
+        ))
+    if rows and tem_antigas:
+        ultimo = rows[-1]
+        botoes.append(InlineKeyboardButton(
+            "Mais antigas ▶️",
+            callback_data=f"tl:p:{ts_para_cursor(ultimo['criado_em'])}:{ultimo['id']}"
+        ))
+
+    if rows:
+        paginas = paginar(linhas, "🕒 <b>Linha do Tempo de Atividades</b>\n\n", ParseMode.HTML)
+    else:
+        paginas = ["🗒️ Sem registros para esses filtros."]
+    await enviar_paginas(
+        update, paginas, ParseMode.HTML,
+        botoes_extra=botoes or None, editar=update.callback_query is not None
+    )
+
+
+async def timeline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Só admins
+    if update.effective_user.id not in ADMINS:
+        return await update.message.reply_text("🚫 Você não tem permissão.")
+
+    args, forcar = separar_flag_atualizar(context.args)
+    try:
+        context.user_data["timeline_filtros"] = ler_filtros_timeline(args)
+    except ValueError:
+        return await update.message.reply_text(AJUDA_TIMELINE)
+    await enviar_timeline(update, context, forcar=forcar)
 
-        texto += f"📆 `{ts}` — Usuário `{uid}` ({nome}): *{evt}*{extra}\n"
 
-    await update.message.reply_text(texto, parse_mode=ParseMode.MARKDOWN)
+async def callback_timeline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id not in ADMINS:
+        return
+    _, direcao, micros, id_cursor = query.data.split(":")
+    await enviar_timeline(update, context, cursor=(direcao, int(micros), int(id_cursor)))
 
 
 PAY_CODIGO, PAY_VALOR, PAY_CONFIRM_REMOVE = range(3)
 
 
-async def pay_fila(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Lista todos os pedidos na fila por ordem de chegada."""
-    rows = await pool.fetch(
+@relatorios.relatorio("pay_fila")
+async def relatorio_pay_fila():
+    return await pool.fetch(
         """
         SELECT
             f.id,
@@ -2897,12 +5206,17 @@ async def pay_fila(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ORDER BY f.created_em
         """
     )
+
+
+async def pay_fila(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lista todos os pedidos na fila por ordem de chegada."""
+    _, forcar = separar_flag_atualizar(context.args)
+    rows = await relatorios.obter("pay_fila", forcar=forcar)
     if not rows:
         await update.message.reply_text("📭 Não há pedidos na fila.")
         return ConversationHandler.END
 
-    texto = "📋 *Fila de Pagamentos:*\n\n"
-
+    linhas = []
     for r in rows:
         ts = r["created_em"].astimezone(ZoneInfo("America/Sao_Paulo")).strftime("%d/%m %H:%M")
 
@@ -2919,12 +5233,12 @@ async def pay_fila(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             display = "sem nome"
 
-        texto += (
+        linhas.append(
             f"• `{r['code']}` — usuário `{r['user_id']}` "
-            f"({display}) — {ts}\n"
+            f"({display}) — {ts}"
         )
 
-    await update.message.reply_text(texto)
+    await enviar_paginas(update, paginar(linhas, "📋 *Fila de Pagamentos:*\n\n"))
     return PAY_CODIGO
 
 
@@ -2937,10 +5251,7 @@ async def start_pay(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def pay_codigo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Recebe o código PIX e identifica o pedido."""
     pix = update.message.text.strip()
-    req = await pool.fetchrow(
-        "SELECT id, user_id FROM fila_pagamento WHERE code = $1",
-        pix
-    )
+    req = await consultas.fetchrow("fila_por_codigo", pix)
     if not req:
         await update.message.reply_text("❌ Código não encontrado.")
         return ConversationHandler.END
@@ -2969,10 +5280,7 @@ async def pay_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = context.user_data["pay_user"]
 
     # saldo atual
-    saldo = await pool.fetchval(
-        "SELECT saldo FROM wallet WHERE user_id = $1",
-        user_id
-    ) or 0.0
+    saldo = await consultas.fetchval("saldo_wallet", user_id) or 0.0
 
     if valor > saldo:
         await update.message.reply_text(
@@ -3007,10 +5315,7 @@ async def pay_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     # log global com casts para texto e numeric
     # busca nome do usuário
-    row = await pool.fetchrow(
-        "SELECT username, first_name, last_name FROM usuarios WHERE user_id = $1",
-        user_id
-    )
+    row = await consultas.fetchrow("nome_usuario", user_id)
     if row:
         display = (
             f"@{row['username']}" if row['username'] and row['username'].strip()
@@ -3039,7 +5344,8 @@ async def pay_valor(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Remove da fila
-    await pool.execute("DELETE FROM fila_pagamento WHERE id = $1", pay_id)
+    await consultas.execute("fila_remover", pay_id)
+    relatorios.invalidar("pay_fila")
 
     # notifica usuário
     await context.bot.send_message(
@@ -3060,10 +5366,8 @@ async def pay_confirm_remove(update: Update, context: ContextTypes.DEFAULT_TYPE)
     resposta = update.message.text.strip().lower()
     if resposta in ("sim", "s"):
         # remove e notifica
-        await pool.execute(
-            "DELETE FROM fila_pagamento WHERE id = $1",
-            context.user_data["pay_id"]
-        )
+        await consultas.execute("fila_remover", context.user_data["pay_id"])
+        relatorios.invalidar("pay_fila")
         await update.message.reply_text("✅ Pedido removido da fila.")
         await context.bot.send_message(
             chat_id=context.user_data["pay_user"],
@@ -3089,6 +5393,7 @@ async def pay_confirm_remove(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def limpar_fila(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Apaga todos os registros
     apagados = await pool.execute("DELETE FROM fila_pagamento")
+    relatorios.invalidar("pay_fila")
 
     # Mensagem de retorno para o admin
     await update.message.reply_text(f"🧹 Fila de pagamentos limpa.\nRegistros apagados: {apagados}")
@@ -3119,11 +5424,17 @@ async def on_startup(app):
     # inicializa o pool
     await init_db_pool()
     app.bot_data["pool"] = pool
+    await checkins_hoje.carregar()
+    await indice_ranking.carregar()
+    await placar_top.carregar()
+    await carregar_mensagens_ranking()
 
     await pool.execute("""
         INSERT INTO config_checkin (chave, valor) VALUES ('adicionar_pontos', 'true')
         ON CONFLICT (chave) DO NOTHING
     """)
+    await carregar_config()
+    await escutar_config()
 
     # Carrega do banco e mescla (sem sobrescrever o que veio do .env)
     existing = await carregar_admins_db()
@@ -3132,7 +5443,7 @@ async def on_startup(app):
     app.bot_data["chat_admin"] = ADMINS
 
     # Busca canal do sorteio no banco e converte para int
-    canal_id_str = await pool.fetchval("SELECT valor FROM config_checkin WHERE chave = 'sorteio_canal_id'")
+    canal_id_str = obter_config("sorteio_canal_id")
     if canal_id_str:
         try:
             canal_id = int(canal_id_str)
@@ -3146,6 +5457,22 @@ async def on_startup(app):
     # 3) (opcional) configure seus comandos globais
     await setup_commands(app)
 
+    agregador_presenca.iniciar()
+    agendar_periodica("reconciliar_rankings", RANKING_RECONCILIAR_SEG, reconciliar_rankings)
+    agendar_periodica("reconciliar_indice_ranking", INDICE_RECONCILIAR_SEG, indice_ranking.carregar)
+    await gerar_snapshots_ranking()
+    agendar_periodica("snapshots_ranking", RANKING_SNAPSHOT_SEG, gerar_snapshots_ranking)
+    await criar_particoes_mensais()
+    agendar_periodica("particoes_mensais", PARTICOES_INTERVALO_SEG, criar_particoes_mensais)
+
+
+async def on_shutdown(app):
+    # grava as presenças que ainda estão em memória
+    await parar_tarefas_periodicas()
+    await agregador_presenca.parar()
+    await publicador_ranking.parar()
+    await parar_escuta_config()
+
 
 main_conv = ConversationHandler(
     entry_points=[
@@ -3202,9 +5529,15 @@ async def main():
         ApplicationBuilder()
         .token(BOT_TOKEN)
         .post_init(on_startup)  # <— aqui, não setup_commands
+        .post_shutdown(on_shutdown)
         .build()
     )
 
+    # Guarda o perfil de quem manda qualquer update (antes dos demais handlers)
+    app.add_handler(TypeHandler(Update, registrar_perfil_update), group=-1)
+
+    app.add_handler(ChatMemberHandler(atualizar_inscricao_canal, ChatMemberHandler.CHAT_MEMBER))
+
     app.add_handler(main_conv)
     app.add_handler(conv_resgate)
     app.add_handler(conv_wallet)
@@ -3226,6 +5559,18 @@ async def main():
             allow_reentry=True,
         )
     )
+    app.add_handler(
+        ConversationHandler(
+            entry_points=[CommandHandler("importar_usuarios", importar_usuarios, filters=filters.ChatType.PRIVATE)],
+            states={
+                IMPORTAR_ARQUIVO: [
+                    MessageHandler(filters.Document.ALL, receber_arquivo_importacao)
+                ],
+            },
+            fallbacks=[CommandHandler("cancelar", cancel)],
+            allow_reentry=True,
+        )
+    )
     sort_config_conv = ConversationHandler(
         entry_points=[CommandHandler("configurar_sort", configurar_sort)],
         states={
@@ -3257,17 +5602,20 @@ async def main():
     app.add_handler(CommandHandler('admin', admin, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler('meus_pontos', meus_pontos))
     # app.add_handler(CommandHandler('historico', historico, filters=filters.ChatType.PRIVATE))
-    app.add_handler(CallbackQueryHandler(callback_historico, pattern=r"^hist:\d+:\d+$"))
-    app.add_handler(CallbackQueryHandler(paginacao_via_start, pattern=r"^via_start:\d+$"))
+    app.add_handler(CallbackQueryHandler(callback_historico, pattern=r"^hist:\d+:\d+(:[ap]:\d+:\d+)?$"))
+    app.add_handler(CallbackQueryHandler(paginacao_via_start, pattern=r"^via_start:\d+:[ap]:\d+:\d+$"))
     app.add_handler(CommandHandler("backup", cmd_backup))
+    app.add_handler(CommandHandler("exportar", exportar, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("consultas", consultas_stats, filters=filters.ChatType.PRIVATE))
     # app.add_handler(CommandHandler("sortear", sortear))
     app.add_handler(CommandHandler("set", setar_canal))
     app.add_handler(sort_config_conv)
 
     #app.add_handler(CommandHandler('rank_tops', ranking_tops))
     app.add_handler(CommandHandler("historico_usuario", historico_usuario, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("buscar", buscar, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler("listar_usuarios", listar_usuarios, filters=filters.ChatType.PRIVATE))
-    app.add_handler(CallbackQueryHandler(callback_listar_usuarios, pattern=r'^usuarios\|\d+$'))
+    app.add_handler(CallbackQueryHandler(callback_listar_usuarios, pattern=r'^usuarios\|\d+\|[ap]\|\d+$'))
     app.add_handler(CommandHandler("listar_via_start", listar_via_start, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler("estatisticas", estatisticas, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler('como_ganhar', como_ganhar, filters=filters.ChatType.PRIVATE))
@@ -3279,11 +5627,15 @@ async def main():
     app.add_handler(CommandHandler("liberar_ganhadores", liberar_ganhadores, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler("list_ganhadores_sort", list_ganhadores_sort))
     app.add_handler(CommandHandler("list_pontuadores", listar_pontuadores, filters=filters.ChatType.PRIVATE))
-    app.add_handler(CallbackQueryHandler(callback_listar_ranking, pattern=r"^ranking\|\d+$"))
+    app.add_handler(CallbackQueryHandler(callback_listar_ranking, pattern=r"^ranking\|\d+\|[ap]\|-?\d+\|\d+$"))
     #app.add_handler(CallbackQueryHandler(iniciar_resgatar_codigo, pattern=r"^resgatar_codigo$"))
     #app.add_handler(CallbackQueryHandler(iniciar_resgatar_carteira, pattern=r"^resgatar_carteira$"))
     app.add_handler(CallbackQueryHandler(ver_historico_wallet, pattern=r"^ver_historico_wallet$"))
     app.add_handler(CommandHandler("timeline", timeline, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CallbackQueryHandler(callback_timeline, pattern=r"^tl:[ap]:\d+:\d+$"))
+    app.add_handler(CallbackQueryHandler(callback_pagina, pattern=r"^pg:[\w-]+:\d+$"))
+    app.add_handler(CommandHandler("ranking", ranking_janela))
+    app.add_handler(CommandHandler("campanha", definir_campanha, filters=filters.ChatType.PRIVATE))
     app.add_handler(CommandHandler("limpar_fila", limpar_fila))
     # Presença em grupos
     app.add_handler(MessageHandler(filters.ChatType.GROUPS, tratar_presenca))
@@ -3291,7 +5643,8 @@ async def main():
     app.add_handler(CommandHandler("wallet", wallet, filters=filters.ChatType.PRIVATE))
 
     logger.info("🔄 Iniciando polling...")
-    await app.run_polling()
+    # chat_member não vem por padrão; precisa ser pedido explicitamente
+    await app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,292 @@
+"""
+Testes contra um Postgres de verdade.
+
+Só rodam com DATABASE_URL_TESTE apontando para um banco exclusivo de testes
+(ex.: postgresql://postgres@localhost/pontuador_teste). Cada módulo de teste
+migra um schema descartável e o apaga no fim.
+"""
+import asyncio
+import json
+import os
+import sys
+import uuid
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+import pytest
+
+DSN = os.getenv("DATABASE_URL_TESTE")
+pytestmark = pytest.mark.skipif(not DSN, reason="DATABASE_URL_TESTE não definido")
+
+asyncpg = pytest.importorskip("asyncpg")
+pytest.importorskip("telegram")
+pytest.importorskip("nest_asyncio")
+pytest.importorskip("dotenv")
+
+# o módulo sai com erro sem token; os testes não falam com o Telegram
+os.environ.setdefault("TELEGRAM_TOKEN", "teste")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pontuador  # noqa: E402
+
+
+def rodar(coro):
+    return asyncio.run(coro)
+
+
+async def _search_path(conn: asyncpg.Connection, schema: str):
+    # pg_trgm pode já estar instalado em outro schema (normalmente public)
+    schema_trgm = await conn.fetchval("""
+        SELECT n.nspname FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace
+         WHERE e.extname = 'pg_trgm'
+    """)
+    caminho = [schema] + ([schema_trgm] if schema_trgm else [])
+    await conn.execute(f"SET search_path TO {', '.join(caminho)}")
+
+
+@asynccontextmanager
+async def conexao(schema: str):
+    conn = await asyncpg.connect(DSN)
+    try:
+        await _search_path(conn, schema)
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def _criar_schema() -> str:
+    schema = f"teste_{uuid.uuid4().hex[:10]}"
+    conn = await asyncpg.connect(DSN)
+    try:
+        await conn.execute(f"CREATE SCHEMA {schema}")
+        await _search_path(conn, schema)
+        await pontuador.aplicar_migracoes(conn)
+    finally:
+        await conn.close()
+    return schema
+
+
+async def _apagar_schema(schema: str):
+    conn = await asyncpg.connect(DSN)
+    try:
+        await conn.execute(f"DROP SCHEMA {schema} CASCADE")
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(scope="module")
+def schema():
+    """Schema novo com todas as migrações aplicadas."""
+    nome = rodar(_criar_schema())
+    yield nome
+    rodar(_apagar_schema(nome))
+
+
+# --- Índices dos caminhos quentes (migração 2) ---
+
+async def _popular(schema: str):
+    async with conexao(schema) as conn:
+        await conn.execute("""
+            INSERT INTO usuarios (user_id, pontos, ultima_interacao, inserido_em, nickname)
+            SELECT g, (g * 7919) % 5000, CURRENT_DATE - (g % 365),
+                   NOW() - (g % 365) * INTERVAL '1 day', 'nick' || g
+              FROM generate_series(1, 20000) AS g
+        """)
+        await conn.execute("""
+            INSERT INTO historico_pontos (user_id, pontos, motivo, data)
+            SELECT g % 20000 + 1, g % 50 + 1, 'teste',
+                   NOW() - (g % 90) * INTERVAL '1 day' - (g % 1440) * INTERVAL '1 minute'
+              FROM generate_series(1, 60000) AS g
+        """)
+        await conn.execute("""
+            INSERT INTO usuario_history (user_id, status, nickname, inserido_em)
+            SELECT g % 20000 + 1, 'Atualizado', 'nick' || (g % 20000 + 1),
+                   NOW() - g * INTERVAL '1 minute'
+              FROM generate_series(1, 40000) AS g
+        """)
+        await conn.execute("""
+            INSERT INTO fila_pagamento (user_id, code)
+            SELECT g, 'c' || g FROM generate_series(1, 20000) AS g
+        """)
+        await conn.execute("ANALYZE")
+
+
+@pytest.fixture(scope="module")
+def schema_populado(schema):
+    rodar(_popular(schema))
+    return schema
+
+
+async def plano(conn: asyncpg.Connection, sql: str, *args) -> tuple[set[str], set[str]]:
+    """(índices usados, tabelas lidas por Seq Scan) do plano da consulta."""
+    bruto = json.loads(await conn.fetchval(f"EXPLAIN (FORMAT JSON) {sql}", *args))
+    nos, pendentes = [], [bruto[0]["Plan"]]
+    while pendentes:
+        no = pendentes.pop()
+        nos.append(no)
+        pendentes.extend(no.get("Plans", []))
+
+    indices = set()
+    for no in nos:
+        if "Index Name" in no:
+            # índice de partição conta como o índice do pai
+            indices.add(await conn.fetchval(
+                "SELECT COALESCE(pg_partition_root($1::text::regclass), $1::text::regclass)::text",
+                no["Index Name"]
+            ))
+    sequenciais = {no["Relation Name"] for no in nos if no["Node Type"] == "Seq Scan"}
+    return indices, sequenciais
+
+
+def _consultas_quentes():
+    """(nome, sql, args, índices aceitos) das consultas mais frequentes do bot."""
+    ontem = pontuador.hoje_data_sp() - timedelta(days=1)
+    inicio, fim = pontuador.intervalo_dia_sp(ontem)
+    return [
+        ("checkins_do_dia", pontuador.consultas.sql["checkins_do_dia"], (ontem,),
+         {"idx_usuarios_ultima_interacao"}),
+        ("top_ranking", pontuador.consultas.sql["top_ranking"], (10,),
+         {"idx_usuarios_pontos"}),
+        ("ranking_do_dia", pontuador.SQL_SNAPSHOT_RANKING, ("dia", inicio, fim, 10),
+         {"idx_historico_pontos_data", "idx_historico_pontos_user_data"}),
+        ("fila_por_codigo", pontuador.consultas.sql["fila_por_codigo"], ("c123",),
+         {"idx_fila_pagamento_code"}),
+        ("historico_por_usuario",
+         "SELECT * FROM usuario_history WHERE user_id = $1 ORDER BY inserido_em DESC, id DESC LIMIT $2",
+         (123, 16), {"idx_usuario_history_user"}),
+        ("historico_por_nickname",
+         "SELECT user_id FROM usuario_history WHERE nickname = $1 ORDER BY inserido_em DESC LIMIT 1",
+         ("nick123",), {"idx_usuario_history_nickname"}),
+    ]
+
+
+CONSULTAS_QUENTES = _consultas_quentes()
+
+
+@pytest.mark.parametrize("nome,sql,args,esperados", CONSULTAS_QUENTES, ids=[c[0] for c in CONSULTAS_QUENTES])
+def test_consulta_quente_usa_indice(schema_populado, nome, sql, args, esperados):
+    async def verificar():
+        async with conexao(schema_populado) as conn:
+            return await plano(conn, sql, *args)
+
+    indices, sequenciais = rodar(verificar())
+    assert indices & esperados, f"{nome}: esperava {esperados}, plano usou {indices or 'nenhum índice'}"
+    assert not sequenciais, f"{nome}: Seq Scan em {sequenciais}"
+
+
+# --- Rollup stats_diarias (migrações 5 e 9) ---
+
+async def _niveis_hoje(conn: asyncpg.Connection) -> int:
+    return await conn.fetchval("""
+        SELECT COALESCE(MAX(niveis_atingidos), 0) FROM stats_diarias
+         WHERE dia = (NOW() AT TIME ZONE 'America/Sao_Paulo')::date
+    """)
+
+
+def test_zerar_e_subir_de_novo_nao_conta_nivel_outra_vez(schema):
+    sql = pontuador.consultas.sql
+    limiares = sorted(pontuador.NIVEIS_BRINDES)
+    user_id = 9_000_001
+
+    async def cenario():
+        async with conexao(schema) as conn:
+            inicial = await _niveis_hoje(conn)
+            await conn.execute("INSERT INTO usuarios (user_id) VALUES ($1)", user_id)
+
+            # sobe até o nível 2: conta uma vez
+            await conn.execute(sql["gravar_pontos"], 350, 2, user_id)
+            depois_subir = await _niveis_hoje(conn)
+
+            # resgate zera os pontos e o próximo check-in recalcula o nível para baixo
+            await conn.execute(sql["zerar_pontos"], user_id)
+            await conn.fetchrow(pontuador.SQL_CHECKIN, user_id, 10, limiares, pontuador.hoje_data_sp())
+            # o nível caiu, mas o usuário continua entre os que já atingiram algum nível
+            total = await conn.fetchval(
+                "SELECT usuarios_nivel_total FROM (" + sql["estatisticas"] + ") AS e",
+                pontuador.hoje_data_sp()
+            )
+            maximo = await conn.fetchval("SELECT nivel FROM stats_nivel_maximo WHERE user_id = $1", user_id)
+            # simula a virada do dia: a marca diária não pode ser o que impede a recontagem
+            await conn.execute("DELETE FROM stats_usuarios_dia WHERE user_id = $1", user_id)
+
+            # volta ao nível 2: não é nível novo
+            await conn.execute(sql["gravar_pontos"], 360, 2, user_id)
+            final = await _niveis_hoje(conn)
+            nivel = await conn.fetchval("SELECT nivel_atingido FROM usuarios WHERE user_id = $1", user_id)
+            return inicial, depois_subir, final, nivel, total, maximo
+
+    inicial, depois_subir, final, nivel, total, maximo = rodar(cenario())
+    assert maximo == 2 and total >= 1
+    assert nivel == 2
+    assert depois_subir == inicial + 1
+    assert final == depois_subir
+
+
+# --- Upsert de usuário (adicionar_usuario_db) ---
+
+async def _esperar_bloqueio(observador: asyncpg.Connection, bloqueada: asyncpg.Connection):
+    pid = bloqueada.get_server_pid()
+    for _ in range(200):
+        if await observador.fetchval(
+            "SELECT wait_event_type = 'Lock' FROM pg_stat_activity WHERE pid = $1", pid
+        ):
+            return
+        await asyncio.sleep(0.025)
+    raise AssertionError("o segundo upsert não chegou a esperar pelo primeiro")
+
+
+def test_upserts_concorrentes_do_mesmo_usuario(schema):
+    user_id = 9_000_002
+    perfil = dict(username="corrida", first_name="Teste", last_name="vazio",
+                  display_choice="indefinido", nickname="sem nick", via_start=True)
+
+    async def cenario():
+        async with conexao(schema) as a, conexao(schema) as b, conexao(schema) as obs:
+            tx = a.transaction()
+            await tx.start()
+            primeira = await a.fetchrow(
+                pontuador.SQL_UPSERT_USUARIO, user_id, *perfil.values()
+            )
+            # o segundo /start fica preso no conflito até o primeiro confirmar
+            corrida = asyncio.create_task(
+                pontuador.adicionar_usuario_db(user_id, **perfil, pool_override=b)
+            )
+            await _esperar_bloqueio(obs, b)
+            await tx.commit()
+            segunda = await asyncio.wait_for(corrida, timeout=10)
+            inseridos = await obs.fetchval(
+                "SELECT COUNT(*) FROM usuario_history WHERE user_id = $1 AND status = 'Inserido'",
+                user_id
+            )
+            return primeira, segunda, inseridos
+
+    primeira, segunda, inseridos = rodar(cenario())
+    assert primeira["status"] == "Inserido"
+    assert segunda is not None and segunda["user_id"] == user_id
+    assert inseridos == 1
+
+
+# --- Partições mensais (migrações 6 e 10) ---
+
+def test_criar_particao_resgata_linhas_da_default(schema):
+    mes = (pontuador.hoje_data_sp().replace(day=1) + timedelta(days=75)).replace(day=1)
+    user_id = 9_000_003
+
+    async def cenario():
+        async with conexao(schema) as conn:
+            await conn.execute("INSERT INTO usuarios (user_id) VALUES ($1)", user_id)
+            # sem partição para o mês, a linha cai na DEFAULT
+            await conn.execute(
+                "INSERT INTO historico_pontos (user_id, pontos, data) VALUES ($1, 5, $2)",
+                user_id, pontuador.intervalo_dia_sp(mes.replace(day=10))[0]
+            )
+            movidas = await conn.fetchval("SELECT criar_particao_mensal('historico_pontos', $1)", mes)
+            onde = await conn.fetchval(
+                "SELECT tableoid::regclass::text FROM historico_pontos WHERE user_id = $1", user_id
+            )
+            de_novo = await conn.fetchval("SELECT criar_particao_mensal('historico_pontos', $1)", mes)
+            return movidas, onde, de_novo
+
+    movidas, onde, de_novo = rodar(cenario())
+    assert movidas == 1
+    assert onde == f"historico_pontos_{mes:%Y_%m}"
+    assert de_novo == 0